@@ -22,7 +22,9 @@ CREATE TABLE IF NOT EXISTS users (
     -- showing up on the frontpage
     blocked BOOLEAN DEFAULT FALSE,
     -- migration flag, whether or not the migrated user has logged in at all
-    active BOOLEAN DEFAULT TRUE
+    active BOOLEAN DEFAULT TRUE,
+    -- sorted copy of the user's bot_categories, maintained by a trigger
+    category_ids INTEGER[] NOT NULL DEFAULT '{}'
 );
 
 -- DEPRECIATED: now served by directory service
@@ -43,6 +45,7 @@ CREATE INDEX IF NOT EXISTS idx_users_groupchatbots ON users (is_groupchatbot);
 CREATE INDEX IF NOT EXISTS idx_users_tsv ON users USING gin(tsv);
 
 CREATE INDEX IF NOT EXISTS idx_users_went_public ON users (went_public DESC NULLS LAST);
+CREATE INDEX IF NOT EXISTS idx_users_category_ids ON users USING gin(category_ids);
 
 CREATE FUNCTION users_search_trigger() RETURNS TRIGGER AS $$
 BEGIN
@@ -56,12 +59,26 @@ $$ LANGUAGE plpgsql;
 CREATE TRIGGER tsvectorupdate BEFORE INSERT OR UPDATE
 ON users FOR EACH ROW EXECUTE PROCEDURE users_search_trigger();
 
+CREATE FUNCTION users_updated_trigger() RETURNS TRIGGER AS $$
+BEGIN
+    NEW.updated := (now() AT TIME ZONE 'utc');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER users_set_updated BEFORE UPDATE
+ON users FOR EACH ROW EXECUTE PROCEDURE users_updated_trigger();
+
 CREATE TABLE IF NOT EXISTS avatars (
     toshi_id VARCHAR,
     img BYTEA,
     hash VARCHAR,
     format VARCHAR NOT NULL,
     last_modified TIMESTAMP WITHOUT TIME ZONE DEFAULT (now() AT TIME ZONE 'utc'),
+    size INTEGER,
+    source_hash VARCHAR,
+    length INTEGER,
+    url VARCHAR,
 
     PRIMARY KEY (toshi_id, hash)
 );
@@ -70,6 +87,8 @@ CREATE INDEX IF NOT EXISTS idx_avatars_toshi_id_hash_substr ON avatars (toshi_id
 CREATE INDEX IF NOT EXISTS idx_avatars_toshi_id_format_hash_substr ON avatars (toshi_id, format, substring(hash for 5));
 CREATE INDEX IF NOT EXISTS idx_avatars_toshi_id_last_modified ON avatars (toshi_id, last_modified DESC NULLS LAST);
 CREATE INDEX IF NOT EXISTS idx_avatars_toshi_id_format_last_modified ON avatars (toshi_id, format, last_modified DESC NULLS LAST);
+CREATE INDEX IF NOT EXISTS idx_avatars_toshi_id_source_hash ON avatars (toshi_id, source_hash);
+CREATE INDEX IF NOT EXISTS idx_avatars_identicons ON avatars (toshi_id) WHERE toshi_id LIKE '%\_identicon\_%';
 
 CREATE TABLE IF NOT EXISTS reports (
     report_id SERIAL PRIMARY KEY,
@@ -108,4 +127,66 @@ CREATE TABLE IF NOT EXISTS websocket_sessions (
 CREATE INDEX IF NOT EXISTS idx_websocket_sessions_toshi_id ON websocket_sessions (toshi_id);
 CREATE INDEX IF NOT EXISTS idx_websocket_sessions_last_seen ON websocket_sessions (last_seen DESC);
 
-UPDATE database_version SET version_number = 27;
+-- notifies listeners (see toshiid.invalidation) of changes to a user's data
+CREATE FUNCTION notify_user_changed() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('user_changed', OLD.toshi_id);
+    ELSE
+        PERFORM pg_notify('user_changed', NEW.toshi_id);
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER users_notify_changed AFTER INSERT OR UPDATE OR DELETE
+ON users FOR EACH ROW EXECUTE PROCEDURE notify_user_changed();
+
+CREATE TRIGGER bot_categories_notify_changed AFTER INSERT OR UPDATE OR DELETE
+ON bot_categories FOR EACH ROW EXECUTE PROCEDURE notify_user_changed();
+
+-- keeps users.category_ids in sync with bot_categories
+CREATE FUNCTION update_user_category_ids(user_toshi_id VARCHAR) RETURNS VOID AS $$
+DECLARE
+    new_category_ids INTEGER[];
+BEGIN
+    new_category_ids := ARRAY(SELECT category_id FROM bot_categories
+                              WHERE toshi_id = user_toshi_id ORDER BY category_id);
+    UPDATE users SET category_ids = new_category_ids
+    WHERE toshi_id = user_toshi_id AND category_ids IS DISTINCT FROM new_category_ids;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION bot_categories_sync_trigger() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP <> 'INSERT' THEN
+        PERFORM update_user_category_ids(OLD.toshi_id);
+    END IF;
+    IF TG_OP = 'INSERT' OR (TG_OP = 'UPDATE' AND NEW.toshi_id IS DISTINCT FROM OLD.toshi_id) THEN
+        PERFORM update_user_category_ids(NEW.toshi_id);
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+-- deferred so that it only sees the final set of categories
+CREATE CONSTRAINT TRIGGER bot_categories_sync AFTER INSERT OR UPDATE OR DELETE
+ON bot_categories DEFERRABLE INITIALLY DEFERRED
+FOR EACH ROW EXECUTE PROCEDURE bot_categories_sync_trigger();
+
+-- side effects of requests that are run by the housekeeping process
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id SERIAL PRIMARY KEY,
+    kind VARCHAR NOT NULL,
+    payload JSONB NOT NULL DEFAULT '{}',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    failed BOOLEAN NOT NULL DEFAULT FALSE,
+    last_error VARCHAR,
+    created TIMESTAMP WITHOUT TIME ZONE DEFAULT (now() AT TIME ZONE 'utc'),
+    run_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT (now() AT TIME ZONE 'utc'),
+    locked_until TIMESTAMP WITHOUT TIME ZONE
+);
+
+CREATE INDEX IF NOT EXISTS idx_jobs_run_at ON jobs (run_at) WHERE failed = FALSE;
+
+UPDATE database_version SET version_number = 37;
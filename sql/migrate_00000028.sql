@@ -0,0 +1,16 @@
+CREATE FUNCTION notify_user_changed() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('user_changed', OLD.toshi_id);
+    ELSE
+        PERFORM pg_notify('user_changed', NEW.toshi_id);
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER users_notify_changed AFTER INSERT OR UPDATE OR DELETE
+ON users FOR EACH ROW EXECUTE PROCEDURE notify_user_changed();
+
+CREATE TRIGGER bot_categories_notify_changed AFTER INSERT OR UPDATE OR DELETE
+ON bot_categories FOR EACH ROW EXECUTE PROCEDURE notify_user_changed();
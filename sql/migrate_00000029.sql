@@ -0,0 +1,34 @@
+ALTER TABLE users ADD COLUMN category_ids INTEGER[] NOT NULL DEFAULT '{}';
+
+UPDATE users SET category_ids = c.category_ids
+FROM (SELECT toshi_id, array_agg(category_id ORDER BY category_id) AS category_ids
+      FROM bot_categories GROUP BY toshi_id) AS c
+WHERE users.toshi_id = c.toshi_id;
+
+CREATE INDEX IF NOT EXISTS idx_users_category_ids ON users USING gin(category_ids);
+
+CREATE FUNCTION update_user_category_ids(user_toshi_id VARCHAR) RETURNS VOID AS $$
+DECLARE
+    new_category_ids INTEGER[];
+BEGIN
+    new_category_ids := ARRAY(SELECT category_id FROM bot_categories
+                              WHERE toshi_id = user_toshi_id ORDER BY category_id);
+    UPDATE users SET category_ids = new_category_ids
+    WHERE toshi_id = user_toshi_id AND category_ids IS DISTINCT FROM new_category_ids;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION bot_categories_sync_trigger() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP <> 'INSERT' THEN
+        PERFORM update_user_category_ids(OLD.toshi_id);
+    END IF;
+    IF TG_OP = 'INSERT' OR (TG_OP = 'UPDATE' AND NEW.toshi_id IS DISTINCT FROM OLD.toshi_id) THEN
+        PERFORM update_user_category_ids(NEW.toshi_id);
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER bot_categories_sync AFTER INSERT OR UPDATE OR DELETE
+ON bot_categories FOR EACH ROW EXECUTE PROCEDURE bot_categories_sync_trigger();
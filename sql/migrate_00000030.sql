@@ -0,0 +1,8 @@
+-- run the category sync when the transaction commits, so that it only sees
+-- the final set of categories and is a no-op when update_user has already
+-- set users.category_ids
+DROP TRIGGER bot_categories_sync ON bot_categories;
+
+CREATE CONSTRAINT TRIGGER bot_categories_sync AFTER INSERT OR UPDATE OR DELETE
+ON bot_categories DEFERRABLE INITIALLY DEFERRED
+FOR EACH ROW EXECUTE PROCEDURE bot_categories_sync_trigger();
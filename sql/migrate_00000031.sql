@@ -0,0 +1,9 @@
+CREATE FUNCTION users_updated_trigger() RETURNS TRIGGER AS $$
+BEGIN
+    NEW.updated := (now() AT TIME ZONE 'utc');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER users_set_updated BEFORE UPDATE
+ON users FOR EACH ROW EXECUTE PROCEDURE users_updated_trigger();
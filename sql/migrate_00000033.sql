@@ -0,0 +1,6 @@
+-- the largest dimension of the image, NULL for avatars stored before sizes were recorded
+ALTER TABLE avatars ADD COLUMN size INTEGER;
+-- for resized copies of an avatar, the hash of the avatar they were made from
+ALTER TABLE avatars ADD COLUMN source_hash VARCHAR;
+
+CREATE INDEX IF NOT EXISTS idx_avatars_toshi_id_source_hash ON avatars (toshi_id, source_hash);
@@ -0,0 +1,2 @@
+-- the size of the image in bytes, used to pick the smallest format a client accepts
+ALTER TABLE avatars ADD COLUMN length INTEGER;
@@ -0,0 +1,3 @@
+-- jobs are leased to a worker while they run, rather than being locked for
+-- the duration of a transaction
+ALTER TABLE jobs ADD COLUMN locked_until TIMESTAMP WITHOUT TIME ZONE;
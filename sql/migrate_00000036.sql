@@ -0,0 +1,2 @@
+-- lets housekeeping find stored identicons without scanning every avatar
+CREATE INDEX IF NOT EXISTS idx_avatars_identicons ON avatars (toshi_id) WHERE toshi_id LIKE '%\_identicon\_%';
@@ -0,0 +1,2 @@
+-- the url of an avatar stored in s3, for rows that only hold its metadata
+ALTER TABLE avatars ADD COLUMN url VARCHAR;
@@ -0,0 +1,139 @@
+import asyncio
+import base64
+import time
+from collections import deque
+
+import tornado.httpclient
+from tornado.escape import json_encode, url_escape
+from tornado.platform.asyncio import to_asyncio_future
+
+from toshi.analytics import AnalyticsMixin, encode_id
+from toshi.log import log
+
+MIXPANEL_API_HOST = "https://api.mixpanel.com"
+# the most events mixpanel accepts in a single request
+MAX_BATCH_SIZE = 50
+DEFAULT_FLUSH_INTERVAL = 5
+DEFAULT_MAX_BACKLOG = 10000
+
+class AnalyticsDispatcher:
+    """Buffers mixpanel events and profile updates in memory and sends them
+    in batches from a background task.
+
+    A batch is sent once `batch_size` updates of the same type are queued,
+    or every `flush_interval` seconds otherwise. When `max_backlog` updates
+    are waiting new ones are dropped, and batches that fail to send are
+    dropped rather than retried, so analytics can never hold up requests."""
+
+    def __init__(self, token, *, api_host=MIXPANEL_API_HOST, batch_size=MAX_BATCH_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL, max_backlog=DEFAULT_MAX_BACKLOG):
+        self._token = token
+        self._api_host = api_host
+        self._batch_size = min(batch_size, MAX_BATCH_SIZE)
+        self._flush_interval = flush_interval
+        self._max_backlog = max_backlog
+
+        self._queues = {'track': deque(), 'engage': deque()}
+        self._full = asyncio.Event()
+        self._task = None
+        self._http_client = tornado.httpclient.AsyncHTTPClient()
+
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+
+    @property
+    def backlog(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    def _enqueue(self, endpoint, message):
+        if self.backlog >= self._max_backlog:
+            if self.dropped % 1000 == 0:
+                log.warning("Analytics backlog full, dropping events ({} dropped so far)".format(self.dropped))
+            self.dropped += 1
+            return
+        queue = self._queues[endpoint]
+        queue.append(message)
+        if len(queue) >= self._batch_size:
+            self._full.set()
+
+    def track(self, distinct_id, event, properties=None):
+        message_properties = {
+            'token': self._token,
+            'time': int(time.time()),
+            'mp_lib': 'python'
+        }
+        if distinct_id is not None:
+            message_properties['distinct_id'] = distinct_id
+        if properties:
+            message_properties.update(properties)
+        self._enqueue('track', {'event': event, 'properties': message_properties})
+
+    def people_set(self, distinct_id, properties):
+        self._enqueue('engage', {
+            '$token': self._token,
+            '$time': int(time.time() * 1000),
+            '$distinct_id': distinct_id,
+            '$set': properties
+        })
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    def shutdown(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), self._flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            await self.flush()
+
+    async def flush(self):
+        """Sends everything that is currently queued"""
+        for endpoint, queue in self._queues.items():
+            while queue:
+                batch = [queue.popleft() for _ in range(min(self._batch_size, len(queue)))]
+                try:
+                    await self._send(endpoint, batch)
+                    self.sent += len(batch)
+                except Exception as e:
+                    self.failed += len(batch)
+                    log.warning("Error sending {} analytics events: {}".format(len(batch), e))
+
+    async def _send(self, endpoint, batch):
+        data = base64.b64encode(json_encode(batch).encode('utf-8')).decode('ascii')
+        await to_asyncio_future(self._http_client.fetch(
+            "{}/{}/".format(self._api_host, endpoint), method="POST",
+            headers={'Content-Type': 'application/x-www-form-urlencoded'},
+            body="data={}".format(url_escape(data))))
+
+    def stats(self):
+        return {
+            'backlog': self.backlog,
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'failed': self.failed
+        }
+
+class BufferedAnalyticsMixin(AnalyticsMixin):
+    """Sends analytics through the application's `analytics_dispatcher` when
+    one is configured, falling back to the default `AnalyticsMixin`"""
+
+    def track(self, toshi_id, event, data=None):
+        dispatcher = getattr(self.application, 'analytics_dispatcher', None)
+        if dispatcher is None:
+            return super().track(toshi_id, event, data)
+        dispatcher.track(encode_id(toshi_id) if toshi_id else None, event, data)
+
+    def people_set(self, toshi_id, data):
+        dispatcher = getattr(self.application, 'analytics_dispatcher', None)
+        if dispatcher is None:
+            return super().people_set(toshi_id, data)
+        dispatcher.people_set(encode_id(toshi_id), data)
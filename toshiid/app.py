@@ -4,6 +4,13 @@ from toshiid import handlers_v1
 from toshiid import websocket
 from toshiid import login
 from toshiid import search_v2
+from toshiid import users_v2
+from toshiid import sprite
+from toshiid.invalidation import InvalidationListener
+from toshiid.analytics import AnalyticsDispatcher
+from toshiid.migration import migration_notifier_stats
+from toshiid.image_workers import ImageWorkerPool
+from toshiid.stats import StatsLogger, app_stats_source
 from toshi.handlers import GenerateTimestamp
 import toshi.config
 
@@ -26,6 +33,74 @@ def update_config():
     elif 'apps_public_by_default' not in toshi.config.config['general']:
         toshi.config.config['general']['apps_public_by_default'] = 'false'
 
+    if 'USER_CACHE_SIZE' in os.environ:
+        toshi.config.config['general']['user_cache_size'] = os.environ['USER_CACHE_SIZE']
+    elif 'user_cache_size' not in toshi.config.config['general']:
+        toshi.config.config['general']['user_cache_size'] = '10000'
+
+    if 'USER_CACHE_TTL' in os.environ:
+        toshi.config.config['general']['user_cache_ttl'] = os.environ['USER_CACHE_TTL']
+    elif 'user_cache_ttl' not in toshi.config.config['general']:
+        toshi.config.config['general']['user_cache_ttl'] = '60'
+
+    if 'USER_JSON_CACHE_SIZE' in os.environ:
+        toshi.config.config['general']['user_json_cache_size'] = os.environ['USER_JSON_CACHE_SIZE']
+    elif 'user_json_cache_size' not in toshi.config.config['general']:
+        toshi.config.config['general']['user_json_cache_size'] = '10000'
+
+    if 'IDENTICON_CACHE_SIZE' in os.environ:
+        toshi.config.config['general']['identicon_cache_size'] = os.environ['IDENTICON_CACHE_SIZE']
+    elif 'identicon_cache_size' not in toshi.config.config['general']:
+        toshi.config.config['general']['identicon_cache_size'] = str(16 * 1024 * 1024)
+
+    if 'IDENTICON_CACHE_DIR' in os.environ:
+        toshi.config.config['general']['identicon_cache_dir'] = os.environ['IDENTICON_CACHE_DIR']
+
+    if 'AVATAR_STORE_DIR' in os.environ:
+        toshi.config.config['general']['avatar_store_dir'] = os.environ['AVATAR_STORE_DIR']
+
+    if 'IDENTICON_CACHE_ONLY' in os.environ:
+        toshi.config.config['general']['identicon_cache_only'] = os.environ['IDENTICON_CACHE_ONLY']
+    elif 'identicon_cache_only' not in toshi.config.config['general']:
+        toshi.config.config['general']['identicon_cache_only'] = 'false'
+
+    if 'IMAGE_WORKER_PROCESSES' in os.environ:
+        toshi.config.config['general']['image_worker_processes'] = os.environ['IMAGE_WORKER_PROCESSES']
+    elif 'image_worker_processes' not in toshi.config.config['general']:
+        # every web process (e.g. each of WEB_CONCURRENCY on heroku) starts its
+        # own pool, so one worker each rather than one per cpu in every process
+        toshi.config.config['general']['image_worker_processes'] = '1'
+
+    if 'IMAGE_WORKER_QUEUE_SIZE' in os.environ:
+        toshi.config.config['general']['image_worker_queue_size'] = os.environ['IMAGE_WORKER_QUEUE_SIZE']
+    elif 'image_worker_queue_size' not in toshi.config.config['general']:
+        toshi.config.config['general']['image_worker_queue_size'] = '16'
+
+    if 'AVATAR_MAX_UPLOAD_SIZE' in os.environ:
+        toshi.config.config['general']['avatar_max_upload_size'] = os.environ['AVATAR_MAX_UPLOAD_SIZE']
+    elif 'avatar_max_upload_size' not in toshi.config.config['general']:
+        toshi.config.config['general']['avatar_max_upload_size'] = str(10 * 1024 * 1024)
+
+    if 'AVATAR_MAX_PIXELS' in os.environ:
+        toshi.config.config['general']['avatar_max_pixels'] = os.environ['AVATAR_MAX_PIXELS']
+    elif 'avatar_max_pixels' not in toshi.config.config['general']:
+        toshi.config.config['general']['avatar_max_pixels'] = str(50 * 1000 * 1000)
+
+    if 'STATS_LOG_INTERVAL' in os.environ:
+        toshi.config.config['general']['stats_log_interval'] = os.environ['STATS_LOG_INTERVAL']
+    elif 'stats_log_interval' not in toshi.config.config['general']:
+        toshi.config.config['general']['stats_log_interval'] = '60'
+
+    if 'ANALYTICS_FLUSH_INTERVAL' in os.environ:
+        toshi.config.config['general']['analytics_flush_interval'] = os.environ['ANALYTICS_FLUSH_INTERVAL']
+    elif 'analytics_flush_interval' not in toshi.config.config['general']:
+        toshi.config.config['general']['analytics_flush_interval'] = '5'
+
+    if 'ANALYTICS_MAX_BACKLOG' in os.environ:
+        toshi.config.config['general']['analytics_max_backlog'] = os.environ['ANALYTICS_MAX_BACKLOG']
+    elif 'analytics_max_backlog' not in toshi.config.config['general']:
+        toshi.config.config['general']['analytics_max_backlog'] = '10000'
+
 urls = [
 
     # #### VERSION 1 #### #
@@ -66,10 +141,35 @@ urls = [
     (r"^/v2/user/?$", handlers_v1.UserCreationHandler, {'api_version': 2}),
     (r"^/v2/user/(?P<username>[^/]+)/?$", handlers_v1.UserHandler, {'api_version': 2}),
     (r"^/v2/search/?$", search_v2.SearchHandler),
+    (r"^/v2/users/batch/?$", users_v2.UserBatchHandler),
+    (r"^/v2/users/changes/?$", users_v2.UserChangesHandler),
+    (r"^/v2/avatars/sprite/?$", sprite.AvatarSpriteHandler),
 
 ]
 
 def main():
     update_config()
     app = toshi.web.Application(urls)
+    app.invalidation_listener = InvalidationListener()
+    app.invalidation_listener.start()
+    config = toshi.config.config
+    if 'mixpanel' in config and 'token' in config['mixpanel']:
+        app.analytics_dispatcher = AnalyticsDispatcher(
+            config['mixpanel']['token'],
+            flush_interval=config['general'].getfloat('analytics_flush_interval'),
+            max_backlog=config['general'].getint('analytics_max_backlog'))
+        app.analytics_dispatcher.start()
+    if config['general'].getint('image_worker_processes') > 0:
+        app.image_workers = ImageWorkerPool(
+            config['general'].getint('image_worker_processes'),
+            max_queue_size=config['general'].getint('image_worker_queue_size'))
+    if config['general'].getfloat('stats_log_interval') > 0:
+        app.stats_logger = StatsLogger(config['general'].getfloat('stats_log_interval'))
+        app.stats_logger.add_source('user_cache', app_stats_source(app, 'user_cache'))
+        app.stats_logger.add_source('user_json_cache', app_stats_source(app, 'user_json_cache'))
+        app.stats_logger.add_source('identicon_cache', app_stats_source(app, 'identicon_cache'))
+        app.stats_logger.add_source('migration_notifier', migration_notifier_stats)
+        app.stats_logger.add_source('analytics', app_stats_source(app, 'analytics_dispatcher'))
+        app.stats_logger.add_source('image_workers', app_stats_source(app, 'image_workers'))
+        app.stats_logger.start()
     app.start()
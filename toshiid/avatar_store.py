@@ -0,0 +1,143 @@
+import asyncio
+import datetime
+import email.utils
+import mmap
+import os
+import tempfile
+
+from toshi.config import config
+from tornado.web import HTTPError
+
+# size of the chunks avatars are written to the response in
+CHUNK_SIZE = 64 * 1024
+
+# the columns needed to serve an avatar, which only includes the image
+# itself if it's stored in the database
+AVATAR_COLUMNS = "toshi_id, hash, format, last_modified, img, url"
+
+FORMAT_EXTENSIONS = {
+    'PNG': 'png',
+    'JPEG': 'jpg',
+    'SVG': 'svg'
+}
+
+class DatabaseAvatarStore:
+    """Stores avatar images in the `img` column of the avatars table"""
+
+    async def put(self, hash, format, data, overwrite=False):
+        """Stores the image, returning the value for the `img` column"""
+        return data
+
+    def open(self, hash, format):
+        raise FileNotFoundError("Avatar {} is not stored in the database".format(hash))
+
+class FilesystemAvatarStore:
+    """Stores avatar images in `directory`, named by their hash, with only
+    their metadata (and a NULL `img`) stored in the avatars table.
+
+    As files are named by hash, an image shared by several rows is only
+    stored once, and files never change once they're written."""
+
+    def __init__(self, directory):
+        self._directory = directory
+
+    def path(self, hash, format):
+        return os.path.join(self._directory, hash[:2], "{}.{}".format(hash, FORMAT_EXTENSIONS.get(format, format.lower())))
+
+    def write(self, hash, format, data, overwrite=False):
+        """Writes the image unless it's already stored. `overwrite` replaces
+        an existing file, for repairing one that turned out to be broken"""
+        path = self.path(hash, format)
+        if not overwrite and os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file first so readers never see partial files
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        # the rename is only durable once the directory itself is synced
+        dir_fd = os.open(os.path.dirname(path), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    def read(self, hash, format):
+        with open(self.path(hash, format), 'rb') as f:
+            return f.read()
+
+    async def put(self, hash, format, data, overwrite=False):
+        await asyncio.get_event_loop().run_in_executor(None, self.write, hash, format, data, overwrite)
+        return None
+
+    def open(self, hash, format):
+        """Returns a read only memory map of the image"""
+        with open(self.path(hash, format), 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def create_avatar_store():
+    directory = config['general'].get('avatar_store_dir', None) if 'general' in config else None
+    if directory:
+        return FilesystemAvatarStore(directory)
+    return DatabaseAvatarStore()
+
+class AvatarStoreMixin:
+
+    @property
+    def avatar_store(self):
+        store = getattr(self.application, 'avatar_store', None)
+        if store is None:
+            store = self.application.avatar_store = create_avatar_store()
+        return store
+
+    async def handle_avatar_response(self, row, mime_type, include_body=True):
+        """Writes the avatar in the given avatars row, reading it from the
+        avatar store if it's not stored in the row itself, or redirecting to
+        it if it's stored in s3"""
+
+        if row['img'] is not None:
+            await self.handle_file_response(row['img'], mime_type, row['hash'], row['last_modified'])
+            return
+
+        if row['url'] is not None:
+            self.redirect(row['url'])
+            return
+
+        try:
+            data = self.avatar_store.open(row['hash'], row['format'])
+        except (FileNotFoundError, ValueError):
+            # ValueError is raised when mapping an empty file
+            raise HTTPError(404)
+
+        with data:
+            self.set_header("Content-Type", mime_type)
+            self.set_header("Etag", '"{}"'.format(row['hash']))
+            self.set_header("Last-Modified", row['last_modified'])
+            if 'If-None-Match' in self.request.headers:
+                not_modified = self.check_etag_header()
+            else:
+                not_modified = not self.modified_since(row['last_modified'])
+            if not_modified:
+                self.set_status(304)
+                return
+            self.set_header("Content-Length", len(data))
+            if not include_body:
+                return
+            # the image is copied into the response a chunk at a time, rather
+            # than being read into memory all at once
+            for offset in range(0, len(data), CHUNK_SIZE):
+                self.write(data[offset:offset + CHUNK_SIZE])
+                await self.flush()
+
+    def modified_since(self, last_modified):
+        ims_value = self.request.headers.get("If-Modified-Since")
+        if ims_value is None:
+            return True
+        date_tuple = email.utils.parsedate(ims_value)
+        if date_tuple is None:
+            return True
+        # http dates only have second precision
+        return last_modified.replace(microsecond=0) > datetime.datetime(*date_tuple[:6])
@@ -0,0 +1,164 @@
+import time
+from collections import OrderedDict
+
+from toshi.config import config
+
+class LRUCache:
+    """Bounded LRU cache with an optional time to live for entries.
+
+    A `max_size` of 0 (or less) disables the cache: every `get` returns
+    the default and `set` is a no-op."""
+
+    def __init__(self, max_size, ttl=None, *, timer=time.monotonic):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._timer = timer
+        self._data = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        # entries dropped due to size or ttl limits
+        self.evictions = 0
+        # entries explicitly removed via `invalidate`
+        self.invalidations = 0
+
+    @property
+    def enabled(self):
+        return self._max_size > 0
+
+    def get(self, key, default=None):
+        if not self.enabled:
+            return default
+        try:
+            value, expires = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        if expires is not None and expires <= self._timer():
+            del self._data[key]
+            self.evictions += 1
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        if not self.enabled:
+            return
+        expires = self._timer() + self._ttl if self._ttl else None
+        self._data[key] = (value, expires)
+        self._data.move_to_end(key)
+        while len(self._data) > self._max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        if self._data.pop(key, None) is not None:
+            self.invalidations += 1
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def stats(self):
+        return {
+            'size': len(self._data),
+            'max_size': self._max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations
+        }
+
+class UserCache:
+    """Caches user rows by toshi_id, with secondary lookups by username.
+
+    Username entries only store the toshi_id they resolved to, and are
+    verified against the cached row on lookup, so evicting a user only
+    requires knowing their toshi_id.
+
+    Rows read from the database can be outdated by the time they are
+    `put`, if the user was changed in the meantime. Callers take a
+    `generation()` token before querying, and `put` drops the row if
+    the user (or the whole cache) was evicted since then."""
+
+    def __init__(self, max_size, ttl=None):
+        self.rows = LRUCache(max_size, ttl)
+        self.usernames = LRUCache(max_size, ttl)
+        self._max_size = max_size
+        self._generation = 0
+        # generation at which each toshi_id was last evicted
+        self._evicted = OrderedDict()
+        # rows from generations before this are always dropped
+        self._min_generation = 0
+
+    def generation(self):
+        return self._generation
+
+    def get_by_toshi_id(self, toshi_id):
+        return self.rows.get(toshi_id)
+
+    def get_by_username(self, username):
+        username = username.lower()
+        toshi_id = self.usernames.get(username)
+        if toshi_id is None:
+            return None
+        row = self.rows.get(toshi_id)
+        if row is None or row['username'] is None or row['username'].lower() != username:
+            self.usernames.invalidate(username)
+            return None
+        return row
+
+    def put(self, row, generation=None):
+        if generation is not None and (
+                generation < self._min_generation or
+                self._evicted.get(row['toshi_id'], -1) > generation):
+            return
+        self.rows.set(row['toshi_id'], row)
+        if row['username'] is not None:
+            self.usernames.set(row['username'].lower(), row['toshi_id'])
+
+    def evict(self, toshi_id):
+        self.rows.invalidate(toshi_id)
+        self._generation += 1
+        self._evicted[toshi_id] = self._generation
+        self._evicted.move_to_end(toshi_id)
+        # only remember as many evictions as there are cache entries,
+        # anything older than the forgotten evictions is dropped instead
+        while len(self._evicted) > max(self._max_size, 1):
+            _, generation = self._evicted.popitem(last=False)
+            self._min_generation = generation
+
+    def clear(self):
+        self.rows.clear()
+        self.usernames.clear()
+        self._generation += 1
+        self._evicted.clear()
+        self._min_generation = self._generation
+
+    def stats(self):
+        return {
+            'rows': self.rows.stats(),
+            'usernames': self.usernames.stats()
+        }
+
+class UserCacheMixin:
+
+    @property
+    def user_cache(self):
+        cache = getattr(self.application, 'user_cache', None)
+        if cache is None:
+            cache = self.application.user_cache = UserCache(
+                config['general'].getint('user_cache_size', 0),
+                config['general'].getint('user_cache_ttl', 0))
+            # evict entries changed by other processes
+            listener = getattr(self.application, 'invalidation_listener', None)
+            if listener is not None:
+                listener.subscribe(cache.evict, cache.clear)
+        return cache
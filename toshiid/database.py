@@ -0,0 +1,93 @@
+from tornado.ioloop import IOLoop
+
+from toshi.database import get_database_pool
+
+class RequestDatabaseContext:
+    """Drop in replacement for `DatabaseMixin.db` that keeps hold of a
+    single connection for the whole request.
+
+    The connection is acquired the first time the context is entered and
+    reused by every following `async with`, so handlers that use the
+    database at several points only wait on the pool once. Each `async with`
+    block still runs in its own transaction, which is rolled back if it
+    wasn't committed, so no transaction is left open while the handler is
+    doing other work (e.g. uploading files)."""
+
+    def __init__(self):
+        self.connection = None
+        self.transaction = None
+        self._entered = False
+        self._release_pending = False
+
+    async def __aenter__(self):
+        if self._entered:
+            raise Exception("Cannot nest database contexts")
+        if self.connection is None:
+            self.connection = await get_database_pool().acquire()
+        self.transaction = self.connection.transaction()
+        await self.transaction.start()
+        self._entered = True
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._entered = False
+        transaction, self.transaction = self.transaction, None
+        if transaction is not None:
+            await transaction.rollback()
+        if self._release_pending:
+            await self.release()
+
+    async def commit(self):
+        # any statements after this in the same block are autocommitted
+        transaction, self.transaction = self.transaction, None
+        await transaction.commit()
+
+    async def execute(self, *args, **kwargs):
+        return await self.connection.execute(*args, **kwargs)
+
+    async def executemany(self, *args, **kwargs):
+        return await self.connection.executemany(*args, **kwargs)
+
+    async def fetch(self, *args, **kwargs):
+        return await self.connection.fetch(*args, **kwargs)
+
+    async def fetchrow(self, *args, **kwargs):
+        return await self.connection.fetchrow(*args, **kwargs)
+
+    async def fetchval(self, *args, **kwargs):
+        return await self.connection.fetchval(*args, **kwargs)
+
+    async def release(self):
+        """Returns the connection to the pool. Safe to call more than once,
+        and while a block is running, in which case the connection is
+        released once the block exits"""
+        if self._entered:
+            self._release_pending = True
+            return
+        self._release_pending = False
+        connection, self.connection = self.connection, None
+        if connection is not None:
+            await get_database_pool().release(connection)
+
+class RequestDatabaseMixin:
+    """Overrides `DatabaseMixin.db` with a `RequestDatabaseContext`, must be
+    listed before `DatabaseMixin`"""
+
+    @property
+    def db(self):
+        if not hasattr(self, '_request_db'):
+            self._request_db = RequestDatabaseContext()
+        return self._request_db
+
+    def _release_db(self):
+        if hasattr(self, '_request_db'):
+            IOLoop.current().add_callback(self._request_db.release)
+
+    def on_finish(self):
+        super().on_finish()
+        self._release_db()
+
+    def on_connection_close(self):
+        # on_finish isn't guaranteed to be called if the client goes away
+        super().on_connection_close()
+        self._release_db()
@@ -1,17 +1,14 @@
 # -*- coding: utf-8 -*-
-import asyncio
 import asyncpg
 import regex
 import os
 import io
-import blockies
 import random
-import itertools
 import string
 import datetime
 import hashlib
-import binascii
-import tornado.httpclient
+import ctypes
+import ctypes.util
 
 from toshi.database import DatabaseMixin
 from toshi.boto import BotoMixin
@@ -22,13 +19,23 @@ from decimal import Decimal
 from toshi.handlers import (BaseHandler,
                             RequestVerificationMixin,
                             SimpleFileHandler)
-from toshi.analytics import AnalyticsMixin, encode_id as analytics_encode_id
-from tornado.web import HTTPError
+from toshi.analytics import encode_id as analytics_encode_id
+from tornado.web import HTTPError, stream_request_body
 from toshi.utils import validate_address, validate_decimal_string, validate_int_string, parse_int
 from PIL import Image, ExifTags
 from PIL.JpegImagePlugin import get_sampling
 
-from toshiid.handlers_v2 import user_row_for_json as user_row_for_json_v2
+from toshiid.cache import UserCacheMixin
+from toshiid.serialization import UserJSONMixin
+from toshiid.database import RequestDatabaseMixin
+from toshiid.jobs import enqueue_jobs
+from toshiid.migration import get_migration_notifier
+from toshiid.analytics import BufferedAnalyticsMixin
+from toshiid.avatar_store import AvatarStoreMixin, AVATAR_COLUMNS
+from toshiid.image_workers import ImageWorkersBusy
+from toshiid.uploads import StreamingUploadMixin, max_image_pixels, image_too_large_error
+from toshiid.identicon import (Identicon, IdenticonCacheMixin, identicon_cache_only,
+                               IDENTICON_LAST_MODIFIED, IDENTICON_CACHE_CONTROL)
 
 assert ExifTags.TAGS[0x0112] == "Orientation"
 EXIF_ORIENTATION = 0x0112
@@ -37,10 +44,32 @@ EXIF_ORIENTATION = 0x0112
 PUNCTUATION = string.punctuation.replace('_', '')
 
 MIN_AUTOID_LENGTH = 5
+# generated usernames are allocated by trying a batch of candidates with
+# a few different lengths in a single statement
+USERNAME_CANDIDATE_LENGTHS = 4
+USERNAME_CANDIDATES_PER_LENGTH = 4
+USERNAME_ALLOCATION_ATTEMPTS = 3
 
 AVATAR_URL_HASH_LENGTH = 6
-
-httpCli = tornado.httpclient.AsyncHTTPClient(max_clients=100)
+# the sizes avatars are stored in, the largest is the size of the original
+AVATAR_SIZES = [64, 128, 256, 512]
+# the extensions of the avatars uploaded to s3
+AVATAR_EXTENSIONS = {'JPEG': 'jpg', 'PNG': 'png', 'WEBP': 'webp', 'AVIF': 'avif'}
+# formats avatars are also stored in, when supported by PIL, and served in to
+# clients that accept them
+Image.init()
+ALTERNATIVE_AVATAR_FORMATS = [format for format in ['WEBP', 'AVIF'] if format in Image.SAVE]
+
+
+# resolves the tags and names of the categories in `users.category_ids`,
+# keeping the same order as the ids. Expects the language as $1
+USER_CATEGORIES_SQL = (
+    "ARRAY(SELECT categories.tag FROM unnest(users.category_ids) WITH ORDINALITY AS c (category_id, ordering) "
+    "LEFT JOIN categories ON categories.category_id = c.category_id "
+    "ORDER BY c.ordering) AS category_tags, "
+    "ARRAY(SELECT category_names.name FROM unnest(users.category_ids) WITH ORDINALITY AS c (category_id, ordering) "
+    "LEFT JOIN category_names ON category_names.category_id = c.category_id AND category_names.language = $1 "
+    "ORDER BY c.ordering) AS category_names")
 
 def generate_username(autoid_length):
     """Generate usernames postfixed with a random ID which is a concatenation
@@ -105,6 +134,15 @@ def user_row_for_json(request, row):
         rval['custom']['location'] = rval['location']
     return rval
 
+def user_row_etag(row, api_version):
+    """ETag for a user's profile response. `updated` changes with every
+    update to the user's row, the reputation fields are included as well
+    as they are the values most frequently updated by other services."""
+    key = "{}:{}:{}:{}:{}:{}".format(
+        api_version, row['toshi_id'], row['updated'],
+        row['reputation_score'], row['review_count'], row['average_rating'])
+    return '"{}"'.format(hashlib.md5(key.encode('utf-8')).hexdigest())
+
 def parse_boolean(b):
     if isinstance(b, bool):
         return b
@@ -120,15 +158,105 @@ def parse_boolean(b):
         return bool(b)
     return None
 
-def process_image(data, mime_type):
-    stream = io.BytesIO(data)
+class InvalidImageError(Exception):
+    """Raised by `process_image`, which can run in another process, in place
+    of a JSONHTTPError"""
+    pass
+
+class ImageTooLargeError(InvalidImageError):
+    pass
+
+def process_memory(field):
+    """Returns a memory field (e.g. VmRSS) of the current process's status
+    in bytes, or None where it isn't available"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+try:
+    malloc_trim = ctypes.CDLL(ctypes.util.find_library('c')).malloc_trim
+except (OSError, AttributeError):
+    # only glibc has malloc_trim
+    malloc_trim = None
+
+def reset_peak_rss():
+    """Resets the current process's peak RSS (VmHWM) to its current RSS,
+    returning False where that isn't supported (only linux 4.0+ is)"""
+    # memory freed by earlier tasks is returned to the os first, otherwise
+    # it's reused without raising the RSS and the task looks smaller
+    if malloc_trim is not None:
+        malloc_trim(0)
     try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        return False
+    return True
+
+def image_memory(img):
+    """Returns the approximate memory used by the image's pixels"""
+    # PIL pads 3 band images to 4 bytes per pixel
+    if img.mode in ('1', 'L', 'P'):
+        bytes_per_pixel = 1
+    elif img.mode.startswith('I;16'):
+        bytes_per_pixel = 2
+    else:
+        bytes_per_pixel = 4
+    return img.size[0] * img.size[1] * bytes_per_pixel
+
+def process_image(data, mime_type, max_pixels=None, measure_memory=False):
+    """Returns the (images, format, alternatives, stats) of the avatar,
+    where stats has the image's original and decoded sizes and an estimate
+    of the peak memory used by decoded pixels while processing it.
+
+    With `measure_memory` the process's peak RSS is reset first, and the
+    peak while processing the image and how far it was above the RSS at
+    the start are included as `peak_rss` and `peak_rss_increase`, where
+    supported. This only measures the image if nothing else runs in the
+    process at the same time, as in an image worker process."""
+
+    rss_before = None
+    if measure_memory and reset_peak_rss():
+        rss_before = process_memory('VmRSS')
+    # data can also be a file object, e.g. a spooled upload
+    stream = io.BytesIO(data) if isinstance(data, bytes) else data
+    try:
+        # only reads the image's headers, the pixels are decoded on first use
         img = Image.open(stream)
     except OSError:
-        raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Invalid image data'}]})
+        raise InvalidImageError('Invalid image data')
+
+    if max_pixels is not None and img.size[0] * img.size[1] > max_pixels:
+        raise ImageTooLargeError('Image too large')
+    stats = {'width': img.size[0], 'height': img.size[1]}
 
     if mime_type == 'image/jpeg' and img.format == 'JPEG':
         format = "JPEG"
+    elif mime_type == 'image/png' and img.format == 'PNG':
+        format = "PNG"
+    else:
+        raise InvalidImageError('Unsupported image format')
+
+    max_size = AVATAR_SIZES[-1]
+    if format == 'JPEG':
+        # have the decoder scale the image down by up to 8x while decoding,
+        # to the smallest scale that's still at least as big as the largest
+        # avatar, rather than decoding it at full size and resizing after
+        img.draft(img.mode, (max_size, max_size))
+
+    try:
+        img.load()
+    except OSError:
+        raise InvalidImageError('Invalid image data')
+    stats['decoded_width'], stats['decoded_height'] = img.size
+    decoded_memory = pixel_memory = image_memory(img)
+
+    if format == 'JPEG':
         subsampling = 'keep'
         # check exif information for orientation
         if hasattr(img, '_getexif'):
@@ -157,55 +285,129 @@ def process_image(data, mime_type):
                 elif orientation == 8:
                     # Rotation 90°
                     img = img.transpose(Image.ROTATE_90)
+                # each transpose makes a copy while the previous one is held
+                pixel_memory = decoded_memory * 2
         save_kwargs = {'subsampling': subsampling, 'quality': 85}
-    elif mime_type == 'image/png' and img.format == 'PNG':
-        format = "PNG"
-        save_kwargs = {'icc_profile': img.info.get("icc_profile")}
     else:
-        raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Unsupported image format'}]})
-
-    if img.size[0] > 512 or img.size[1] > 512:
-        img.thumbnail((512, 512))
+        save_kwargs = {'icc_profile': img.info.get("icc_profile")}
 
+    if img.size[0] > max_size or img.size[1] > max_size:
+        img.thumbnail((max_size, max_size))
+        pixel_memory = max(pixel_memory, decoded_memory + image_memory(img))
+    stats['estimated_pixel_memory'] = pixel_memory
+
+    images = [encode_image(img, format, save_kwargs)]
+    alternatives = encode_alternative_formats(img, format, images[0])
+
+    # the smaller sizes are made from the already decoded image
+    if save_kwargs.get('subsampling') == 'keep':
+        # 'keep' only works when saving the image that was loaded
+        save_kwargs = dict(save_kwargs, subsampling=get_sampling(img))
+    for size in reversed(AVATAR_SIZES[:-1]):
+        if max(img.size) <= size:
+            continue
+        resized = img.copy()
+        resized.thumbnail((size, size))
+        images.append(encode_image(resized, format, save_kwargs))
+        alternatives.extend(encode_alternative_formats(resized, format, images[-1]))
+
+    peak_rss = process_memory('VmHWM') if rss_before is not None else None
+    if peak_rss is not None:
+        stats['peak_rss'] = peak_rss
+        stats['peak_rss_increase'] = peak_rss - rss_before
+    return images, format, alternatives, stats
+
+def encode_alternative_formats(img, format, encoded):
+    """Encodes the image in each of `ALTERNATIVE_AVATAR_FORMATS`, returning
+    the (format, size, data, hash) of those that are smaller than `encoded`"""
+    if img.mode not in ('RGB', 'RGBA'):
+        img = img.convert('RGBA' if 'transparency' in img.info or img.mode.endswith('A') else 'RGB')
+    # keep png avatars lossless
+    save_kwargs = {'lossless': True} if format == 'PNG' else {'quality': 80}
+    alternatives = []
+    for alternative_format in ALTERNATIVE_AVATAR_FORMATS:
+        size, data, cache_hash = encode_image(img, alternative_format, save_kwargs)
+        if len(data) < len(encoded[1]):
+            alternatives.append((alternative_format, size, data, cache_hash))
+    return alternatives
+
+def nearest_avatar_size(rows, size):
+    """Returns the smallest avatar in `rows` that is at least `size`, or the
+    largest if none are big enough or `size` is None"""
+    # avatars with no size are originals stored before sizes were recorded
+    by_size = sorted(rows, key=lambda row: row['size'] or AVATAR_SIZES[-1])
+    if size is not None:
+        for row in by_size:
+            if (row['size'] or AVATAR_SIZES[-1]) >= size:
+                return row
+    return by_size[-1]
+
+def choose_avatar(rows, format, size, accepted):
+    """Returns the hash of the avatar to serve from `rows`, which are all the
+    variants of a single avatar. The size is picked from the variants in
+    `format`, then the smallest of that size in `format` or one of the
+    `accepted` formats is used"""
+    chosen = nearest_avatar_size([row for row in rows if row['format'] == format], size)
+    for row in rows:
+        if row['format'] in accepted and row['size'] == chosen['size'] and \
+           row['length'] is not None and (chosen['length'] is None or row['length'] < chosen['length']):
+            chosen = row
+    return chosen['hash']
+
+def accepted_avatar_formats(accept):
+    """Returns the alternative avatar formats listed in the given Accept header"""
+    if not accept:
+        return set()
+    accepted = set()
+    for media_range in accept.split(','):
+        params = [param.strip() for param in media_range.split(';')]
+        quality = 1
+        for param in params[1:]:
+            if param.startswith('q='):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0
+        # wildcards aren't counted, as clients that don't support newer
+        # formats send them too
+        if quality > 0 and params[0].lower().startswith('image/'):
+            format = params[0][6:].upper()
+            if format in ALTERNATIVE_AVATAR_FORMATS:
+                accepted.add(format)
+    return accepted
+
+def encode_image(img, format, save_kwargs):
+    """Returns the (size, data, hash) of the encoded image"""
     stream = io.BytesIO()
-    img.save(stream, format=format, optimize=True, **save_kwargs)
+    if format in ('PNG', 'JPEG'):
+        save_kwargs = dict(save_kwargs, optimize=True)
+    img.save(stream, format=format, **save_kwargs)
 
     data = stream.getbuffer().tobytes()
     hasher = hashlib.md5()
     hasher.update(data)
     cache_hash = hasher.hexdigest()
 
-    return data, cache_hash, format
-
-def create_identitcon(address, format='PNG'):
-    if format == 'JPG':
-        format = 'JPEG'
-    return blockies.create(address, size=8, scale=12, format=format.upper())
+    return max(img.size), data, cache_hash
 
+def identicon_key(address):
+    return "public/identicon/{}.png".format(address)
 
 def request_to_migrate(address):
-    data = { "toshiId": address }
-    url = os.getenv('WALLET_URL', None)
-    username = os.getenv('WALLET_BASIC_AUTH_USERNAME')
-    password = os.getenv('WALLET_BASIC_AUTH_PASSWORD')
+    notifier = get_migration_notifier()
+    if notifier is not None:
+        notifier.notify(address)
 
-    try:
-        httpCli.fetch(
-            url,
-            method="POST",
-            headers={
-                "Content-Type": "application/json",
-                "Authorization":'Basic %s' % (
-                binascii.b2a_base64(
-                    ('%s:%s' % (username, password)).encode('ascii')
-                ).decode('ascii').strip())
-            },
-            body=tornado.escape.json_encode(data)
-        )
-    except Exception as e:
-        log.warning("Error in request_to_migrate. toshi_id: {} \"{}\"".format(address, str(e)))
-
-class UserMixin(BotoMixin, RequestVerificationMixin, AnalyticsMixin):
+class UserJSONV1Mixin(UserJSONMixin):
+
+    def user_json_v1(self, row):
+        # v1 json contains absolute urls, and only includes categories if
+        # they were part of the query
+        variant = (1, self.request.protocol, self.request.host,
+                   'category_names' in row and 'category_ids' in row)
+        return self.cached_user_json(row, variant, lambda row: user_row_for_json(self.request, row))
+
+class UserMixin(UserCacheMixin, UserJSONV1Mixin, BotoMixin, RequestVerificationMixin, BufferedAnalyticsMixin):
 
     def is_superuser(self, toshi_id):
         return 'superusers' in config and \
@@ -213,9 +415,9 @@ class UserMixin(BotoMixin, RequestVerificationMixin, AnalyticsMixin):
 
     def write_user_data(self, user):
         if self.api_version == 1:
-            self.write(user_row_for_json(self.request, user))
+            self.write_json(self.user_json_v1(user))
         elif self.api_version == 2:
-            self.write(user_row_for_json_v2(user))
+            self.write_json(self.user_json_v2(user))
         else:
             raise Exception("Unknown api version")
 
@@ -251,8 +453,11 @@ class UserMixin(BotoMixin, RequestVerificationMixin, AnalyticsMixin):
             if user is None:
                 raise JSONHTTPError(404, body={'errors': [{'id': 'not_found', 'message': 'Not Found'}]})
 
-            categories = await self.db.fetch("SELECT category_id FROM bot_categories WHERE toshi_id = $1 ORDER BY category_id", toshi_id)
-            categories = [row['category_id'] for row in categories]
+            categories = list(user['category_ids'])
+
+            # validate the whole payload before applying any of the changes
+            # so that all the changed columns can be set in a single update
+            updates = []
 
             if 'username' in payload and user['username'] != payload['username']:
                 username = payload['username']
@@ -266,13 +471,13 @@ class UserMixin(BotoMixin, RequestVerificationMixin, AnalyticsMixin):
                     if row is not None:
                         raise JSONHTTPError(400, body={'errors': [{'id': 'username_taken', 'message': 'Username Taken'}]})
 
-                await self.db.execute("UPDATE users SET username = $1 WHERE toshi_id = $2", username, toshi_id)
+                updates.append(('username', username))
 
             if 'payment_address' in payload and payload['payment_address'] != user['payment_address']:
                 payment_address = payload['payment_address']
                 if payment_address is not None and not validate_address(payment_address):
                     raise JSONHTTPError(400, body={'errors': [{'id': 'invalid_payment_address', 'message': 'Invalid Payment Address'}]})
-                await self.db.execute("UPDATE users SET payment_address = $1 WHERE toshi_id = $2", payment_address, toshi_id)
+                updates.append(('payment_address', payment_address))
 
             if is_bot_key in payload and payload[is_bot_key] != user['is_bot']:
                 is_bot = parse_boolean(payload[is_bot_key])
@@ -280,11 +485,13 @@ class UserMixin(BotoMixin, RequestVerificationMixin, AnalyticsMixin):
                     raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Bad Arguments'}]})
                 if config['general'].getboolean('apps_public_by_default') and 'public' not in payload:
                     payload['public'] = is_bot
-                await self.db.execute("UPDATE users SET is_bot = $1 WHERE toshi_id = $2", is_bot, toshi_id)
+                updates.append(('is_bot', is_bot))
 
+            updated_categories = None
             if 'categories' in payload and payload['categories'] != categories:
+                # lock the categories so they can't be deleted before they're added
                 updated_categories = await self.db.fetch(
-                    "SELECT category_id, tag FROM categories WHERE category_id = ANY($1) OR tag = ANY($2)",
+                    "SELECT category_id, tag FROM categories WHERE category_id = ANY($1) OR tag = ANY($2) FOR KEY SHARE",
                     [c for c in payload['categories'] if isinstance(c, int)],
                     [c for c in payload['categories'] if isinstance(c, str)])
                 if len(updated_categories) != len(payload['categories']):
@@ -298,56 +505,70 @@ class UserMixin(BotoMixin, RequestVerificationMixin, AnalyticsMixin):
                         'message': "Invalid Categor{}: {}".format(
                             'ies' if len(payload['categories']) > 1 else 'y',
                             ", ".join([str(c) for c in payload['categories']]))}})
-                updated_categories = [c['category_id'] for c in updated_categories]
-                removed = set(categories).difference(set(updated_categories))
-                added = set(updated_categories).difference(set(categories))
-                for category_id in removed:
-                    await self.db.execute("DELETE FROM bot_categories WHERE category_id = $1 AND toshi_id = $2", category_id, toshi_id)
-                for category_id in added:
-                    try:
-                        await self.db.execute("INSERT INTO bot_categories VALUES ($1, $2) ON CONFLICT DO NOTHING",
-                                              category_id, toshi_id)
-                    except asyncpg.exceptions.ForeignKeyViolationError:
-                        raise JSONHTTPError(400, body={'errors': {'id': 'bad_arguments', 'message': "Invalid Category ID: {}".format(category_id)}})
+                updated_categories = sorted(c['category_id'] for c in updated_categories)
+                # set here as well as by the bot_categories trigger so the
+                # trigger doesn't need to create extra versions of the row
+                updates.append(('category_ids', updated_categories))
 
             if 'public' in payload and payload['public'] != user['is_public']:
                 is_public = parse_boolean(payload['public'])
                 if not isinstance(is_public, bool):
                     raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Bad Arguments'}]})
-                await self.db.execute("UPDATE users SET is_public = $1, went_public = $2 WHERE toshi_id = $3",
-                                      is_public, datetime.datetime.utcnow() if is_public else None, toshi_id)
+                updates.append(('is_public', is_public))
+                updates.append(('went_public', datetime.datetime.utcnow() if is_public else None))
 
             if 'name' in payload and payload['name'] != user['name']:
                 name = payload['name']
                 if not isinstance(name, str):
                     raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Invalid Name'}]})
-                await self.db.execute("UPDATE users SET name = $1 WHERE toshi_id = $2", name, toshi_id)
+                updates.append(('name', name))
 
             if 'avatar' in payload and payload['avatar'] != user['avatar']:
                 avatar = payload['avatar']
                 if not isinstance(avatar, str):
                     raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Invalid Avatar'}]})
-                await self.db.execute("UPDATE users SET avatar = $1 WHERE toshi_id = $2", avatar, toshi_id)
+                updates.append(('avatar', avatar))
 
             if description_key in payload and payload[description_key] != user['description']:
                 description = payload[description_key]
                 if not isinstance(description, str):
                     raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Invalid {}'.format(description_key.capitalize())}]})
-                await self.db.execute("UPDATE users SET description = $1 WHERE toshi_id = $2", description, toshi_id)
+                updates.append(('description', description))
 
             if 'location' in payload and payload['location'] != user['location']:
                 location = payload['location']
                 if not isinstance(location, str):
                     raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Invalid Location'}]})
-                await self.db.execute("UPDATE users SET location = $1 WHERE toshi_id = $2", location, toshi_id)
+                updates.append(('location', location))
 
             if user['active'] is False:
                 # mark users as active if their data has been accessed
-                await self.db.execute("UPDATE users SET active = true WHERE toshi_id = $1", toshi_id)
+                updates.append(('active', True))
+
+            if updates:
+                sql = "UPDATE users SET {} WHERE toshi_id = $1 RETURNING *".format(
+                    ", ".join("{} = ${}".format(column, idx + 2) for idx, (column, _) in enumerate(updates)))
+                try:
+                    user = await self.db.fetchrow(sql, toshi_id, *(value for _, value in updates))
+                except asyncpg.exceptions.UniqueViolationError:
+                    # the username was taken since it was checked above
+                    raise JSONHTTPError(400, body={'errors': [{'id': 'username_taken', 'message': 'Username Taken'}]})
+
+            if updated_categories is not None:
+                await self.db.execute("DELETE FROM bot_categories WHERE toshi_id = $1 AND category_id <> ALL($2::INTEGER[])",
+                                      toshi_id, updated_categories)
+                try:
+                    await self.db.execute("INSERT INTO bot_categories (category_id, toshi_id) "
+                                          "SELECT unnest($1::INTEGER[]), $2 ON CONFLICT DO NOTHING",
+                                          updated_categories, toshi_id)
+                except asyncpg.exceptions.ForeignKeyViolationError:
+                    # shouldn't happen as the categories are locked above, but just in case
+                    raise JSONHTTPError(400, body={'errors': {'id': 'bad_arguments', 'message': "Invalid Category ID: {}".format(
+                        ", ".join(str(c) for c in updated_categories))}})
 
-            user = await self.db.fetchrow("SELECT * FROM users WHERE toshi_id = $1", toshi_id)
             await self.db.commit()
 
+        self.user_cache.evict(toshi_id)
         self.write_user_data(user)
         self.track(toshi_id, "Edited profile")
 
@@ -370,24 +591,73 @@ class UserMixin(BotoMixin, RequestVerificationMixin, AnalyticsMixin):
         data = file[0]['body']
         mime_type = file[0]['content_type']
 
-        data, cache_hash, format = await self.run_in_executor(process_image, data, mime_type)
-
-        boto_key = "public/avatar/{}_{}.{}".format(toshi_id, cache_hash[:AVATAR_URL_HASH_LENGTH], 'jpg' if format == 'JPEG' else 'png')
+        image_workers = getattr(self.application, 'image_workers', None)
+        try:
+            if image_workers is not None:
+                # file objects can't be sent to other processes, so the image
+                # has to be read into memory to be sent to the worker
+                images, format, alternatives, stats = await image_workers.run(
+                    process_image, data.read(), mime_type, max_image_pixels(), True)
+            else:
+                images, format, alternatives, stats = await self.run_in_executor(
+                    process_image, data, mime_type, max_image_pixels())
+        except ImageTooLargeError:
+            raise image_too_large_error(max_image_pixels())
+        except InvalidImageError as e:
+            raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': str(e)}]})
+        except ImageWorkersBusy:
+            # written directly as send_error would clear the Retry-After header
+            self.set_status(503)
+            self.set_header("Retry-After", str(image_workers.retry_after))
+            self.write({'errors': [{'id': 'service_busy', 'message': 'Too many avatar uploads, try again later'}]})
+            return
+        message = "Processed {}x{} avatar for {}, decoded at {}x{} using an estimated {:.1f}MB for pixels".format(
+            stats['width'], stats['height'], toshi_id, stats['decoded_width'], stats['decoded_height'],
+            stats['estimated_pixel_memory'] / 1024 / 1024)
+        if 'peak_rss' in stats:
+            message += ", worker peak RSS {:.1f}MB (+{:.1f}MB)".format(
+                stats['peak_rss'] / 1024 / 1024, stats['peak_rss_increase'] / 1024 / 1024)
+        log.info(message)
+        original_size, data, cache_hash = images[0]
+
+        # every size and format is uploaded to s3, with only its metadata
+        # recorded in the avatars table so /avatar/ can redirect to the one
+        # closest to what's requested
+        avatar_rows = []
         async with self.boto:
+            # the smaller sizes and other formats are stored next to the
+            # original, which is uploaded last so the avatar url never points
+            # at an upload that's still in progress
+            for image_format, size, image_data, image_hash in [(format, *image) for image in images[1:]] + alternatives:
+                key = "public/avatar/{}_{}{}.{}".format(
+                    toshi_id, cache_hash[:AVATAR_URL_HASH_LENGTH], "" if size == original_size else "_{}".format(size),
+                    AVATAR_EXTENSIONS[image_format])
+                await self.boto.put_object(key=key, body=image_data)
+                avatar_rows.append((toshi_id, image_hash, image_format, size, cache_hash, len(image_data),
+                                    self.boto.url_for_object(key)))
+            boto_key = "public/avatar/{}_{}.{}".format(toshi_id, cache_hash[:AVATAR_URL_HASH_LENGTH], AVATAR_EXTENSIONS[format])
             await self.boto.put_object(key=boto_key, body=data)
             avatar_url = self.boto.url_for_object(boto_key)
+        avatar_rows.append((toshi_id, cache_hash, format, original_size, None, len(data), avatar_url))
 
         async with self.db:
+            await self.db.executemany("INSERT INTO avatars (toshi_id, hash, format, size, source_hash, length, url) "
+                                      "VALUES ($1, $2, $3, $4, $5, $6, $7) "
+                                      "ON CONFLICT (toshi_id, hash) DO UPDATE "
+                                      "SET last_modified = (now() AT TIME ZONE 'utc'), url = EXCLUDED.url",
+                                      avatar_rows)
             await self.db.execute("UPDATE users SET avatar = $1 WHERE toshi_id = $2", avatar_url, toshi_id)
             user = await self.db.fetchrow("SELECT * FROM users WHERE toshi_id = $1", toshi_id)
             await self.db.commit()
 
+        self.user_cache.evict(toshi_id)
         self.write_user_data(user)
 
         self.track(toshi_id, "Updated avatar")
 
 
-class UserCreationHandler(UserMixin, DatabaseMixin, BaseHandler):
+@stream_request_body
+class UserCreationHandler(StreamingUploadMixin, RequestDatabaseMixin, UserMixin, DatabaseMixin, BaseHandler):
 
     def __init__(self, *args, api_version=1, **kwargs):
         super().__init__(*args, **kwargs)
@@ -395,6 +665,7 @@ class UserCreationHandler(UserMixin, DatabaseMixin, BaseHandler):
 
     async def post(self):
 
+        self.finish_request_body()
         toshi_id = self.verify_request()
         payload = self.json
 
@@ -428,13 +699,8 @@ class UserCreationHandler(UserMixin, DatabaseMixin, BaseHandler):
 
         else:
 
-            # generate temporary username
-            for i in itertools.count():
-                username = generate_username(MIN_AUTOID_LENGTH + i)
-                async with self.db:
-                    row = await self.db.fetchrow("SELECT * FROM users WHERE lower(username) = lower($1)", username)
-                if row is None:
-                    break
+            # a temporary username is allocated when the user is inserted
+            username = None
 
         if 'payment_address' in payload:
             payment_address = payload['payment_address']
@@ -492,29 +758,65 @@ class UserCreationHandler(UserMixin, DatabaseMixin, BaseHandler):
         else:
             location = None
 
+        # the identicon is uploaded by the job queue after the user is created
         identicon_address = payment_address or toshi_id
-        identicon_data = await self.run_in_executor(create_identitcon, identicon_address)
-        key = "public/identicon/{}.png".format(identicon_address)
-        async with self.boto:
-            await self.boto.put_object(key=key, body=identicon_data)
-            if avatar is None:
-                avatar = self.boto.url_for_object(key)
+        if avatar is None:
+            async with self.boto:
+                avatar = self.boto.url_for_object(identicon_key(identicon_address))
 
         async with self.db:
-            await self.db.execute("INSERT INTO users "
-                                  "(username, toshi_id, payment_address, name, avatar, is_bot, description, location, is_public) "
-                                  "VALUES "
-                                  "($1, $2, $3, $4, $5, $6, $7, $8, $9)",
-                                  username, toshi_id, payment_address, name, avatar, is_bot, description, location, is_public)
-            user = await self.db.fetchrow("SELECT * FROM users WHERE toshi_id = $1", toshi_id)
+            try:
+                if username is not None:
+                    user = await self.db.fetchrow("INSERT INTO users "
+                                                  "(username, toshi_id, payment_address, name, avatar, is_bot, description, location, is_public) "
+                                                  "VALUES "
+                                                  "($1, $2, $3, $4, $5, $6, $7, $8, $9) "
+                                                  "RETURNING *",
+                                                  username, toshi_id, payment_address, name, avatar, is_bot, description, location, is_public)
+                else:
+                    user = await self.insert_user_with_generated_username(
+                        toshi_id, payment_address, name, avatar, is_bot, description, location, is_public)
+            except asyncpg.exceptions.UniqueViolationError as e:
+                if e.constraint_name == 'users_pkey':
+                    raise JSONHTTPError(400, body={'errors': [{'id': 'already_registered', 'message': 'The provided toshi id address is already registered'}]})
+                raise JSONHTTPError(400, body={'errors': [{'id': 'username_taken', 'message': 'Username Taken'}]})
+            await enqueue_jobs(self.db, [
+                ('upload_identicon', {'address': identicon_address}),
+                ('analytics', {'toshi_id': toshi_id, 'event': "Created account",
+                               'people': {"distinct_id": analytics_encode_id(toshi_id)}}),
+                ('request_to_migrate', {'toshi_id': toshi_id})
+            ])
             await self.db.commit()
 
+        self.user_cache.evict(toshi_id)
         self.write_user_data(user)
-        self.people_set(toshi_id, {"distinct_id": analytics_encode_id(toshi_id)})
-        self.track(toshi_id, "Created account")
-        request_to_migrate(toshi_id)
+
+    async def insert_user_with_generated_username(self, toshi_id, *values):
+        """Inserts the user with the shortest free username out of a batch of
+        generated candidates of increasing lengths. Conflicts with usernames
+        taken concurrently are skipped, and only if every candidate is taken
+        is a new batch of longer candidates tried."""
+
+        for attempt in range(USERNAME_ALLOCATION_ATTEMPTS):
+            candidates = [generate_username(MIN_AUTOID_LENGTH + attempt * USERNAME_CANDIDATE_LENGTHS + i // USERNAME_CANDIDATES_PER_LENGTH)
+                          for i in range(USERNAME_CANDIDATE_LENGTHS * USERNAME_CANDIDATES_PER_LENGTH)]
+            user = await self.db.fetchrow(
+                "INSERT INTO users "
+                "(username, toshi_id, payment_address, name, avatar, is_bot, description, location, is_public) "
+                "SELECT c.username, $2, $3, $4, $5, $6, $7, $8, $9 "
+                "FROM unnest($1::VARCHAR[]) WITH ORDINALITY AS c (username, ordering) "
+                "WHERE NOT EXISTS (SELECT 1 FROM users WHERE lower(users.username) = lower(c.username)) "
+                "ORDER BY c.ordering LIMIT 1 "
+                "ON CONFLICT ((lower(username))) DO NOTHING "
+                "RETURNING *",
+                candidates, toshi_id, *values)
+            if user is not None:
+                return user
+
+        raise Exception("Unable to allocate a username for {}".format(toshi_id))
 
     def put(self):
+        self.finish_request_body()
         toshi_id = self.verify_request()
 
         if not self.request.headers['Content-Type'].startswith('application/json') and not self.request.files:
@@ -535,7 +837,8 @@ class UserCreationHandler(UserMixin, DatabaseMixin, BaseHandler):
         else:
             return self.update_user(toshi_id)
 
-class UserHandler(UserMixin, DatabaseMixin, BaseHandler):
+@stream_request_body
+class UserHandler(StreamingUploadMixin, RequestDatabaseMixin, UserMixin, DatabaseMixin, BaseHandler):
 
     def __init__(self, *args, apps_only=None, api_version=1, **kwargs):
         super().__init__(*args, **kwargs)
@@ -544,45 +847,77 @@ class UserHandler(UserMixin, DatabaseMixin, BaseHandler):
 
     async def get(self, username):
 
-        sql = ("SELECT users.*, array_agg(bot_categories.category_id) AS category_ids, "
-               "array_agg(categories.tag) AS category_tags, "
-               "array_agg(category_names.name) AS category_names "
-               "FROM users LEFT JOIN bot_categories "
-               "ON users.toshi_id = bot_categories.toshi_id "
-               "LEFT JOIN category_names ON bot_categories.category_id = category_names.category_id "
-               "AND category_names.language = $1 "
-               "LEFT JOIN categories ON bot_categories.category_id = categories.category_id "
-               "WHERE ")
-        args = ['en']
+        is_address = regex.match('^0x[a-fA-F0-9]{40}$', username)
+        if is_address:
+            row = self.user_cache.get_by_toshi_id(username)
+        else:
+            row = self.user_cache.get_by_username(username)
+        if row is not None:
+            if self.apps_only and (not row['is_bot'] or row['blocked']):
+                raise JSONHTTPError(404, body={'errors': [{'id': 'not_found', 'message': 'Not Found'}]})
+            if not self.check_user_etag(row):
+                self.write_user_data(row)
+            return
+
+        where = []
+        args = []
 
         # check if ethereum address is given
-        if regex.match('^0x[a-fA-F0-9]{40}$', username):
-            sql += "users.toshi_id = $2"
+        if is_address:
+            where.append("users.toshi_id = ${}")
             args.append(username)
 
         # otherwise verify that username is valid
         elif not regex.match('^[a-zA-Z][a-zA-Z0-9_]{2,59}$', username):
             raise JSONHTTPError(400, body={'errors': [{'id': 'invalid_username', 'message': 'Invalid Username'}]})
         else:
-            sql += "lower(users.username) = lower($2)"
+            where.append("lower(users.username) = lower(${})")
             args.append(username)
 
         if self.apps_only:
-            sql += " AND users.is_bot = $3 AND users.blocked = $4"
+            where.extend(["users.is_bot = ${}", "users.blocked = ${}"])
             args.extend([True, False])
 
-        sql += " GROUP BY users.toshi_id"
+        def where_sql(offset):
+            return " AND ".join(w.format(i + offset + 1) for i, w in enumerate(where))
 
+        # taken before querying so the row isn't cached if the user
+        # changes while the query is running
+        generation = self.user_cache.generation()
         async with self.db:
-            row = await self.db.fetchrow(sql, *args)
+            # if the client already has a copy, check if it's still valid
+            # before running the full query
+            if self.request.headers.get("If-None-Match"):
+                row = await self.db.fetchrow(
+                    "SELECT toshi_id, updated, reputation_score, review_count, average_rating "
+                    "FROM users WHERE {}".format(where_sql(0)), *args)
+                if row is not None and self.check_user_etag(row):
+                    return
+
+            row = await self.db.fetchrow(
+                "SELECT users.*, {} FROM users WHERE {}".format(USER_CATEGORIES_SQL, where_sql(1)),
+                'en', *args)
 
         if row is None:
             raise JSONHTTPError(404, body={'errors': [{'id': 'not_found', 'message': 'Not Found'}]})
 
-        self.write_user_data(row)
+        self.user_cache.put(row, generation)
+        if not self.check_user_etag(row):
+            self.write_user_data(row)
+
+    def check_user_etag(self, row):
+        """Sets the Etag header for the given user's profile, returning
+        True (with a 304 status) if it matches the client's copy"""
+        self.set_header("Etag", user_row_etag(row, self.api_version))
+        if self.check_etag_header():
+            self.set_status(304)
+            return True
+        return False
 
     async def put(self, username):
 
+        self.finish_request_body()
+
         if regex.match('^0x[a-fA-F0-9]{40}$', username):
 
             address_to_update = username
@@ -619,7 +954,7 @@ class UserHandler(UserMixin, DatabaseMixin, BaseHandler):
             return await self.update_user(address_to_update)
 
 
-class SearchUserHandler(AnalyticsMixin, DatabaseMixin, BaseHandler):
+class SearchUserHandler(UserJSONV1Mixin, BufferedAnalyticsMixin, DatabaseMixin, BaseHandler):
 
     def __init__(self, *args, force_featured=None, force_apps=None, **kwargs):
         super().__init__(*args, **kwargs)
@@ -695,54 +1030,48 @@ class SearchUserHandler(AnalyticsMixin, DatabaseMixin, BaseHandler):
             check_connected = False
 
         if query is None:
-            sql = ("SELECT users.*, array_agg(bot_categories.category_id) AS category_ids, "
-                   "array_agg(categories.tag) AS category_tags, "
-                   "array_agg(category_names.name) AS category_names "
-                   "FROM users LEFT JOIN bot_categories "
-                   "ON users.toshi_id = bot_categories.toshi_id "
-                   "LEFT JOIN category_names ON bot_categories.category_id = category_names.category_id "
-                   "AND category_names.language = $1 "
-                   "LEFT JOIN categories ON bot_categories.category_id = categories.category_id ")
+            sql = "SELECT users.*, {} FROM users ".format(USER_CATEGORIES_SQL)
             sql_args = ['en']
+            where_q = []
             if check_connected:
-                sql += "INNER JOIN websocket_sessions ON users.toshi_id = websocket_sessions.toshi_id "
+                where_q.append("EXISTS (SELECT 1 FROM websocket_sessions WHERE websocket_sessions.toshi_id = users.toshi_id)")
             if payment_address:
-                sql += "WHERE active = true AND payment_address = ${} ".format(len(sql_args) + 1)
+                where_q.append("active = true AND payment_address = ${}".format(len(sql_args) + 1))
                 sql_args.append(payment_address)
                 if apps is not None:
-                    sql += "AND is_bot = ${} AND blocked = false ".format(len(sql_args) + 1)
+                    where_q.append("is_bot = ${} AND blocked = false".format(len(sql_args) + 1))
                     sql_args.append(apps)
                     if featured is not None:
-                        sql += "AND featured = ${} ".format(len(sql_args) + 1)
+                        where_q.append("featured = ${}".format(len(sql_args) + 1))
                         sql_args.append(featured)
-                sql += "GROUP BY users.toshi_id "
                 if apps is not None and len(categories) > 0:
-                    sql += "HAVING array_agg(bot_categories.category_id) @> ${} ".format(len(sql_args) + 1)
+                    where_q.append("category_ids @> ${}".format(len(sql_args) + 1))
                     sql_args.append(categories)
+                sql += "WHERE {} ".format(" AND ".join(where_q))
                 if recent:
                     sql += "ORDER BY payment_address, created DESC, name, username "
                 else:
                     sql += "ORDER BY payment_address, name, username "
             else:
                 if apps is not None:
-                    sql += "WHERE is_bot = ${} AND blocked = false ".format(len(sql_args) + 1)
+                    where_q.append("is_bot = ${} AND blocked = false".format(len(sql_args) + 1))
                     sql_args.append(apps)
                     if featured is not None:
-                        sql += "AND featured = ${} ".format(len(sql_args) + 1)
+                        where_q.append("featured = ${}".format(len(sql_args) + 1))
                         sql_args.append(featured)
                     if public is not None:
-                        sql += "AND is_public = ${} ".format(len(sql_args) + 1)
+                        where_q.append("is_public = ${}".format(len(sql_args) + 1))
                         sql_args.append(public)
                 elif public is not None:
-                    sql += "WHERE is_public = ${} ".format(len(sql_args) + 1)
+                    where_q.append("is_public = ${}".format(len(sql_args) + 1))
                     sql_args.append(public)
                     if apps is None or apps is False:
-                        sql += "AND is_bot = FALSE "
-                sql += "AND active = true "
-                sql += "GROUP BY users.toshi_id "
+                        where_q.append("is_bot = FALSE")
+                where_q.append("active = true")
                 if apps is not None and len(categories) > 0:
-                    sql += "HAVING array_agg(bot_categories.category_id) @> ${} ".format(len(sql_args) + 1)
+                    where_q.append("category_ids @> ${}".format(len(sql_args) + 1))
                     sql_args.append(categories)
+                sql += "WHERE {} ".format(" AND ".join(where_q))
                 sql += "ORDER BY "
                 if top:
                     if recent:
@@ -780,9 +1109,8 @@ class SearchUserHandler(AnalyticsMixin, DatabaseMixin, BaseHandler):
                 where_q.append("blocked = ${}".format(len(sql_args) + 1))
                 sql_args.append(False)
                 if len(categories) > 0:
-                    for category in categories:
-                        where_q.append("bot_categories.category_id = ${}".format(len(sql_args) + 1))
-                        sql_args.append(category)
+                    where_q.append("category_ids @> ${}".format(len(sql_args) + 1))
+                    sql_args.append(categories)
                 if public is not None:
                     where_q.append("is_public = ${}".format(len(sql_args) + 1))
                     sql_args.append(public)
@@ -794,25 +1122,13 @@ class SearchUserHandler(AnalyticsMixin, DatabaseMixin, BaseHandler):
                 where_q.append("is_public = ${}".format(len(sql_args) + 1))
                 sql_args.append(public)
             where_q.append("active = true")
+            if check_connected:
+                where_q.append("EXISTS (SELECT 1 FROM websocket_sessions WHERE websocket_sessions.toshi_id = users.toshi_id)")
             where_q = " AND {}".format(" AND ".join(where_q)) if where_q else ""
             sql = ("SELECT * FROM "
-                   "(SELECT users.*, array_agg(bot_categories.category_id) AS category_ids, "
-                   "array_agg(categories.tag) AS category_tags, "
-                   "array_agg(category_names.name) AS category_names "
-                   "FROM users {}"
-                   "LEFT JOIN bot_categories ON users.toshi_id = bot_categories.toshi_id "
-                   "LEFT JOIN category_names ON bot_categories.category_id = category_names.category_id "
-                   "AND category_names.language = $1 "
-                   "LEFT JOIN categories ON bot_categories.category_id = categories.category_id "
-                   ", TO_TSQUERY($4) AS q "
-                   "WHERE (tsv @@ q){} "
-                   "GROUP BY users.toshi_id ").format(
-                       "INNER JOIN websocket_sessions ON users.toshi_id = websocket_sessions.toshi_id "
-                       if check_connected else "",
-                       where_q)
-            if apps is not None and len(categories) > 0:
-                sql += "HAVING array_agg(bot_categories.category_id) @> ${} ".format(len(sql_args) + 1)
-                sql_args.append(categories)
+                   "(SELECT users.*, {} "
+                   "FROM users, TO_TSQUERY($4) AS q "
+                   "WHERE (tsv @@ q){} ").format(USER_CATEGORIES_SQL, where_q)
             sql += ") AS t1 "
             sql += "ORDER BY TS_RANK_CD(t1.tsv, TO_TSQUERY($4)) DESC, "
             if top:
@@ -834,7 +1150,7 @@ class SearchUserHandler(AnalyticsMixin, DatabaseMixin, BaseHandler):
 
         async with self.db:
             rows = await self.db.fetch(sql, *sql_args)
-        results = [user_row_for_json(self.request, row) for row in rows]
+        results = [self.user_json_v1(row) for row in rows]
         querystring = 'query={}'.format(query if query else '')
         if apps is not None:
             querystring += '&apps={}'.format('true' if apps else 'false')
@@ -849,7 +1165,7 @@ class SearchUserHandler(AnalyticsMixin, DatabaseMixin, BaseHandler):
         for category in categories:
             querystring += '&category={}'.format(category)
 
-        self.write({
+        self.write_json({
             'query': querystring,
             'offset': offset,
             'limit': limit,
@@ -869,29 +1185,22 @@ class SearchUserHandler(AnalyticsMixin, DatabaseMixin, BaseHandler):
 
     async def list_users(self, toshi_ids):
 
-        sql = "SELECT u.* FROM users u JOIN (VALUES "
-        values = []
-        for i, toshi_id in enumerate(toshi_ids):
+        for toshi_id in toshi_ids:
             if not validate_address(toshi_id):
                 raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Bad Arguments'}]})
-            values.append("('{}', {}) ".format(toshi_id, i))
-            # in case this request is made with a lot of ids
-            # make sure we yield to other processes rather
-            # than taking up all resources on this
-            if i > 0 and i % 100 == 0:
-                await asyncio.sleep(0.001)
-        sql += ", ".join(values)
-        sql += ") AS v (toshi_id, ordering) ON u.toshi_id = v.toshi_id "
-        sql += "ORDER BY v.ordering"
 
         async with self.db:
-            rows = await self.db.fetch(sql)
-
-        self.write({
-            'results': [user_row_for_json(self.request, row) for row in rows]
+            rows = await self.db.fetch(
+                "SELECT u.* FROM unnest($1::VARCHAR[]) WITH ORDINALITY AS v (toshi_id, ordering) "
+                "JOIN users u ON u.toshi_id = v.toshi_id "
+                "ORDER BY v.ordering",
+                toshi_ids)
+
+        self.write_json({
+            'results': [self.user_json_v1(row) for row in rows]
         })
 
-class SearchDappHandler(AnalyticsMixin, DatabaseMixin, BaseHandler):
+class SearchDappHandler(BufferedAnalyticsMixin, DatabaseMixin, BaseHandler):
 
     async def get(self):
 
@@ -903,11 +1212,12 @@ class SearchDappHandler(AnalyticsMixin, DatabaseMixin, BaseHandler):
         })
 
 
-class IdenticonHandler(DatabaseMixin, SimpleFileHandler):
+class IdenticonHandler(IdenticonCacheMixin, AvatarStoreMixin, DatabaseMixin, SimpleFileHandler):
 
     FORMAT_MAP = {
         'PNG': 'image/png',
-        'JPEG': 'image/jpeg'
+        'JPEG': 'image/jpeg',
+        'SVG': 'image/svg+xml'
     }
 
     def head(self, address, format):
@@ -921,31 +1231,63 @@ class IdenticonHandler(DatabaseMixin, SimpleFileHandler):
         if format not in self.FORMAT_MAP.keys():
             raise HTTPError(404)
 
-        identicon_pkey = "{}_identicon_{}".format(address, format)
-        async with self.db:
-            # add suffix to id for cached identicons
-            row = await self.db.fetchrow("SELECT * FROM avatars WHERE toshi_id = $1", identicon_pkey)
-
-        if row is None:
-            data = blockies.create(address, size=8, scale=12, format=format.upper())
-            hasher = hashlib.md5()
-            hasher.update(data)
-            cache_hash = hasher.hexdigest()
+        # svg identicons are cheap enough to render that they're never stored
+        if identicon_cache_only() or format == 'SVG':
+            identicon = await self.identicon_cache.get(address, format)
+            # the hash is the md5 of the image, which is the same wherever
+            # the identicon is rendered
+            identicon = Identicon(identicon.data, identicon.hash, IDENTICON_LAST_MODIFIED)
+            self.set_header("Cache-Control", IDENTICON_CACHE_CONTROL)
+            await self.handle_file_response(identicon.data, self.FORMAT_MAP[format], identicon.hash,
+                                            identicon.last_modified)
+            return
+
+        identicon = await self.identicon_cache.lookup(address, format)
+
+        if identicon is None:
+            identicon_pkey = "{}_identicon_{}".format(address, format)
             async with self.db:
-                await self.db.execute("INSERT INTO avatars (toshi_id, img, hash, format) VALUES ($1, $2, $3, $4) "
-                                      "ON CONFLICT (toshi_id, hash) DO UPDATE "
-                                      "SET img = EXCLUDED.img, format = EXCLUDED.format, last_modified = (now() AT TIME ZONE 'utc')",
-                                      identicon_pkey, data, cache_hash, format)
-                await self.db.commit()
-            last_modified = datetime.datetime.utcnow()
-        else:
-            data = row['img']
-            cache_hash = row['hash']
-            last_modified = row['last_modified']
+                # add suffix to id for cached identicons
+                row = await self.db.fetchrow("SELECT * FROM avatars WHERE toshi_id = $1", identicon_pkey)
 
-        await self.handle_file_response(data, self.FORMAT_MAP[format], cache_hash, last_modified)
+            data = None
+            broken = False
+            if row is not None:
+                data = row['img']
+                if data is None:
+                    try:
+                        with self.avatar_store.open(row['hash'], format) as stored:
+                            # identicons are small, so read them into the cache
+                            data = stored[:]
+                    except FileNotFoundError:
+                        pass
+                    except ValueError:
+                        # raised when mapping an empty file
+                        broken = True
+                    # the hash is the md5 of the image, so truncated files
+                    # can be detected too
+                    if data is not None and hashlib.md5(data).hexdigest() != row['hash']:
+                        data = None
+                        broken = True
+                    if broken:
+                        log.warning("Stored identicon {} for {} is broken, rendering it again".format(row['hash'], address))
+
+            if data is None:
+                identicon = await self.identicon_cache.render(address, format)
+                img = await self.avatar_store.put(identicon.hash, format, identicon.data, overwrite=broken)
+                async with self.db:
+                    await self.db.execute("INSERT INTO avatars (toshi_id, img, hash, format) VALUES ($1, $2, $3, $4) "
+                                          "ON CONFLICT (toshi_id, hash) DO UPDATE "
+                                          "SET img = EXCLUDED.img, format = EXCLUDED.format, last_modified = (now() AT TIME ZONE 'utc')",
+                                          identicon_pkey, img, identicon.hash, format)
+                    await self.db.commit()
+            else:
+                identicon = Identicon(data, row['hash'], row['last_modified'])
+                self.identicon_cache.put(address, format, identicon)
+
+        await self.handle_file_response(identicon.data, self.FORMAT_MAP[format], identicon.hash, identicon.last_modified)
 
-class AvatarHandler(DatabaseMixin, SimpleFileHandler):
+class AvatarHandler(AvatarStoreMixin, DatabaseMixin, SimpleFileHandler):
 
     def head(self, address, hash, format):
         return self.get(address, hash, format, include_body=False)
@@ -958,24 +1300,51 @@ class AvatarHandler(DatabaseMixin, SimpleFileHandler):
         if format == 'JPG':
             format = 'JPEG'
 
+        size = self.get_query_argument('size', None)
+        if size is not None:
+            size = parse_int(size)
+            if size is None or size <= 0:
+                raise HTTPError(400)
+
+        if hash is None:
+            where = "toshi_id = $1 AND format = $2 AND source_hash IS NULL"
+            args = [address, format]
+        else:
+            where = "toshi_id = $1 AND format = $2 AND source_hash IS NULL AND substring(hash for {}) = $3".format(
+                AVATAR_URL_HASH_LENGTH)
+            args = [address, format, hash]
+
+        accepted = accepted_avatar_formats(self.request.headers.get('Accept'))
+        # the avatar returned depends on the accept header
+        self.set_header("Vary", "Accept")
+
         async with self.db:
-            if hash is None:
-                row = await self.db.fetchrow("SELECT * FROM avatars WHERE toshi_id = $1 AND format = $2 ORDER BY last_modified DESC",
-                                             address, format)
+            if size is None and not accepted:
+                row = await self.db.fetchrow("SELECT {} FROM avatars WHERE {} ORDER BY last_modified DESC"
+                                             .format(AVATAR_COLUMNS, where),
+                                             *args)
             else:
-                row = await self.db.fetchrow(
-                    "SELECT * FROM avatars WHERE toshi_id = $1 AND format = $2 AND substring(hash for {}) = $3"
-                    .format(AVATAR_URL_HASH_LENGTH),
-                    address, format, hash)
-
-        if row is None or row['format'] != format:
+                # find the sizes and formats available for the avatar without loading any images
+                variants = await self.db.fetch("WITH original AS (SELECT hash FROM avatars WHERE {} "
+                                               "ORDER BY last_modified DESC LIMIT 1) "
+                                               "SELECT a.hash, a.format, a.size, a.source_hash, a.length "
+                                               "FROM avatars a, original o "
+                                               "WHERE a.toshi_id = $1 AND (a.hash = o.hash OR a.source_hash = o.hash)"
+                                               .format(where),
+                                               *args)
+                row = None
+                if variants:
+                    row = await self.db.fetchrow("SELECT {} FROM avatars WHERE toshi_id = $1 AND hash = $2"
+                                                 .format(AVATAR_COLUMNS),
+                                                 address, choose_avatar(variants, format, size, accepted))
+
+        if row is None or (row['format'] != format and row['format'] not in accepted):
             raise HTTPError(404)
 
-        await self.handle_file_response(row['img'], "image/{}".format(format.lower()),
-                                        row['hash'], row['last_modified'])
+        await self.handle_avatar_response(row, "image/{}".format(row['format'].lower()), include_body)
 
 
-class ReportHandler(RequestVerificationMixin, AnalyticsMixin, DatabaseMixin, BaseHandler):
+class ReportHandler(RequestVerificationMixin, BufferedAnalyticsMixin, DatabaseMixin, BaseHandler):
 
     async def post(self):
 
@@ -1024,7 +1393,7 @@ class CategoryHandler(DatabaseMixin, BaseHandler):
             ]
         })
 
-class ReputationUpdateHandler(RequestVerificationMixin, AnalyticsMixin, DatabaseMixin, BaseHandler):
+class ReputationUpdateHandler(UserCacheMixin, RequestVerificationMixin, BufferedAnalyticsMixin, DatabaseMixin, BaseHandler):
 
     async def post(self):
 
@@ -1068,4 +1437,5 @@ class ReputationUpdateHandler(RequestVerificationMixin, AnalyticsMixin, Database
                                   score, count, rating, toshi_id)
             await self.db.commit()
 
+        self.user_cache.evict(toshi_id)
         self.set_status(204)
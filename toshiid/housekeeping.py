@@ -1,22 +1,78 @@
 import asyncio
 
 import logging
+from mixpanel import Mixpanel
+from toshi.analytics import encode_id
+from toshi.boto import BotoMixin
 from toshi.log import configure_logger
 from toshi.database import prepare_database, get_database_pool
 from toshi.config import config
+from toshiid.handlers_v1 import identicon_key
+from toshiid.identicon import create_identicon_cache, delete_stored_identicons, identicon_cache_only, \
+    IDENTICON_CLEANUP_BATCH_SIZE
+from toshiid.migration import get_migration_notifier
+from toshiid.jobs import JobWorker
 
 DEFAULT_DELAY = 30
+DEFAULT_JOB_DELAY = 1
 
 log = logging.getLogger("toshiid.housekeeping")
 if 'database' in config:
-    config['database']['max_size'] = '1'
+    # one connection for housekeeping and one for the job worker
+    config['database']['max_size'] = '2'
     config['database']['min_size'] = '1'
 
+class SignupJobs(BotoMixin):
+    """Side effects of creating a user, run from the job queue"""
+
+    def __init__(self):
+        self.identicon_cache = create_identicon_cache()
+        if 'mixpanel' in config and 'token' in config['mixpanel']:
+            self.mixpanel = Mixpanel(config['mixpanel']['token'])
+        else:
+            self.mixpanel = None
+
+    def handlers(self):
+        return {
+            'upload_identicon': self.upload_identicon,
+            'analytics': self.analytics,
+            'request_to_migrate': self.request_to_migrate
+        }
+
+    async def upload_identicon(self, address):
+        identicon = await self.identicon_cache.get(address, 'PNG')
+        async with self.boto:
+            await self.boto.put_object(key=identicon_key(address), body=identicon.data)
+
+    async def analytics(self, toshi_id, event, people=None):
+        if self.mixpanel is None:
+            return
+        distinct_id = encode_id(toshi_id)
+        loop = asyncio.get_event_loop()
+        # the mixpanel client is blocking
+        if people:
+            await loop.run_in_executor(None, self.mixpanel.people_set, distinct_id, people)
+        await loop.run_in_executor(None, self.mixpanel.track, distinct_id, event)
+
+    async def request_to_migrate(self, toshi_id):
+        # retries are handled by the job queue
+        notifier = get_migration_notifier()
+        if notifier is not None:
+            await notifier.send([toshi_id])
+
 class HousekeepingApplication:
 
-    def __init__(self, *, delay=DEFAULT_DELAY):
+    def __init__(self, *, delay=DEFAULT_DELAY, job_delay=DEFAULT_JOB_DELAY, cleanup_identicons=None):
         self._schedule = None
         self._delay = delay
+        # identicons are no longer stored when they're served from the cache,
+        # so remove the ones stored before that was turned on
+        if cleanup_identicons is None:
+            cleanup_identicons = identicon_cache_only()
+        self._cleanup_identicons = cleanup_identicons
+        self._job_schedule = None
+        self._job_delay = job_delay
+        self.job_worker = JobWorker(SignupJobs().handlers())
 
         configure_logger(log)
 
@@ -26,10 +82,13 @@ class HousekeepingApplication:
     async def _start(self):
         await prepare_database()
         self._schedule = asyncio.get_event_loop().call_soon(self.run_housekeeping)
+        self._job_schedule = asyncio.get_event_loop().call_soon(self.run_jobs)
 
     def shutdown(self):
         if self._schedule:
             self._schedule.cancel()
+        if self._job_schedule:
+            self._job_schedule.cancel()
 
     def run(self):
         self.start()
@@ -48,7 +107,35 @@ class HousekeepingApplication:
         if rval != "DELETE 0":
             log.info("Housekeeping cleaned up {} stale sessions".format(rval[7:]))
 
+        if self._cleanup_identicons:
+            await self.cleanup_identicons()
+
         self.schedule_housekeeping()
 
+    async def cleanup_identicons(self):
+        # one small batch per run, so the cleanup never holds long locks on
+        # avatars or delays the rest of housekeeping
+        async with get_database_pool().acquire() as con:
+            count = await delete_stored_identicons(con, IDENTICON_CLEANUP_BATCH_SIZE)
+        if count > 0:
+            log.info("Housekeeping cleaned up {} stored identicons".format(count))
+        else:
+            # nothing new is stored, so there's no need to keep checking
+            self._cleanup_identicons = False
+
+    def run_jobs(self):
+        asyncio.get_event_loop().create_task(self.do_jobs())
+
+    async def do_jobs(self):
+        try:
+            count = await self.job_worker.run_pending()
+            if count > 0:
+                log.info("Ran {} jobs".format(count))
+        except Exception:
+            log.exception("Error running jobs")
+        self._job_schedule = asyncio.get_event_loop().call_later(self._job_delay, self.run_jobs)
+
 if __name__ == '__main__':
+    from toshiid.app import update_config
+    update_config()
     HousekeepingApplication().run()
@@ -0,0 +1,340 @@
+import asyncio
+import datetime
+import hashlib
+import math
+import os
+import tempfile
+from collections import OrderedDict, defaultdict, namedtuple
+from functools import lru_cache
+from io import BytesIO
+
+import numpy as np
+from PIL import Image, ImageColor
+
+from toshi.config import config
+
+IDENTICON_SIZE = 8
+IDENTICON_SCALE = 12
+# identicons never change, so when they're not stored in the database they're
+# served with a fixed last modified time and can be cached forever
+IDENTICON_LAST_MODIFIED = datetime.datetime(2017, 1, 1)
+IDENTICON_CACHE_CONTROL = "public, max-age=31536000, immutable"
+IDENTICON_CLEANUP_BATCH_SIZE = 1000
+
+Identicon = namedtuple('Identicon', ['data', 'hash', 'last_modified'])
+
+def _int32(values):
+    return ((values + 0x80000000) & 0xFFFFFFFF) - 0x80000000
+
+class _BatchRandom:
+    """The xorshift generator used by `blockies`, run over a batch of seeds
+    at once. Values are kept in int64 arrays and wrapped to int32 where
+    blockies wraps them, so the output matches it exactly."""
+
+    def __init__(self, seeds):
+        chars = np.array([[ord(c) for c in seed] for seed in seeds], dtype=np.int64).reshape(len(seeds), -1)
+        self.randseed = np.zeros((len(seeds), 4), dtype=np.int64)
+        for i in range(chars.shape[1]):
+            seed = self.randseed[:, i % 4]
+            self.randseed[:, i % 4] = _int32(_int32(seed << 5) - seed + chars[:, i])
+
+    def rand(self):
+        t = _int32(self.randseed[:, 0] ^ (self.randseed[:, 0] << 11))
+        last = self.randseed[:, 3]
+        value = last ^ (last >> 19) ^ t ^ (t >> 8)
+        self.randseed = np.concatenate([self.randseed[:, 1:], value[:, None]], axis=1)
+        return (value & 0xFFFFFFFF) / float(1 << 31)
+
+@lru_cache(maxsize=None)
+def _hsl_to_rgb(h, s, l):
+    try:
+        return ImageColor.getrgb("hsl({},{}%,{}%)".format(h, s, l))
+    except Exception:
+        return (0, 0, 0)
+
+def _create_colors(random):
+    h = np.floor(random.rand() * 360)
+    s = random.rand() * 60 + 40
+    # summed in the same order as blockies to get identical rounding
+    l = (((random.rand() + random.rand()) + random.rand()) + random.rand()) * 25
+    return [_hsl_to_rgb(int(h), int(round(s)), int(round(l))) for h, s, l in zip(h, s, l)]
+
+def _render_cells(seeds, size):
+    """Returns a (len(seeds), size, size) array of the identicons' cells,
+    where 0 is the background, 1 is the color and 2 is the spot color, and
+    the (background, color, spot color) for each identicon"""
+
+    random = _BatchRandom(seeds)
+    color = _create_colors(random)
+    bgcolor = _create_colors(random)
+    spotcolor = _create_colors(random)
+
+    data_width = math.ceil(size / 2)
+    mirror_width = size - data_width
+    rows = []
+    for _ in range(size):
+        row = [np.floor(random.rand() * 2.3).astype(np.int64) for _ in range(data_width)]
+        rows.append(np.stack(row + row[:mirror_width][::-1], axis=1))
+    cells = np.minimum(np.stack(rows, axis=1), 2).astype(np.uint8)
+    return cells, list(zip(bgcolor, color, spotcolor))
+
+def _render_pixels(seeds, size, scale):
+    """Returns a (len(seeds), size * scale, size * scale, 3) array of the
+    identicons' pixels"""
+
+    cells, palettes = _render_cells(seeds, size)
+
+    # blockies draws each cell as an inclusive rectangle, so a cell also
+    # covers the first row and column of pixels of the cells after it. The
+    # last non background cell drawn over a pixel sets its color. Rows and
+    # columns are split into segments: the first pixel of each cell (after
+    # the first) and the rest of the cell, which are colored separately and
+    # then repeated out to the full image size.
+    cell = np.repeat(np.arange(size), 2)[1:]
+    edge = np.arange(len(cell)) % 2 == 1
+    previous = np.where(edge, cell - 1, cell)
+    repeats = np.where(edge, 1, scale - 1)
+    repeats[0] = scale
+    row, col, prev_row, prev_col = cell[:, None], cell[None, :], previous[:, None], previous[None, :]
+    col_edge, row_edge = edge[None, :], edge[:, None]
+
+    values = cells[:, row, col]
+    for covering, mask in [(cells[:, row, prev_col], col_edge),
+                           (cells[:, prev_row, col], row_edge),
+                           (cells[:, prev_row, prev_col], row_edge & col_edge)]:
+        values = np.where((values == 0) & mask, covering, values)
+
+    palette = np.array(palettes, dtype=np.uint8)
+    pixels = palette[np.arange(len(seeds))[:, None, None], values]
+    return np.repeat(np.repeat(pixels, repeats, axis=1), repeats, axis=2)
+
+SVG_TEMPLATE = ('<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{width}" '
+                'viewBox="0 0 {size} {size}" shape-rendering="crispEdges">'
+                '<rect width="{size}" height="{size}" fill="{bgcolor}"/>{paths}</svg>')
+SVG_PATH_TEMPLATE = '<path fill="{color}" d="{path}"/>'
+
+def _svg_color(rgb):
+    return "#{:02x}{:02x}{:02x}".format(*rgb)
+
+def _svg_path(cells, value):
+    # one subpath per horizontal run of cells with the given value
+    path = []
+    for y, row in enumerate(cells.tolist()):
+        x = 0
+        while x < len(row):
+            if row[x] != value:
+                x += 1
+                continue
+            start = x
+            while x < len(row) and row[x] == value:
+                x += 1
+            path.append("M{} {}h{}v1h-{}z".format(start, y, x - start, x - start))
+    return "".join(path)
+
+def _render_svg(cells, palette):
+    paths = []
+    for value in (1, 2):
+        path = _svg_path(cells, value)
+        if path:
+            paths.append(SVG_PATH_TEMPLATE.format(color=_svg_color(palette[value]), path=path))
+    return SVG_TEMPLATE.format(width=IDENTICON_SIZE * IDENTICON_SCALE, size=IDENTICON_SIZE,
+                               bgcolor=_svg_color(palette[0]), paths="".join(paths)).encode('utf-8')
+
+def _batch_by_length(addresses, render):
+    """Calls `render` with batches of addresses of the same length (as seeds
+    are processed a character at a time), returning the results in the same
+    order as `addresses`"""
+    results = [None] * len(addresses)
+    by_length = defaultdict(list)
+    for i, address in enumerate(addresses):
+        by_length[len(address)].append(i)
+    for indexes in by_length.values():
+        for i, result in zip(indexes, render([addresses[i] for i in indexes])):
+            results[i] = result
+    return results
+
+def _render_svgs(addresses):
+    cells, palettes = _render_cells(addresses, IDENTICON_SIZE)
+    return [_render_svg(identicon_cells, palette) for identicon_cells, palette in zip(cells, palettes)]
+
+def _render_images(addresses):
+    pixels = _render_pixels(addresses, IDENTICON_SIZE, IDENTICON_SCALE)
+    return [Image.fromarray(image, 'RGB') for image in pixels]
+
+def render_identicon_images(addresses):
+    """Renders the identicons for a batch of addresses as PIL images"""
+    return _batch_by_length(addresses, _render_images)
+
+def render_identicons(addresses, format='PNG'):
+    """Renders the identicons for a batch of addresses, returning the encoded
+    images in the same order. For PNG and JPEG the output is byte for byte
+    the same as `blockies.create(address, size=8, scale=12, format=format)`.
+    SVG identicons contain the same pattern of cells, without the one pixel
+    overlap blockies draws between them."""
+
+    if format == 'SVG':
+        return _batch_by_length(addresses, _render_svgs)
+    results = []
+    for image in render_identicon_images(addresses):
+        stream = BytesIO()
+        image.save(stream, format=format, optimize=True)
+        results.append(stream.getvalue())
+    return results
+
+def render_identicon(address, format='PNG'):
+    return render_identicons([address], format)[0]
+
+def identicon_from_data(data, last_modified=None):
+    return Identicon(data, hashlib.md5(data).hexdigest(), last_modified or datetime.datetime.utcnow())
+
+class IdenticonCache:
+    """Caches rendered identicons by (address, format).
+
+    Identicons are kept in memory up to `max_bytes`, and optionally written
+    to `directory` where they are stored by the hash of their key. As
+    identicons are deterministic entries never need to be invalidated."""
+
+    def __init__(self, max_bytes, directory=None):
+        self._max_bytes = max_bytes
+        self._directory = directory
+        self._entries = OrderedDict()
+        self._size = 0
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.renders = 0
+
+    def _path(self, address, format):
+        name = hashlib.sha256("{}:{}".format(address, format).encode('utf-8')).hexdigest()
+        return os.path.join(self._directory, name[:2], "{}.{}".format(name, format.lower()))
+
+    def _get_memory(self, address, format):
+        key = (address, format)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def _put_memory(self, address, format, entry):
+        if len(entry.data) > self._max_bytes:
+            return
+        key = (address, format)
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self._size -= len(previous.data)
+        self._entries[key] = entry
+        self._size += len(entry.data)
+        while self._size > self._max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= len(evicted.data)
+
+    def _read_disk(self, address, format):
+        if self._directory is None:
+            return None
+        path = self._path(address, format)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            last_modified = datetime.datetime.utcfromtimestamp(os.path.getmtime(path))
+        except FileNotFoundError:
+            return None
+        return identicon_from_data(data, last_modified)
+
+    def _write_disk(self, address, format, data):
+        if self._directory is None:
+            return
+        path = self._path(address, format)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file first so readers never see partial files
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _render(self, address, format):
+        self.renders += 1
+        data = render_identicon(address, format)
+        self._write_disk(address, format, data)
+        return identicon_from_data(data)
+
+    def render_many(self, addresses, format):
+        """Renders and stores the identicons for `addresses` which aren't
+        already stored on disk, returning the number rendered"""
+        missing = [address for address in addresses
+                   if self._directory is None or not os.path.exists(self._path(address, format))]
+        for address, data in zip(missing, render_identicons(missing, format)):
+            self.renders += 1
+            self._write_disk(address, format, data)
+            self._put_memory(address, format, identicon_from_data(data))
+        return len(missing)
+
+    async def lookup(self, address, format):
+        """Returns the cached identicon, or None if it's not cached"""
+        entry = self._get_memory(address, format)
+        if entry is not None:
+            self.hits += 1
+            return entry
+        if self._directory is not None:
+            entry = await asyncio.get_event_loop().run_in_executor(None, self._read_disk, address, format)
+            if entry is not None:
+                self.disk_hits += 1
+                self._put_memory(address, format, entry)
+                return entry
+        self.misses += 1
+        return None
+
+    async def get(self, address, format):
+        """Returns the identicon, rendering it if it's not cached"""
+        entry = await self.lookup(address, format)
+        if entry is None:
+            entry = await self.render(address, format)
+        return entry
+
+    async def render(self, address, format):
+        """Renders and caches the identicon, for use once `lookup` has
+        missed, so the miss isn't counted again"""
+        entry = await asyncio.get_event_loop().run_in_executor(None, self._render, address, format)
+        self._put_memory(address, format, entry)
+        return entry
+
+    def put(self, address, format, identicon):
+        self._put_memory(address, format, identicon)
+
+    def stats(self):
+        return {
+            'size': self._size,
+            'max_bytes': self._max_bytes,
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'renders': self.renders
+        }
+
+def identicon_cache_only():
+    """True if identicons should only be served from the render cache rather
+    than being stored in the avatars table"""
+    return 'general' in config and config['general'].getboolean('identicon_cache_only', False)
+
+async def delete_stored_identicons(con, batch_size=IDENTICON_CLEANUP_BATCH_SIZE):
+    """Deletes up to `batch_size` identicons stored in the avatars table,
+    returning the number deleted"""
+    # matches the predicate of idx_avatars_identicons so the index is used
+    rval = await con.execute("DELETE FROM avatars WHERE (toshi_id, hash) IN ("
+                             "SELECT toshi_id, hash FROM avatars WHERE toshi_id LIKE '%\\_identicon\\_%' LIMIT $1)",
+                             batch_size)
+    return int(rval.split()[-1])
+
+def create_identicon_cache():
+    return IdenticonCache(config['general'].getint('identicon_cache_size', 0),
+                          config['general'].get('identicon_cache_dir', None) or None)
+
+class IdenticonCacheMixin:
+
+    @property
+    def identicon_cache(self):
+        cache = getattr(self.application, 'identicon_cache', None)
+        if cache is None:
+            cache = self.application.identicon_cache = create_identicon_cache()
+        return cache
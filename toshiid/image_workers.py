@@ -0,0 +1,118 @@
+import asyncio
+import concurrent.futures
+import time
+
+from concurrent.futures.process import BrokenProcessPool
+
+from toshi.log import log
+
+DEFAULT_QUEUE_SIZE = 16
+DEFAULT_TASKS_PER_PROCESS = 1
+DEFAULT_RETRY_AFTER = 5
+
+class ImageWorkersBusy(Exception):
+    pass
+
+def _timed_call(fn, *args):
+    # runs in the worker process, so the time doesn't include waiting to be
+    # picked up or sending the result back
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+class ImageWorkerPool:
+    """Runs image processing in a pool of worker processes, so decoding and
+    encoding images doesn't compete with the event loop for the GIL.
+
+    At most `tasks_per_process` tasks are sent to each process at a time.
+    Up to `max_queue_size` more can wait for a free process, after which
+    `run` raises `ImageWorkersBusy` immediately.
+
+    If a worker process dies (e.g. killed for using too much memory) the
+    whole pool is broken, so it's shut down and a new one is started for
+    the next task."""
+
+    def __init__(self, processes, *, max_queue_size=DEFAULT_QUEUE_SIZE,
+                 tasks_per_process=DEFAULT_TASKS_PER_PROCESS, retry_after=DEFAULT_RETRY_AFTER):
+        self._processes = processes
+        self._max_queue_size = max_queue_size
+        self._slots = asyncio.Semaphore(processes * tasks_per_process)
+        self._executor = None
+        self._waiting = 0
+        self.retry_after = retry_after
+
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.restarts = 0
+        self.queue_time = 0.0
+        self.max_queue_time = 0.0
+        self.run_time = 0.0
+        self.max_run_time = 0.0
+
+    @property
+    def queue_depth(self):
+        return self._waiting
+
+    async def run(self, fn, *args):
+        """Runs `fn(*args)` in a worker process, returning its result"""
+
+        if self._slots.locked() and self._waiting >= self._max_queue_size:
+            self.rejected += 1
+            raise ImageWorkersBusy()
+
+        queued_at = time.perf_counter()
+        self._waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self._waiting -= 1
+        try:
+            queue_time = time.perf_counter() - queued_at
+            self.queue_time += queue_time
+            self.max_queue_time = max(self.max_queue_time, queue_time)
+
+            if self._executor is None:
+                self._executor = concurrent.futures.ProcessPoolExecutor(self._processes)
+            executor = self._executor
+            try:
+                result, run_time = await asyncio.wrap_future(executor.submit(_timed_call, fn, *args))
+            except BrokenProcessPool:
+                self.failed += 1
+                # other tasks running in the same pool fail too, only the
+                # first to notice replaces it
+                if self._executor is executor:
+                    log.error("Image worker process died, restarting the pool")
+                    self._executor = None
+                    self.restarts += 1
+                    executor.shutdown(wait=False)
+                raise
+            except Exception:
+                self.failed += 1
+                raise
+            self.completed += 1
+            self.run_time += run_time
+            self.max_run_time = max(self.max_run_time, run_time)
+            log.debug("Image task {} queued {:.3f}s, ran {:.3f}s".format(fn.__name__, queue_time, run_time))
+            return result
+        finally:
+            self._slots.release()
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def stats(self):
+        finished = self.completed + self.failed
+        return {
+            'queue_depth': self._waiting,
+            'completed': self.completed,
+            'failed': self.failed,
+            'rejected': self.rejected,
+            'restarts': self.restarts,
+            'avg_queue_time': self.queue_time / finished if finished else 0.0,
+            'max_queue_time': self.max_queue_time,
+            'avg_run_time': self.run_time / self.completed if self.completed else 0.0,
+            'max_run_time': self.max_run_time
+        }
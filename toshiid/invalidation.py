@@ -0,0 +1,85 @@
+import asyncio
+import asyncpg
+
+from toshi.config import config
+from toshi.log import log
+
+USER_CHANGED_CHANNEL = 'user_changed'
+HEARTBEAT_INTERVAL = 30
+RECONNECT_DELAY = 5
+
+class InvalidationListener:
+    """Listens for `user_changed` notifications sent by the database
+    triggers on `users` and `bot_categories`, and forwards the changed
+    toshi_id to all subscribed caches.
+
+    Subscribers register an `evict(toshi_id)` callback, and optionally a
+    `clear()` callback that is called whenever the listener (re)connects,
+    as any notifications sent while not listening are lost.
+
+    The listener holds its own connection rather than one from the
+    request pool, so it can be started before the pool is prepared and
+    never takes a connection away from request handlers."""
+
+    def __init__(self, dsn=None, *, heartbeat_interval=HEARTBEAT_INTERVAL, reconnect_delay=RECONNECT_DELAY):
+        self._dsn = dsn
+        self._subscribers = []
+        self._task = None
+        self._heartbeat_interval = heartbeat_interval
+        self._reconnect_delay = reconnect_delay
+        self._listening = asyncio.Event()
+
+    def subscribe(self, evict, clear=None):
+        self._subscribers.append((evict, clear))
+
+    def unsubscribe(self, evict):
+        self._subscribers = [s for s in self._subscribers if s[0] != evict]
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_event_loop().create_task(self._run())
+
+    def shutdown(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def wait_until_listening(self):
+        await self._listening.wait()
+
+    def _on_notification(self, connection, pid, channel, payload):
+        for evict, _ in self._subscribers:
+            try:
+                evict(payload)
+            except:
+                log.exception("error evicting {} from cache".format(payload))
+
+    def _clear_all(self):
+        for _, clear in self._subscribers:
+            if clear is None:
+                continue
+            try:
+                clear()
+            except:
+                log.exception("error clearing cache")
+
+    async def _run(self):
+        while True:
+            try:
+                con = await asyncpg.connect(self._dsn or config['database']['dsn'])
+                try:
+                    await con.add_listener(USER_CHANGED_CHANNEL, self._on_notification)
+                    self._clear_all()
+                    self._listening.set()
+                    while True:
+                        await asyncio.sleep(self._heartbeat_interval)
+                        # make sure the connection is still alive
+                        await con.fetchval("SELECT 1")
+                finally:
+                    self._listening.clear()
+                    con.terminate()
+            except asyncio.CancelledError:
+                raise
+            except:
+                log.exception("error listening for user changes, reconnecting in {} seconds".format(self._reconnect_delay))
+            await asyncio.sleep(self._reconnect_delay)
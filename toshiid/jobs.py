@@ -0,0 +1,88 @@
+import logging
+
+from tornado.escape import json_encode, json_decode
+
+from toshi.database import get_database_pool
+
+log = logging.getLogger("toshiid.jobs")
+
+DEFAULT_BATCH_SIZE = 10
+DEFAULT_MAX_ATTEMPTS = 10
+MAX_RETRY_DELAY = 3600
+# how long a claimed job is left to run before another worker can take it
+DEFAULT_LEASE_TIME = 300
+
+async def enqueue_jobs(db, jobs):
+    """Adds the given `(kind, payload)` pairs to the job queue using the given
+    connection, so the jobs are only run if the current transaction commits"""
+    await db.execute("INSERT INTO jobs (kind, payload) "
+                     "SELECT j.kind, j.payload::JSONB "
+                     "FROM unnest($1::VARCHAR[], $2::VARCHAR[]) AS j (kind, payload)",
+                     [kind for kind, _ in jobs],
+                     [json_encode(payload) for _, payload in jobs])
+
+class JobWorker:
+    """Runs queued jobs using the handler registered for each job's kind.
+
+    Handlers are coroutines called with the job's payload as keyword
+    arguments. Jobs are claimed by leasing them for `lease_time` seconds in
+    a statement of their own, so no transaction or connection is held while
+    they run and multiple workers can share the queue. A job whose worker
+    dies is picked up again once its lease runs out. Jobs that fail are
+    retried with exponential backoff until `max_attempts` is reached, after
+    which they are marked as failed and left in the table for inspection."""
+
+    def __init__(self, handlers, *, batch_size=DEFAULT_BATCH_SIZE, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 lease_time=DEFAULT_LEASE_TIME):
+        self._handlers = handlers
+        self._batch_size = batch_size
+        self._max_attempts = max_attempts
+        self._lease_time = lease_time
+
+    async def run_pending(self):
+        """Runs jobs until there are none due, returning the number run"""
+        count = 0
+        while True:
+            processed = await self.run_batch()
+            if processed == 0:
+                return count
+            count += processed
+
+    async def run_batch(self):
+        jobs = await self.claim_jobs()
+        for job in jobs:
+            await self.run_job(job)
+        return len(jobs)
+
+    async def claim_jobs(self):
+        """Leases up to `batch_size` due jobs, counting the attempt"""
+        async with get_database_pool().acquire() as con:
+            return await con.fetch("UPDATE jobs SET attempts = attempts + 1, "
+                                   "locked_until = (now() AT TIME ZONE 'utc') + ($2 * interval '1 second') "
+                                   "WHERE job_id IN ("
+                                   "SELECT job_id FROM jobs "
+                                   "WHERE failed = FALSE AND run_at <= (now() AT TIME ZONE 'utc') "
+                                   "AND (locked_until IS NULL OR locked_until <= (now() AT TIME ZONE 'utc')) "
+                                   "ORDER BY run_at "
+                                   "LIMIT $1 "
+                                   "FOR UPDATE SKIP LOCKED) "
+                                   "RETURNING *",
+                                   self._batch_size, self._lease_time)
+
+    async def run_job(self, job):
+        try:
+            handler = self._handlers[job['kind']]
+            await handler(**json_decode(job['payload']))
+        except Exception as e:
+            attempts = job['attempts']
+            failed = attempts >= self._max_attempts
+            log.warning("Error running {} job {} (attempt {}): {}".format(
+                job['kind'], job['job_id'], attempts, e))
+            async with get_database_pool().acquire() as con:
+                await con.execute("UPDATE jobs SET failed = $1, last_error = $2, locked_until = NULL, "
+                                  "run_at = (now() AT TIME ZONE 'utc') + ($3 * interval '1 second') "
+                                  "WHERE job_id = $4",
+                                  failed, str(e), min(2 ** attempts, MAX_RETRY_DELAY), job['job_id'])
+        else:
+            async with get_database_pool().acquire() as con:
+                await con.execute("DELETE FROM jobs WHERE job_id = $1", job['job_id'])
@@ -0,0 +1,100 @@
+"""Copies the images stored in the avatars table into the avatar store.
+
+    AVATAR_STORE_DIR=/path/to/avatars python -m toshiid.migrate_avatars [--delete-from-db]
+
+By default images are only copied, leaving the database untouched, so the
+command can be rerun safely against any directory. With `--delete-from-db`
+each image is read back from the store after it's been written and synced
+to disk, and only then is the row's `img` set to NULL, leaving only the
+avatar's metadata in the database. Only use it when AVATAR_STORE_DIR is
+durable storage shared by every process serving avatars: on Heroku, for
+example, a dyno's filesystem is discarded when it restarts, and isn't
+visible to other dynos, so deleting the images from the database after
+copying them there would lose them.
+
+Rows are processed in batches, each in its own transaction. The command can
+be stopped and rerun at any time, and can run while the service is serving
+avatars."""
+
+import argparse
+import asyncio
+import logging
+
+from toshi.database import prepare_database, get_database_pool
+from toshi.log import configure_logger
+from toshiid.app import update_config
+from toshiid.avatar_store import create_avatar_store, FilesystemAvatarStore
+
+DEFAULT_BATCH_SIZE = 100
+
+log = logging.getLogger("toshiid.migrate_avatars")
+
+async def migrate_batch(store, batch_size=DEFAULT_BATCH_SIZE, after=None, delete_from_db=False):
+    """Copies up to `batch_size` images, from the rows after the
+    `(toshi_id, hash)` key `after`, to the store. Returns the number of
+    images copied, and the key of the last row to pass as `after` for the
+    next batch, or None if there are no rows left"""
+    async with get_database_pool().acquire() as con:
+        async with con.transaction():
+            rows = await con.fetch("SELECT toshi_id, hash, format, img FROM avatars "
+                                   "WHERE img IS NOT NULL AND (toshi_id, hash) > ($1, $2) "
+                                   "ORDER BY toshi_id, hash "
+                                   "LIMIT $3 "
+                                   "{}".format("FOR UPDATE SKIP LOCKED" if delete_from_db else ""),
+                                   *(after or ('', '')), batch_size)
+            if not rows:
+                return 0, None
+            copied = []
+            for row in rows:
+                await store.put(row['hash'], row['format'], row['img'])
+                if not delete_from_db:
+                    copied.append(row)
+                    continue
+                # make sure what's on disk is the image before removing the
+                # only other copy of it
+                try:
+                    data = await asyncio.get_event_loop().run_in_executor(
+                        None, store.read, row['hash'], row['format'])
+                except OSError:
+                    data = None
+                if data != row['img']:
+                    log.error("Avatar {} for {} doesn't match the stored file, leaving it in the database".format(
+                        row['hash'], row['toshi_id']))
+                    continue
+                copied.append(row)
+            if delete_from_db:
+                await con.executemany("UPDATE avatars SET img = NULL WHERE toshi_id = $1 AND hash = $2",
+                                      [(row['toshi_id'], row['hash']) for row in copied])
+    return len(copied), (rows[-1]['toshi_id'], rows[-1]['hash'])
+
+async def migrate_avatars(store, batch_size=DEFAULT_BATCH_SIZE, delete_from_db=False):
+    total = 0
+    after = None
+    while True:
+        count, after = await migrate_batch(store, batch_size, after, delete_from_db)
+        if after is None:
+            return total
+        total += count
+        log.info("{} {} avatars".format("Moved" if delete_from_db else "Copied", total))
+
+def main():
+    parser = argparse.ArgumentParser(description="Copy avatar images out of the database")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--delete-from-db', action='store_true',
+                        help="set the images in the database to NULL once they've been copied, only use "
+                        "this if AVATAR_STORE_DIR is durable and shared by every process serving avatars")
+    args = parser.parse_args()
+
+    configure_logger(log)
+    update_config()
+    store = create_avatar_store()
+    if not isinstance(store, FilesystemAvatarStore):
+        parser.error("AVATAR_STORE_DIR must be set")
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(prepare_database())
+    total = loop.run_until_complete(migrate_avatars(store, args.batch_size, args.delete_from_db))
+    log.info("Finished {} {} avatars".format("moving" if args.delete_from_db else "copying", total))
+
+if __name__ == '__main__':
+    main()
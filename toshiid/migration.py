@@ -0,0 +1,171 @@
+import asyncio
+import binascii
+import os
+import time
+from collections import OrderedDict, deque
+
+import tornado.httpclient
+from tornado.escape import json_encode
+from tornado.platform.asyncio import to_asyncio_future
+
+from toshi.log import log
+
+DEFAULT_MAX_QUEUE_SIZE = 10000
+DEFAULT_DEDUPE_WINDOW = 3600
+DEFAULT_BATCH_SIZE = 1
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_RETRY_DELAY = 1
+MAX_RETRY_DELAY = 60
+
+class MigrationNotifier:
+    """Asks the wallet service to migrate toshi ids, in the background.
+
+    Toshi ids are added to a bounded queue (ids added when the queue is full
+    are dropped), and ids that were already queued within `dedupe_window`
+    seconds are ignored. Requests are retried with exponential backoff
+    until `max_attempts` is reached.
+
+    The wallet endpoint takes a single `toshiId`. If `batch_size` is more
+    than 1, up to that many ids are sent per request as `toshiIds`."""
+
+    def __init__(self, url, *, username=None, password=None,
+                 max_queue_size=DEFAULT_MAX_QUEUE_SIZE, dedupe_window=DEFAULT_DEDUPE_WINDOW,
+                 batch_size=DEFAULT_BATCH_SIZE, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 retry_delay=DEFAULT_RETRY_DELAY, timer=time.monotonic):
+        self._url = url
+        if username is not None or password is not None:
+            self._authorization = 'Basic %s' % (
+                binascii.b2a_base64(
+                    ('%s:%s' % (username, password)).encode('ascii')
+                ).decode('ascii').strip())
+        else:
+            self._authorization = None
+        self._max_queue_size = max_queue_size
+        self._dedupe_window = dedupe_window
+        self._batch_size = batch_size
+        self._max_attempts = max_attempts
+        self._retry_delay = retry_delay
+        self._timer = timer
+
+        self._queue = deque()
+        # toshi_id -> time it was last queued, oldest first
+        self._recent = OrderedDict()
+        self._task = None
+        self._sending = False
+        self._wakeup = asyncio.Event()
+        self._http_client = tornado.httpclient.AsyncHTTPClient()
+
+        self.queued = 0
+        self.deduped = 0
+        self.dropped = 0
+        self.sent = 0
+        self.retries = 0
+        self.failed = 0
+
+    def notify(self, toshi_id):
+        """Queues a migration request for `toshi_id`, returning False if it
+        was ignored as a duplicate or dropped because the queue is full"""
+
+        now = self._timer()
+        while self._recent:
+            oldest, queued_at = next(iter(self._recent.items()))
+            if queued_at + self._dedupe_window > now:
+                break
+            del self._recent[oldest]
+
+        if toshi_id in self._recent:
+            self.deduped += 1
+            return False
+        if len(self._queue) >= self._max_queue_size:
+            self.dropped += 1
+            log.warning("Dropping migration request for {}: queue full".format(toshi_id))
+            return False
+
+        self._recent[toshi_id] = now
+        self._queue.append(toshi_id)
+        self.queued += 1
+        self._wakeup.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+        return True
+
+    def request(self, toshi_ids):
+        if self._batch_size > 1:
+            body = {"toshiIds": toshi_ids}
+        else:
+            body = {"toshiId": toshi_ids[0]}
+        headers = {"Content-Type": "application/json"}
+        if self._authorization is not None:
+            headers["Authorization"] = self._authorization
+        return tornado.httpclient.HTTPRequest(
+            self._url, method="POST", headers=headers, body=json_encode(body))
+
+    async def send(self, toshi_ids):
+        """Sends a single request for the given ids, raising on failure"""
+        await to_asyncio_future(self._http_client.fetch(self.request(toshi_ids)))
+
+    async def _run(self):
+        while True:
+            while not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            batch = [self._queue.popleft() for _ in range(min(self._batch_size, len(self._queue)))]
+            self._sending = True
+            for attempt in range(1, self._max_attempts + 1):
+                try:
+                    await self.send(batch)
+                    self.sent += len(batch)
+                    break
+                except Exception as e:
+                    if attempt == self._max_attempts:
+                        self.failed += len(batch)
+                        log.warning("Error in request_to_migrate. toshi_ids: {} \"{}\"".format(batch, str(e)))
+                        # allow them to be retried by a later notify
+                        for toshi_id in batch:
+                            self._recent.pop(toshi_id, None)
+                    else:
+                        self.retries += 1
+                        await asyncio.sleep(min(self._retry_delay * 2 ** (attempt - 1), MAX_RETRY_DELAY))
+            self._sending = False
+
+    async def flush(self):
+        """Waits until every queued id has been sent or has failed"""
+        while self._queue or self._sending:
+            await asyncio.sleep(0.01)
+
+    def shutdown(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self):
+        return {
+            'queue_depth': len(self._queue),
+            'queued': self.queued,
+            'deduped': self.deduped,
+            'dropped': self.dropped,
+            'sent': self.sent,
+            'retries': self.retries,
+            'failed': self.failed
+        }
+
+_notifier = None
+
+def get_migration_notifier():
+    """Returns the process' MigrationNotifier, configured from the environment,
+    or None if no wallet service is configured"""
+    global _notifier
+    if _notifier is None and os.getenv('WALLET_URL'):
+        _notifier = MigrationNotifier(
+            os.getenv('WALLET_URL'),
+            username=os.getenv('WALLET_BASIC_AUTH_USERNAME'),
+            password=os.getenv('WALLET_BASIC_AUTH_PASSWORD'),
+            max_queue_size=int(os.getenv('WALLET_MAX_QUEUE_SIZE', DEFAULT_MAX_QUEUE_SIZE)),
+            dedupe_window=int(os.getenv('WALLET_DEDUPE_WINDOW', DEFAULT_DEDUPE_WINDOW)),
+            batch_size=int(os.getenv('WALLET_BATCH_SIZE', DEFAULT_BATCH_SIZE)))
+    return _notifier
+
+def migration_notifier_stats():
+    """Returns the stats of the process' MigrationNotifier, if there is one"""
+    notifier = get_migration_notifier()
+    return notifier.stats() if notifier is not None else None
@@ -0,0 +1,103 @@
+"""Renders identicons ahead of time into the identicon cache directory.
+
+    python -m toshiid.pregenerate_identicons [--format PNG] [FILE ...]
+
+Addresses are read one per line from the given files (or stdin with `-`),
+or from the users table when no files are given. Identicons already in
+the cache directory are skipped. Batches are rendered in parallel using
+`--processes` worker processes.
+
+    python -m toshiid.pregenerate_identicons --benchmark 1000
+
+compares rendering a batch of random addresses with `blockies.create`."""
+
+import argparse
+import asyncio
+import concurrent.futures
+import itertools
+import os
+import sys
+import time
+
+from toshi.config import config
+from toshi.database import prepare_database, get_database_pool
+from toshiid.identicon import IdenticonCache, IDENTICON_SIZE, IDENTICON_SCALE, render_identicons
+
+DEFAULT_BATCH_SIZE = 1000
+
+def read_addresses(files):
+    for filename in files:
+        with (sys.stdin if filename == '-' else open(filename)) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield line
+
+async def fetch_addresses():
+    await prepare_database()
+    async with get_database_pool().acquire() as con:
+        rows = await con.fetch("SELECT toshi_id, payment_address FROM users")
+    addresses = set()
+    for row in rows:
+        addresses.add(row['toshi_id'])
+        if row['payment_address']:
+            addresses.add(row['payment_address'])
+    return sorted(addresses)
+
+def render_batch(directory, addresses, format):
+    # only the disk tier is useful here
+    return IdenticonCache(0, directory).render_many(addresses, format)
+
+def pregenerate(directory, addresses, format, batch_size=DEFAULT_BATCH_SIZE, processes=1):
+    batches = [addresses[i:i + batch_size] for i in range(0, len(addresses), batch_size)]
+    if processes <= 1:
+        return sum(render_batch(directory, batch, format) for batch in batches)
+    # encoding the images is the slowest part, and has to be done one image
+    # at a time, so spread the batches over multiple processes
+    with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+        return sum(executor.map(render_batch, itertools.repeat(directory), batches, itertools.repeat(format)))
+
+def benchmark(count, format):
+    import blockies
+
+    addresses = ["0x" + os.urandom(20).hex() for _ in range(count)]
+    start = time.perf_counter()
+    for address in addresses:
+        blockies.create(address, size=IDENTICON_SIZE, scale=IDENTICON_SCALE, format=format)
+    blockies_time = time.perf_counter() - start
+    start = time.perf_counter()
+    render_identicons(addresses, format)
+    batch_time = time.perf_counter() - start
+    print("blockies: {:.3f}s ({:.0f}/s)".format(blockies_time, count / blockies_time))
+    print("batched:  {:.3f}s ({:.0f}/s)".format(batch_time, count / batch_time))
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-generate identicons")
+    parser.add_argument('files', nargs='*', help="files with one address per line, - for stdin")
+    parser.add_argument('--format', default='PNG')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--processes', type=int, default=os.cpu_count())
+    parser.add_argument('--benchmark', type=int, metavar='COUNT',
+                        help="benchmark rendering COUNT random addresses")
+    args = parser.parse_args()
+    format = args.format.upper()
+
+    if args.benchmark:
+        benchmark(args.benchmark, format)
+        return
+
+    directory = os.getenv('IDENTICON_CACHE_DIR')
+    if not directory and 'general' in config:
+        directory = config['general'].get('identicon_cache_dir', None)
+    if not directory:
+        parser.error("IDENTICON_CACHE_DIR must be set")
+    if args.files:
+        addresses = list(read_addresses(args.files))
+    else:
+        addresses = asyncio.get_event_loop().run_until_complete(fetch_addresses())
+    start = time.perf_counter()
+    rendered = pregenerate(directory, addresses, format, args.batch_size, args.processes)
+    print("Rendered {} of {} identicons in {:.1f}s".format(rendered, len(addresses), time.perf_counter() - start))
+
+if __name__ == '__main__':
+    main()
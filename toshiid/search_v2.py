@@ -1,8 +1,7 @@
-import asyncio
 from toshi.database import DatabaseMixin
 from toshi.handlers import BaseHandler
 from toshiid.handlers_v1 import parse_boolean, PUNCTUATION
-from toshiid.handlers_v2 import user_row_for_json
+from toshiid.serialization import UserJSONMixin
 from toshi.utils import parse_int, validate_address
 from toshi.errors import JSONHTTPError
 
@@ -16,7 +15,7 @@ GROUPINGS = [
 ]
 RESULTS_PER_SECTION = 5
 
-class SearchHandler(DatabaseMixin, BaseHandler):
+class SearchHandler(UserJSONMixin, DatabaseMixin, BaseHandler):
 
     async def get(self):
 
@@ -46,15 +45,13 @@ class SearchHandler(DatabaseMixin, BaseHandler):
                 "name": name,
                 "query": query,
                 "results": [
-                    user_row_for_json(result) for result in results
+                    self.user_json_v2(result) for result in results
                 ]})
 
-        self.write({'sections': sections})
+        self.write_json({'sections': sections})
 
     async def list_users(self, *, toshi_ids=None, payment_addresses=None):
 
-        sql = "SELECT u.* FROM users u JOIN (VALUES "
-        values = []
         if toshi_ids is not None:
             column = 'toshi_id'
             addresses = toshi_ids
@@ -63,28 +60,23 @@ class SearchHandler(DatabaseMixin, BaseHandler):
             addresses = payment_addresses
         else:
             raise Exception("list_users called without toshi_ids or payment_addresses")
-        for i, address in enumerate(addresses):
+        for address in addresses:
             if not validate_address(address):
                 raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Bad Arguments'}]})
-            values.append("('{}', {}) ".format(address, i))
-            # in case this request is made with a lot of ids
-            # make sure we yield to other processes rather
-            # than taking up all resources on this
-            if i > 0 and i % 100 == 0:
-                await asyncio.sleep(0.001)
-        sql += ", ".join(values)
-        sql += ") AS v ({column}, ordering) ON u.{column} = v.{column} ".format(column=column)
-        sql += "ORDER BY v.ordering"
 
         async with self.db:
-            rows = await self.db.fetch(sql)
+            rows = await self.db.fetch(
+                "SELECT u.* FROM unnest($1::VARCHAR[]) WITH ORDINALITY AS v ({column}, ordering) "
+                "JOIN users u ON u.{column} = v.{column} "
+                "ORDER BY v.ordering".format(column=column),
+                addresses)
 
-        self.write({
+        self.write_json({
             'limit': len(rows),
             'total': len(rows),
             'offset': 0,
             'query': '',
-            'results': [user_row_for_json(row) for row in rows]
+            'results': [self.user_json_v2(row) for row in rows]
         })
 
     async def search(self):
@@ -154,10 +146,10 @@ class SearchHandler(DatabaseMixin, BaseHandler):
             if key in ['limit', 'offset']:
                 continue
             query.extend(['{}={}'.format(key, v.decode('utf-8')) for v in values])
-        return self.write({
+        return self.write_json({
             'limit': limit,
             'offset': offset,
             'total': total,
-            'results': [user_row_for_json(r) for r in results],
+            'results': [self.user_json_v2(r) for r in results],
             'query': "&".join(query)
         })
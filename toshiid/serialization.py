@@ -0,0 +1,105 @@
+from tornado.escape import json_encode
+
+from toshi.config import config
+from toshiid.cache import LRUCache
+from toshiid.handlers_v2 import user_row_for_json as user_row_for_json_v2
+
+# variants include values from the request (e.g. the host), so the number
+# kept for each user is capped to keep them from growing without bound
+MAX_VARIANTS_PER_USER = 8
+
+class JSONFragment(bytes):
+    """Already encoded JSON, included as is by `encode_json`"""
+
+def encode_json(obj):
+    """Encodes `obj` the same way `tornado.escape.json_encode` does, except
+    that any `JSONFragment`s are spliced in without being re-encoded"""
+    if isinstance(obj, JSONFragment):
+        return obj
+    if isinstance(obj, dict):
+        return b'{' + b', '.join(
+            json_encode(key).encode('utf-8') + b': ' + encode_json(value)
+            for key, value in obj.items()) + b'}'
+    if isinstance(obj, (list, tuple)):
+        return b'[' + b', '.join(encode_json(value) for value in obj) + b']'
+    return json_encode(obj).encode('utf-8')
+
+def user_row_version(row):
+    """Identifies the state of a user row. `updated` is changed on every
+    update to the row, categories are included as their names and tags
+    come from other tables"""
+    return tuple(row[key] if key in row else None for key in (
+        'updated', 'reputation_score', 'review_count', 'average_rating',
+        'category_ids', 'category_tags', 'category_names'))
+
+class UserJSONCache:
+    """Caches encoded user json by toshi_id.
+
+    Each user can have multiple variants of their json cached (e.g. for
+    different api versions or hosts), each stored alongside the version of
+    the row it was generated from so stale entries are never returned even
+    if an invalidation is missed. At most `max_variants` are kept for each
+    user, the oldest being replaced first."""
+
+    def __init__(self, max_size, max_variants=MAX_VARIANTS_PER_USER):
+        self.users = LRUCache(max_size)
+        self.max_variants = max_variants
+
+    def get(self, row, variant):
+        variants = self.users.get(row['toshi_id'])
+        if variants is None:
+            return None
+        version, fragment = variants.get(variant, (None, None))
+        if fragment is None or version != user_row_version(row):
+            return None
+        return fragment
+
+    def put(self, row, variant, fragment):
+        if not self.users.enabled:
+            return
+        variants = self.users.get(row['toshi_id'])
+        if variants is None:
+            variants = {}
+            self.users.set(row['toshi_id'], variants)
+        if variant not in variants and len(variants) >= self.max_variants:
+            del variants[next(iter(variants))]
+        variants[variant] = (user_row_version(row), fragment)
+
+    def evict(self, toshi_id):
+        self.users.invalidate(toshi_id)
+
+    def clear(self):
+        self.users.clear()
+
+    def stats(self):
+        return self.users.stats()
+
+class UserJSONMixin:
+
+    @property
+    def user_json_cache(self):
+        cache = getattr(self.application, 'user_json_cache', None)
+        if cache is None:
+            cache = self.application.user_json_cache = UserJSONCache(
+                config['general'].getint('user_json_cache_size', 0))
+            listener = getattr(self.application, 'invalidation_listener', None)
+            if listener is not None:
+                listener.subscribe(cache.evict, cache.clear)
+        return cache
+
+    def cached_user_json(self, row, variant, serialize):
+        """Returns `serialize(row)` as a `JSONFragment`, reusing the previously
+        encoded json for the same row and `variant` if available"""
+        fragment = self.user_json_cache.get(row, variant)
+        if fragment is None:
+            fragment = JSONFragment(json_encode(serialize(row)).encode('utf-8'))
+            self.user_json_cache.put(row, variant, fragment)
+        return fragment
+
+    def user_json_v2(self, row):
+        return self.cached_user_json(row, (2,), user_row_for_json_v2)
+
+    def write_json(self, data):
+        """Like `self.write(data)` for dicts containing `JSONFragment`s"""
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        self.write(encode_json(data))
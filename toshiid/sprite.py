@@ -0,0 +1,149 @@
+import base64
+import math
+import regex
+from io import BytesIO
+
+from PIL import Image
+
+from toshi.database import DatabaseMixin
+from toshi.handlers import BaseHandler
+from toshi.errors import JSONHTTPError
+from toshi.log import log
+from toshi.utils import validate_address, parse_int
+from toshiid.avatar_store import AvatarStoreMixin
+from toshiid.identicon import render_identicon_images
+
+MAX_SPRITE_ADDRESSES = 100
+DEFAULT_SPRITE_SIZE = 64
+MIN_SPRITE_SIZE = 8
+MAX_SPRITE_SIZE = 256
+
+# matches both the local identicon url and the key identicons are uploaded to
+IDENTICON_URL_RE = regex.compile(r"/identicon/(0x[0-9a-fA-F]{40})\.png$")
+
+def render_sprite(tiles, size, avatar_store=None):
+    """Renders a sprite sheet from a list of tiles, which are either
+    ('avatar', address, image data), ('stored', address, hash, format) for
+    avatars kept in `avatar_store`, or ('identicon', address), returning the
+    PNG data and the (x, y) offset of each tile. Avatars that can't be read
+    or decoded are replaced by the identicon of their address"""
+
+    images = []
+    for tile in tiles:
+        image = None
+        if tile[0] in ('avatar', 'stored'):
+            try:
+                data = tile[2] if tile[0] == 'avatar' else avatar_store.read(tile[2], tile[3])
+                image = Image.open(BytesIO(data))
+                image.load()
+            except OSError:
+                log.warning("Unable to decode stored avatar for {}".format(tile[1]))
+                image = None
+        images.append(image)
+    identicons = iter(render_identicon_images([tile[1] for tile, image in zip(tiles, images) if image is None]))
+    images = [image if image is not None else next(identicons) for image in images]
+
+    columns = math.ceil(math.sqrt(len(tiles)))
+    rows = math.ceil(len(tiles) / columns)
+    sheet = Image.new('RGBA', (columns * size, rows * size), (0, 0, 0, 0))
+    offsets = []
+    for i, image in enumerate(images):
+        offset = ((i % columns) * size, (i // columns) * size)
+        sheet.paste(image.convert('RGBA').resize((size, size), Image.LANCZOS), offset)
+        offsets.append(offset)
+
+    stream = BytesIO()
+    sheet.save(stream, format='PNG')
+    return stream.getvalue(), offsets
+
+class AvatarSpriteHandler(AvatarStoreMixin, DatabaseMixin, BaseHandler):
+    """Returns the avatars of many users as a single sprite sheet, so list
+    views don't have to fetch each avatar separately.
+
+    Avatars stored in the avatars table or the avatar store and identicons
+    are included in the sprite, avatars hosted elsewhere (e.g. uploaded to
+    s3) are returned as urls instead."""
+
+    async def get(self):
+
+        addresses = self.get_query_arguments('address')
+        size = parse_int(self.get_query_argument('size', DEFAULT_SPRITE_SIZE))
+
+        if len(addresses) == 0 or size is None or not MIN_SPRITE_SIZE <= size <= MAX_SPRITE_SIZE:
+            raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Bad Arguments'}]})
+        if len(addresses) > MAX_SPRITE_ADDRESSES:
+            raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Too many addresses requested. Max is {}'.format(MAX_SPRITE_ADDRESSES)}]})
+        if not all(validate_address(address) for address in addresses):
+            raise JSONHTTPError(400, body={'errors': [{'id': 'invalid_address', 'message': 'Invalid Address'}]})
+
+        # remove duplicates, keeping the requested order
+        addresses = list(dict.fromkeys(address.lower() for address in addresses))
+
+        async with self.db:
+            # only the metadata of the latest avatar is loaded here, as the
+            # image itself isn't needed for users whose avatar is hosted
+            # elsewhere or kept in the avatar store
+            rows = await self.db.fetch(
+                "SELECT u.toshi_id, u.avatar, a.hash, a.format, a.url, a.in_db "
+                "FROM users u "
+                "LEFT JOIN LATERAL (SELECT hash, format, url, img IS NOT NULL AS in_db "
+                "FROM avatars WHERE avatars.toshi_id = u.toshi_id AND avatars.source_hash IS NULL "
+                "ORDER BY last_modified DESC LIMIT 1) a ON TRUE "
+                "WHERE u.toshi_id = ANY($1)",
+                addresses)
+            in_db = [row for row in rows if row['avatar'] is not None and row['avatar'].startswith('/avatar/') and row['in_db']]
+            if in_db:
+                images = await self.db.fetch(
+                    "SELECT toshi_id, img FROM avatars "
+                    "JOIN unnest($1::VARCHAR[], $2::VARCHAR[]) AS v (toshi_id, hash) USING (toshi_id, hash) "
+                    "WHERE img IS NOT NULL",
+                    [row['toshi_id'] for row in in_db], [row['hash'] for row in in_db])
+                images = {row['toshi_id']: row['img'] for row in images}
+            else:
+                images = {}
+        users = {row['toshi_id']: row for row in rows}
+
+        tiles = []
+        urls = {}
+        for address in addresses:
+            row = users.get(address)
+            avatar = row['avatar'] if row is not None else None
+            if avatar is None:
+                tiles.append(('identicon', address))
+                continue
+            identicon = IDENTICON_URL_RE.search(avatar)
+            if identicon:
+                tiles.append(('identicon', identicon.group(1)))
+            elif not avatar.startswith('/avatar/'):
+                urls[address] = avatar
+                tiles.append(None)
+            elif address in images:
+                tiles.append(('avatar', address, images[address]))
+            elif row['hash'] is not None and row['url'] is not None:
+                # moved to s3, so there's no local copy to include
+                urls[address] = row['url']
+                tiles.append(None)
+            elif row['hash'] is not None and not row['in_db']:
+                tiles.append(('stored', address, row['hash'], row['format']))
+            else:
+                # the avatar row is missing, so there's nothing to serve
+                tiles.append(('identicon', address))
+
+        sprite_tiles = [tile for tile in tiles if tile is not None]
+        offsets = {}
+        sprite = None
+        if sprite_tiles:
+            data, sprite_offsets = await self.run_in_executor(render_sprite, sprite_tiles, size, self.avatar_store)
+            sprite = "data:image/png;base64,{}".format(base64.b64encode(data).decode('ascii'))
+            sprite_offsets = iter(sprite_offsets)
+            for address, tile in zip(addresses, tiles):
+                if tile is not None:
+                    x, y = next(sprite_offsets)
+                    offsets[address] = {'x': x, 'y': y}
+
+        self.write({
+            'size': size,
+            'sprite': sprite,
+            'offsets': offsets,
+            'urls': urls
+        })
@@ -0,0 +1,61 @@
+import asyncio
+
+from tornado.escape import json_encode
+
+from toshi.log import log
+
+DEFAULT_LOG_INTERVAL = 60
+
+class StatsLogger:
+    """Periodically logs the stats of the application's caches and
+    background queues, so hit rates and backlogs show up in the logs.
+
+    Each source is a function returning a stats dict, or None if whatever
+    it reports on isn't in use, in which case it's left out."""
+
+    def __init__(self, interval=DEFAULT_LOG_INTERVAL):
+        self._interval = interval
+        self._sources = []
+        self._task = None
+
+    def add_source(self, name, fn):
+        self._sources.append((name, fn))
+
+    def collect(self):
+        stats = {}
+        for name, fn in self._sources:
+            try:
+                value = fn()
+            except Exception:
+                log.exception("Error collecting {} stats".format(name))
+                continue
+            if value is not None:
+                stats[name] = value
+        return stats
+
+    def log_stats(self):
+        stats = self.collect()
+        if stats:
+            log.info("Stats: {}".format(json_encode(stats)))
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    def shutdown(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self._interval)
+            self.log_stats()
+
+def app_stats_source(app, attribute):
+    """Returns a source for the stats of `app.<attribute>`, which may only be
+    created once it's first used"""
+    def stats():
+        value = getattr(app, attribute, None)
+        return value.stats() if value is not None else None
+    return stats
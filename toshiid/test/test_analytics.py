@@ -0,0 +1,71 @@
+import asyncio
+import base64
+
+from tornado.escape import json_decode
+from tornado.testing import gen_test
+from tornado.web import RequestHandler
+
+from toshiid.analytics import AnalyticsDispatcher
+from toshi.test.base import AsyncHandlerTest
+
+class MixpanelStandInHandler(RequestHandler):
+
+    def initialize(self, received):
+        self.received = received
+
+    def post(self, endpoint):
+        data = json_decode(base64.b64decode(self.get_body_argument('data')))
+        self.received.append((endpoint, data))
+        self.write("1")
+
+class AnalyticsDispatcherTest(AsyncHandlerTest):
+
+    def setUp(self):
+        self.received = []
+        super().setUp()
+
+    def get_urls(self):
+        return [(r"^/(track|engage)/?$", MixpanelStandInHandler, {'received': self.received})]
+
+    @gen_test
+    async def test_events_are_batched(self):
+
+        dispatcher = AnalyticsDispatcher("token", api_host=self.get_url("").rstrip("/"),
+                                         batch_size=3, flush_interval=0.2)
+        dispatcher.start()
+
+        for i in range(4):
+            dispatcher.track("user{}".format(i), "Searched", {"query": "bob"})
+        dispatcher.people_set("user0", {"distinct_id": "user0"})
+        self.assertEqual(dispatcher.stats()['backlog'], 5)
+
+        # a full batch triggers a flush straight away
+        await asyncio.sleep(0.05)
+        self.assertEqual(sorted(endpoint for endpoint, _ in self.received), ['engage', 'track', 'track'])
+        self.assertEqual(self.received[0][0], 'track')
+        self.assertEqual([e['properties']['distinct_id'] for e in self.received[0][1]], ['user0', 'user1', 'user2'])
+        self.assertEqual(self.received[0][1][0]['properties']['query'], "bob")
+        self.assertEqual(dispatcher.stats(), {'backlog': 0, 'sent': 5, 'dropped': 0, 'failed': 0})
+
+        # otherwise events wait for the interval
+        dispatcher.track("user0", "Searched")
+        await asyncio.sleep(0.05)
+        self.assertEqual(len(self.received), 3)
+        await asyncio.sleep(0.3)
+        self.assertEqual(len(self.received), 4)
+
+        dispatcher.shutdown()
+
+    @gen_test
+    async def test_backlog_limit(self):
+
+        dispatcher = AnalyticsDispatcher("token", api_host=self.get_url("").rstrip("/"), max_backlog=2)
+
+        for i in range(5):
+            dispatcher.track(None, "Searched")
+        self.assertEqual(dispatcher.stats()['backlog'], 2)
+        self.assertEqual(dispatcher.stats()['dropped'], 3)
+
+        await dispatcher.flush()
+        self.assertEqual(len(self.received), 1)
+        self.assertEqual(len(self.received[0][1]), 2)
@@ -1,4 +1,5 @@
 import asyncio
+import time
 import unittest
 import mimetypes
 import blockies
@@ -15,11 +16,14 @@ from tornado.platform.asyncio import to_asyncio_future
 from tornado.ioloop import IOLoop
 
 from toshiid.app import urls
-from toshiid.handlers_v1 import AVATAR_URL_HASH_LENGTH
+from toshiid.handlers_v1 import (AVATAR_URL_HASH_LENGTH, ALTERNATIVE_AVATAR_FORMATS, process_image,
+                                 ImageTooLargeError)
+from toshiid.image_workers import ImageWorkerPool
 from toshi.test.moto_server import requires_moto, BotoTestMixin
 from toshi.analytics import encode_id
 from toshi.test.database import requires_database
 from toshi.test.base import AsyncHandlerTest
+from toshi.request import sign_request
 from toshi.ethereum.utils import data_decoder
 
 from PIL import Image
@@ -227,6 +231,31 @@ class UserAvatarHandlerTest(BotoTestMixin, AsyncHandlerTest):
             objs = await self.boto.list_objects()
         self.assertNotIn('Contents', objs)
 
+    @gen_test
+    @requires_database
+    @requires_moto
+    async def test_signature_covers_upload(self):
+
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO users (username, toshi_id) VALUES ($1, $2)", 'BobSmith', TEST_ADDRESS)
+
+        boundary = uuid4().hex
+        headers = {'Content-Type': 'multipart/form-data; boundary={}'.format(boundary)}
+        png = blockies.create(TEST_PAYMENT_ADDRESS, size=8, scale=12, format='PNG')
+        body = body_producer(boundary, [('image.png', png)])
+
+        # sign one image and send another
+        timestamp = int(time.time())
+        signature = sign_request(TEST_PRIVATE_KEY, "PUT", "/v1/user", timestamp, body)
+        other = body_producer(boundary, [('image.png', blockies.create(TEST_ADDRESS_2, size=8, scale=12, format='PNG'))])
+        resp = await self.fetch_signed("/user", method="PUT", timestamp=timestamp, address=TEST_ADDRESS,
+                                       signature=signature, body=other, headers=headers)
+        self.assertResponseCodeEqual(resp, 400)
+
+        resp = await self.fetch_signed("/user", method="PUT", timestamp=timestamp, address=TEST_ADDRESS,
+                                       signature=signature, body=body, headers=headers)
+        self.assertResponseCodeEqual(resp, 200)
+
     @gen_test
     @requires_database
     @requires_moto
@@ -294,3 +323,206 @@ class UserAvatarHandlerTest(BotoTestMixin, AsyncHandlerTest):
         loop.add_future(f2, f2done)
 
         await asyncio.wait([to_asyncio_future(f) for f in [f1, f2]], timeout=5)
+
+    @gen_test
+    @requires_database
+    @requires_moto
+    async def test_avatar_sizes(self):
+
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO users (username, toshi_id) VALUES ($1, $2)", 'BobSmith', TEST_ADDRESS)
+
+        jpeg = blockies.create(TEST_ADDRESS_2, size=8, scale=100, format='JPEG')
+        boundary = uuid4().hex
+        headers = {'Content-Type': 'multipart/form-data; boundary={}'.format(boundary)}
+        body = body_producer(boundary, [('avatar.jpg', jpeg)])
+        resp = await self.fetch_signed("/user", signing_key=TEST_PRIVATE_KEY, method="PUT",
+                                       body=body, headers=headers)
+        self.assertResponseCodeEqual(resp, 200)
+
+        async with self.pool.acquire() as con:
+            rows = await con.fetch("SELECT * FROM avatars WHERE toshi_id = $1 ORDER BY size DESC", TEST_ADDRESS)
+        self.assertEqual([row['size'] for row in rows], [512, 256, 128, 64])
+        self.assertIsNone(rows[0]['source_hash'])
+        self.assertTrue(all(row['source_hash'] == rows[0]['hash'] for row in rows[1:]))
+        # only the metadata of the images uploaded to s3 is stored
+        self.assertTrue(all(row['img'] is None for row in rows))
+
+        # the resized avatars are uploaded next to the original
+        avatar_url = json_decode(resp.body)['avatar']
+        self.assertEqual(rows[0]['url'], avatar_url)
+        self.assertEqual(rows[-1]['url'], avatar_url.replace(".jpg", "_64.jpg"))
+        resp = await self.fetch(avatar_url.replace(".jpg", "_64.jpg"))
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertEqual(Image.open(BytesIO(resp.body)).size, (64, 64))
+
+        for size, expected in [(None, 512), (40, 64), (64, 64), (100, 128), (300, 512), (1000, 512)]:
+            url = "/avatar/{}.jpg".format(TEST_ADDRESS)
+            if size is not None:
+                url += "?size={}".format(size)
+            resp = await self.fetch(super().get_url(url), follow_redirects=False)
+            self.assertResponseCodeEqual(resp, 302)
+            self.assertEqual(resp.headers['Location'], avatar_url if expected == 512 else
+                             avatar_url.replace(".jpg", "_{}.jpg".format(expected)), url)
+            resp = await self.fetch(super().get_url(url))
+            self.assertResponseCodeEqual(resp, 200)
+            self.assertEqual(Image.open(BytesIO(resp.body)).size, (expected, expected), url)
+
+    @unittest.skipIf('WEBP' not in ALTERNATIVE_AVATAR_FORMATS, "PIL doesn't support WebP")
+    @gen_test
+    @requires_database
+    @requires_moto
+    async def test_avatar_format_negotiation(self):
+
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO users (username, toshi_id) VALUES ($1, $2)", 'BobSmith', TEST_ADDRESS)
+
+        jpeg = blockies.create(TEST_ADDRESS_2, size=8, scale=100, format='JPEG')
+        boundary = uuid4().hex
+        headers = {'Content-Type': 'multipart/form-data; boundary={}'.format(boundary)}
+        body = body_producer(boundary, [('avatar.jpg', jpeg)])
+        resp = await self.fetch_signed("/user", signing_key=TEST_PRIVATE_KEY, method="PUT",
+                                       body=body, headers=headers)
+        self.assertResponseCodeEqual(resp, 200)
+        avatar_url = json_decode(resp.body)['avatar']
+
+        url = super().get_url("/avatar/{}.jpg".format(TEST_ADDRESS))
+        resp = await self.fetch(url, headers={'Accept': '*/*'}, follow_redirects=False)
+        self.assertResponseCodeEqual(resp, 302)
+        self.assertEqual(resp.headers['Location'], avatar_url)
+        self.assertEqual(resp.headers['Vary'], 'Accept')
+        resp = await self.fetch(url, headers={'Accept': '*/*'})
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertEqual(Image.open(BytesIO(resp.body)).format, 'JPEG')
+        jpeg_length = len(resp.body)
+
+        # the other formats are uploaded next to the original
+        resp = await self.fetch(url, headers={'Accept': 'image/webp,image/*,*/*;q=0.8'}, follow_redirects=False)
+        self.assertResponseCodeEqual(resp, 302)
+        self.assertEqual(resp.headers['Location'], avatar_url.replace(".jpg", ".webp"))
+        self.assertEqual(resp.headers['Vary'], 'Accept')
+        resp = await self.fetch(url, headers={'Accept': 'image/webp,image/*,*/*;q=0.8'})
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertLess(len(resp.body), jpeg_length)
+        self.assertEqual(Image.open(BytesIO(resp.body)).format, 'WEBP')
+
+        resp = await self.fetch(url + "?size=64", headers={'Accept': 'image/webp'}, follow_redirects=False)
+        self.assertResponseCodeEqual(resp, 302)
+        self.assertEqual(resp.headers['Location'], avatar_url.replace(".jpg", "_64.webp"))
+        resp = await self.fetch(url + "?size=64", headers={'Accept': 'image/webp'})
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertEqual(Image.open(BytesIO(resp.body)).size, (64, 64))
+
+        async with self.pool.acquire() as con:
+            count = await con.fetchval("SELECT COUNT(*) FROM avatars WHERE toshi_id = $1 AND (img IS NOT NULL OR url IS NULL)",
+                                       TEST_ADDRESS)
+        self.assertEqual(count, 0)
+
+    @gen_test(timeout=30)
+    @requires_database
+    @requires_moto
+    async def test_upload_rejected_when_image_workers_busy(self):
+
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO users (username, toshi_id) VALUES ($1, $2)", 'BobSmith', TEST_ADDRESS)
+
+        self._app.image_workers = ImageWorkerPool(1, max_queue_size=0, retry_after=7)
+        try:
+            # keep the only worker busy
+            busy = asyncio.ensure_future(self._app.image_workers.run(time.sleep, 2))
+            await asyncio.sleep(0.1)
+
+            boundary = uuid4().hex
+            headers = {'Content-Type': 'multipart/form-data; boundary={}'.format(boundary)}
+            png = blockies.create(TEST_PAYMENT_ADDRESS, size=8, scale=12, format='PNG')
+            body = body_producer(boundary, [('image.png', png)])
+            resp = await self.fetch_signed("/user", signing_key=TEST_PRIVATE_KEY, method="PUT",
+                                           body=body, headers=headers)
+            self.assertResponseCodeEqual(resp, 503)
+            self.assertEqual(resp.headers['Retry-After'], '7')
+            self.assertEqual(self._app.image_workers.stats()['rejected'], 1)
+
+            await busy
+            resp = await self.fetch_signed("/user", signing_key=TEST_PRIVATE_KEY, method="PUT",
+                                           body=body, headers=headers)
+            self.assertResponseCodeEqual(resp, 200)
+        finally:
+            self._app.image_workers.shutdown()
+            del self._app.image_workers
+
+class AvatarUploadLimitsTest(BotoTestMixin, AsyncHandlerTest):
+
+    def setUp(self):
+        super().setUp(extraconf={'general': {'avatar_max_upload_size': str(256 * 1024),
+                                             'avatar_max_pixels': str(1000 * 1000)}})
+
+    def get_urls(self):
+        return urls
+
+    def get_url(self, path):
+        if not path.startswith("http://") and not path.startswith("https://"):
+            path = "/v1{}".format(path)
+        return super().get_url(path)
+
+    @gen_test
+    @requires_database
+    @requires_moto
+    async def test_upload_limits(self):
+
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO users (username, toshi_id) VALUES ($1, $2)", 'BobSmith', TEST_ADDRESS)
+
+        boundary = uuid4().hex
+        headers = {'Content-Type': 'multipart/form-data; boundary={}'.format(boundary)}
+
+        # too many bytes
+        body = body_producer(boundary, [('image.png', os.urandom(512 * 1024))])
+        resp = await self.fetch_signed("/user", signing_key=TEST_PRIVATE_KEY, method="PUT",
+                                       body=body, headers=headers)
+        self.assertResponseCodeEqual(resp, 413)
+        self.assertEqual(json_decode(resp.body)['errors'][0]['id'], 'upload_too_large')
+
+        # small file, but too many pixels
+        stream = BytesIO()
+        Image.new('RGB', (2000, 2000)).save(stream, format='PNG')
+        body = body_producer(boundary, [('image.png', stream.getvalue())])
+        resp = await self.fetch_signed("/user", signing_key=TEST_PRIVATE_KEY, method="PUT",
+                                       body=body, headers=headers)
+        self.assertResponseCodeEqual(resp, 413)
+        self.assertEqual(json_decode(resp.body)['errors'][0]['id'], 'image_too_large')
+
+        async with self.boto:
+            objs = await self.boto.list_objects()
+        self.assertNotIn('Contents', objs)
+
+        # within the limits
+        png = blockies.create(TEST_PAYMENT_ADDRESS, size=8, scale=12, format='PNG')
+        body = body_producer(boundary, [('image.png', png)])
+        resp = await self.fetch_signed("/user", signing_key=TEST_PRIVATE_KEY, method="PUT",
+                                       body=body, headers=headers)
+        self.assertResponseCodeEqual(resp, 200)
+
+class ProcessImageTest(unittest.TestCase):
+
+    def test_draft_decode_large_jpeg(self):
+
+        stream = BytesIO()
+        Image.new('RGB', (6000, 4000), (200, 30, 40)).save(stream, format='JPEG')
+        jpeg = stream.getvalue()
+
+        with self.assertRaises(ImageTooLargeError):
+            process_image(jpeg, 'image/jpeg', 6000 * 4000 - 1)
+
+        images, format, alternatives, stats = process_image(BytesIO(jpeg), 'image/jpeg', 6000 * 4000)
+        self.assertEqual(format, 'JPEG')
+        self.assertEqual(Image.open(BytesIO(images[0][1])).size, (512, 341))
+        # decoded at 1/4 scale rather than full size
+        self.assertEqual((stats['width'], stats['height']), (6000, 4000))
+        self.assertEqual((stats['decoded_width'], stats['decoded_height']), (1500, 1000))
+        self.assertLess(stats['estimated_pixel_memory'], 6000 * 4000)
+        self.assertNotIn('peak_rss', stats)
+
+        _, _, _, stats = process_image(jpeg, 'image/jpeg', 6000 * 4000, measure_memory=True)
+        if os.path.exists('/proc/self/clear_refs'):
+            # at least the decoded pixels are measured
+            self.assertGreater(stats['peak_rss_increase'], 1500 * 1000 * 3)
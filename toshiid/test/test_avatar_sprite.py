@@ -0,0 +1,96 @@
+import base64
+import blockies
+from io import BytesIO
+
+from tornado.escape import json_decode
+from tornado.testing import gen_test
+
+from toshiid.app import urls
+from toshiid.identicon import render_identicon_images
+from toshi.test.database import requires_database
+from toshi.test.base import AsyncHandlerTest
+
+from PIL import Image
+
+TEST_ADDRESS = "0x056db290f8ba3250ca64a45d16284d04bc6f5fbf"
+TEST_ADDRESS_2 = "0x056db290f8ba3250ca64a45d16284d04bc000000"
+TEST_ADDRESS_3 = "0x056db290f8ba3250ca64a45d16284d04bc111111"
+TEST_ADDRESS_4 = "0x056db290f8ba3250ca64a45d16284d04bc222222"
+TEST_PAYMENT_ADDRESS = "0x444433335555ffffaaaa222211119999ffff7777"
+
+class AvatarSpriteHandlerTest(AsyncHandlerTest):
+
+    def get_urls(self):
+        return urls
+
+    def fetch(self, url, **kwargs):
+        return super().fetch("/v2{}".format(url), **kwargs)
+
+    @gen_test
+    @requires_database
+    async def test_get_sprite(self):
+
+        avatar = blockies.create("avatar", size=8, scale=4)
+
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO users (username, toshi_id, avatar) VALUES ($1, $2, $3)",
+                              'user1', TEST_ADDRESS, "/avatar/{}.png".format(TEST_ADDRESS))
+            await con.execute("INSERT INTO avatars (toshi_id, img, hash, format) VALUES ($1, $2, $3, $4)",
+                              TEST_ADDRESS, avatar, 'hash', 'PNG')
+            await con.execute("INSERT INTO users (username, toshi_id, avatar) VALUES ($1, $2, $3)",
+                              'user2', TEST_ADDRESS_2, "https://s3.amazonaws.com/public/avatar/user2.png")
+            await con.execute("INSERT INTO users (username, toshi_id, avatar) VALUES ($1, $2, $3)",
+                              'user3', TEST_ADDRESS_3,
+                              "https://s3.amazonaws.com/public/identicon/{}.png".format(TEST_PAYMENT_ADDRESS))
+
+        resp = await self.fetch("/avatars/sprite?size=16&address={}&address={}&address={}&address={}".format(
+            TEST_ADDRESS, TEST_ADDRESS_2, TEST_ADDRESS_3, TEST_ADDRESS_4))
+        self.assertResponseCodeEqual(resp, 200)
+        body = json_decode(resp.body)
+
+        self.assertEqual(body['size'], 16)
+        self.assertEqual(body['urls'], {TEST_ADDRESS_2: "https://s3.amazonaws.com/public/avatar/user2.png"})
+        self.assertEqual(set(body['offsets'].keys()), {TEST_ADDRESS, TEST_ADDRESS_3, TEST_ADDRESS_4})
+
+        self.assertTrue(body['sprite'].startswith("data:image/png;base64,"))
+        sprite = Image.open(BytesIO(base64.b64decode(body['sprite'][22:])))
+        # 3 images are laid out in a 2x2 grid
+        self.assertEqual(sprite.size, (32, 32))
+
+        # the avatar's top left corner is copied into the sprite
+        expected = Image.open(BytesIO(avatar)).convert('RGBA').resize((16, 16), Image.LANCZOS)
+        offset = body['offsets'][TEST_ADDRESS]
+        self.assertEqual(sprite.getpixel((offset['x'], offset['y'])), expected.getpixel((0, 0)))
+
+    @gen_test
+    @requires_database
+    async def test_corrupt_avatar_uses_identicon(self):
+
+        avatar = blockies.create("avatar", size=8, scale=4)
+
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO users (username, toshi_id, avatar) VALUES ($1, $2, $3)",
+                              'user1', TEST_ADDRESS, "/avatar/{}.png".format(TEST_ADDRESS))
+            await con.execute("INSERT INTO avatars (toshi_id, img, hash, format) VALUES ($1, $2, $3, $4)",
+                              TEST_ADDRESS, avatar[:len(avatar) // 2], 'hash', 'PNG')
+
+        resp = await self.fetch("/avatars/sprite?size=16&address={}".format(TEST_ADDRESS))
+        self.assertResponseCodeEqual(resp, 200)
+        body = json_decode(resp.body)
+        self.assertEqual(body['offsets'], {TEST_ADDRESS: {'x': 0, 'y': 0}})
+
+        sprite = Image.open(BytesIO(base64.b64decode(body['sprite'][22:])))
+        expected = render_identicon_images([TEST_ADDRESS])[0].convert('RGBA').resize((16, 16), Image.LANCZOS)
+        self.assertEqual(sprite.getpixel((0, 0)), expected.getpixel((0, 0)))
+
+    @gen_test
+    async def test_bad_arguments(self):
+
+        resp = await self.fetch("/avatars/sprite")
+        self.assertResponseCodeEqual(resp, 400)
+        resp = await self.fetch("/avatars/sprite?address=bad")
+        self.assertResponseCodeEqual(resp, 400)
+        resp = await self.fetch("/avatars/sprite?address={}&size=10000".format(TEST_ADDRESS))
+        self.assertResponseCodeEqual(resp, 400)
+        resp = await self.fetch("/avatars/sprite?{}".format("&".join(["address={}".format(TEST_ADDRESS)] * 101)))
+        self.assertResponseCodeEqual(resp, 400)
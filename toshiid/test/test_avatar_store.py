@@ -0,0 +1,163 @@
+import base64
+import blockies
+import hashlib
+import os
+import shutil
+import tempfile
+from io import BytesIO
+
+from PIL import Image
+from tornado.escape import json_decode
+from tornado.testing import gen_test
+
+from toshiid.app import urls
+from toshiid.avatar_store import FilesystemAvatarStore
+from toshiid.migrate_avatars import migrate_avatars
+from toshi.test.database import requires_database
+from toshi.test.base import AsyncHandlerTest
+
+TEST_ADDRESS = "0x056db290f8ba3250ca64a45d16284d04bc6f5fbf"
+TEST_ADDRESS_2 = "0x056db290f8ba3250ca64a45d16284d04bc000000"
+
+class AvatarStoreTest(AsyncHandlerTest):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        super().setUp(extraconf={'general': {'avatar_store_dir': self.directory}})
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.directory)
+
+    def get_urls(self):
+        return urls
+
+    @gen_test
+    @requires_database
+    async def test_migrate_and_serve_avatars(self):
+
+        avatar = blockies.create(TEST_ADDRESS, size=8, scale=64)
+        avatar_hash = hashlib.md5(avatar).hexdigest()
+
+        async with self.pool.acquire() as con:
+            # two rows sharing the same image
+            for address in [TEST_ADDRESS, TEST_ADDRESS_2]:
+                await con.execute("INSERT INTO avatars (toshi_id, img, hash, format) VALUES ($1, $2, $3, $4)",
+                                  address, avatar, avatar_hash, 'PNG')
+
+        store = FilesystemAvatarStore(self.directory)
+        # by default the images are only copied
+        self.assertEqual(await migrate_avatars(store), 2)
+        async with self.pool.acquire() as con:
+            count = await con.fetchval("SELECT COUNT(*) FROM avatars WHERE img IS NOT NULL")
+        self.assertEqual(count, 2)
+
+        self.assertEqual(await migrate_avatars(store, batch_size=1, delete_from_db=True), 2)
+        self.assertEqual(await migrate_avatars(store, delete_from_db=True), 0)
+
+        async with self.pool.acquire() as con:
+            count = await con.fetchval("SELECT COUNT(*) FROM avatars WHERE img IS NOT NULL")
+        self.assertEqual(count, 0)
+        with open(store.path(avatar_hash, 'PNG'), 'rb') as f:
+            self.assertEqual(f.read(), avatar)
+        self.assertEqual(os.listdir(os.path.dirname(store.path(avatar_hash, 'PNG'))),
+                         [os.path.basename(store.path(avatar_hash, 'PNG'))])
+
+        resp = await self.fetch("/avatar/{}.png".format(TEST_ADDRESS))
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertEqual(resp.body, avatar)
+        self.assertEqual(resp.headers['Content-Type'], 'image/png')
+
+        resp = await self.fetch("/avatar/{}.png".format(TEST_ADDRESS), headers={
+            'If-None-Match': resp.headers['Etag']
+        })
+        self.assertResponseCodeEqual(resp, 304)
+
+        resp = await self.fetch("/avatar/{}.png".format(TEST_ADDRESS), method="HEAD")
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertEqual(resp.body, b'')
+
+    @gen_test
+    @requires_database
+    async def test_migrate_keeps_images_that_dont_match(self):
+
+        avatar = blockies.create(TEST_ADDRESS, size=8, scale=64)
+        avatar_hash = hashlib.md5(avatar).hexdigest()
+
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO avatars (toshi_id, img, hash, format) VALUES ($1, $2, $3, $4)",
+                              TEST_ADDRESS, avatar, avatar_hash, 'PNG')
+
+        # a file left behind with the wrong contents
+        store = FilesystemAvatarStore(self.directory)
+        store.write(avatar_hash, 'PNG', b'garbage')
+
+        self.assertEqual(await migrate_avatars(store, delete_from_db=True), 0)
+        async with self.pool.acquire() as con:
+            img = await con.fetchval("SELECT img FROM avatars WHERE toshi_id = $1", TEST_ADDRESS)
+        self.assertEqual(img, avatar)
+
+    @gen_test
+    @requires_database
+    async def test_identicons_stored_in_filesystem(self):
+
+        resp = await self.fetch("/identicon/{}.png".format(TEST_ADDRESS))
+        self.assertResponseCodeEqual(resp, 200)
+
+        async with self.pool.acquire() as con:
+            row = await con.fetchrow("SELECT * FROM avatars WHERE toshi_id = $1",
+                                     "{}_identicon_PNG".format(TEST_ADDRESS))
+        self.assertIsNotNone(row)
+        self.assertIsNone(row['img'])
+        with open(FilesystemAvatarStore(self.directory).path(row['hash'], 'PNG'), 'rb') as f:
+            self.assertEqual(f.read(), resp.body)
+
+    @gen_test
+    @requires_database
+    async def test_broken_stored_identicons_are_replaced(self):
+
+        resp = await self.fetch("/identicon/{}.png".format(TEST_ADDRESS))
+        self.assertResponseCodeEqual(resp, 200)
+        identicon = resp.body
+
+        async with self.pool.acquire() as con:
+            row = await con.fetchrow("SELECT * FROM avatars WHERE toshi_id = $1",
+                                     "{}_identicon_PNG".format(TEST_ADDRESS))
+        path = FilesystemAvatarStore(self.directory).path(row['hash'], 'PNG')
+
+        # an empty file can't be mapped, and a truncated one doesn't match its hash
+        for data in [b'', identicon[:len(identicon) // 2]]:
+            with open(path, 'wb') as f:
+                f.write(data)
+            # make sure the identicon is read from the store again
+            self._app.identicon_cache = None
+
+            resp = await self.fetch("/identicon/{}.png".format(TEST_ADDRESS))
+            self.assertResponseCodeEqual(resp, 200)
+            self.assertEqual(resp.body, identicon)
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), identicon)
+
+    @gen_test
+    @requires_database
+    async def test_sprite_includes_stored_avatars(self):
+
+        avatar = blockies.create(TEST_ADDRESS, size=8, scale=4)
+        avatar_hash = hashlib.md5(avatar).hexdigest()
+        FilesystemAvatarStore(self.directory).write(avatar_hash, 'PNG', avatar)
+
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO users (username, toshi_id, avatar) VALUES ($1, $2, $3)",
+                              'user1', TEST_ADDRESS, "/avatar/{}_{}.png".format(TEST_ADDRESS, avatar_hash))
+            await con.execute("INSERT INTO avatars (toshi_id, hash, format) VALUES ($1, $2, $3)",
+                              TEST_ADDRESS, avatar_hash, 'PNG')
+
+        resp = await self.fetch("/v2/avatars/sprite?size=16&address={}".format(TEST_ADDRESS))
+        self.assertResponseCodeEqual(resp, 200)
+        body = json_decode(resp.body)
+        self.assertEqual(body['urls'], {})
+        self.assertEqual(body['offsets'], {TEST_ADDRESS: {'x': 0, 'y': 0}})
+
+        sprite = Image.open(BytesIO(base64.b64decode(body['sprite'][22:])))
+        expected = Image.open(BytesIO(avatar)).convert('RGBA').resize((16, 16), Image.LANCZOS)
+        self.assertEqual(sprite.getpixel((0, 0)), expected.getpixel((0, 0)))
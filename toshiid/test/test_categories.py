@@ -260,3 +260,32 @@ class AppCategoriesTest(AsyncHandlerTest):
         body = json_decode(resp.body)
         self.assertIn("results", body)
         self.assertEqual(len(body["results"]), 2)
+
+    @gen_test
+    @requires_database
+    async def test_user_category_ids_are_maintained(self):
+
+        await self.setup_categories()
+
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO users (username, toshi_id, name, is_bot, is_public) VALUES ($1, $2, $3, true, true)",
+                              "toshibot", TEST_ADDRESS, "ToshiBot")
+            await con.executemany("INSERT INTO bot_categories VALUES ($1, $2)",
+                                  [(4, TEST_ADDRESS),
+                                   (2, TEST_ADDRESS)])
+            category_ids = await con.fetchval("SELECT category_ids FROM users WHERE toshi_id = $1", TEST_ADDRESS)
+        self.assertEqual(category_ids, [2, 4])
+
+        resp = await self.fetch_signed("/user", signing_key=TEST_PRIVATE_KEY, method="PUT", body={
+            "categories": [1, "cat3"]
+        })
+        self.assertResponseCodeEqual(resp, 200)
+
+        async with self.pool.acquire() as con:
+            category_ids = await con.fetchval("SELECT category_ids FROM users WHERE toshi_id = $1", TEST_ADDRESS)
+        self.assertEqual(category_ids, [1, 3])
+
+        async with self.pool.acquire() as con:
+            await con.execute("DELETE FROM categories WHERE category_id = 1")
+            category_ids = await con.fetchval("SELECT category_ids FROM users WHERE toshi_id = $1", TEST_ADDRESS)
+        self.assertEqual(category_ids, [3])
@@ -0,0 +1,54 @@
+from tornado.testing import gen_test
+
+from toshiid.app import urls
+from toshiid.database import RequestDatabaseContext
+from toshi.test.database import requires_database
+from toshi.test.base import AsyncHandlerTest
+
+TEST_ADDRESS = "0x056db290f8ba3250ca64a45d16284d04bc6f5fbf"
+
+class RequestDatabaseContextTest(AsyncHandlerTest):
+
+    def get_urls(self):
+        return urls
+
+    @gen_test
+    @requires_database
+    async def test_connection_reused_between_blocks(self):
+
+        db = RequestDatabaseContext()
+
+        async with db:
+            connection = db.connection
+            await db.execute("INSERT INTO users (toshi_id, username) VALUES ($1, $2)", TEST_ADDRESS, 'BobSmith')
+            # not committed
+
+        async with db:
+            self.assertIs(db.connection, connection)
+            self.assertIsNone(await db.fetchrow("SELECT * FROM users WHERE toshi_id = $1", TEST_ADDRESS))
+            await db.execute("INSERT INTO users (toshi_id, username) VALUES ($1, $2)", TEST_ADDRESS, 'BobSmith')
+            await db.commit()
+
+        await db.release()
+        self.assertIsNone(db.connection)
+
+        async with self.pool.acquire() as con:
+            row = await con.fetchrow("SELECT * FROM users WHERE toshi_id = $1", TEST_ADDRESS)
+        self.assertIsNotNone(row)
+        self.assertEqual(row['username'], 'BobSmith')
+
+    @gen_test
+    @requires_database
+    async def test_release_is_idempotent_and_waits_for_blocks(self):
+
+        db = RequestDatabaseContext()
+
+        async with db:
+            await db.release()
+            # still usable until the block exits
+            self.assertIsNotNone(db.connection)
+            self.assertEqual(await db.fetchval("SELECT 1"), 1)
+        self.assertIsNone(db.connection)
+
+        await db.release()
+        self.assertIsNone(db.connection)
@@ -1,6 +1,14 @@
+import hashlib
+import os
+import tempfile
+import unittest
+
+import blockies
 from tornado.testing import gen_test
 
 from toshiid.app import urls
+from toshiid.housekeeping import HousekeepingApplication
+from toshiid.identicon import IdenticonCache, render_identicons
 from toshi.test.database import requires_database
 from toshi.test.base import AsyncHandlerTest
 
@@ -46,3 +54,116 @@ class UserAvatarHandlerTest(AsyncHandlerTest):
             'If-Modified-Since': last_modified
         })
         self.assertResponseCodeEqual(resp, 304)
+
+    @gen_test
+    @requires_database
+    async def test_svg_identicon(self):
+
+        resp = await self.fetch("/identicon/{}.svg".format(TEST_ADDRESS), method="GET")
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertEqual(resp.headers['Content-Type'], 'image/svg+xml')
+        self.assertTrue(resp.body.startswith(b'<svg '))
+        self.assertEqual(resp.body, render_identicons([TEST_ADDRESS], 'SVG')[0])
+
+        async with self.pool.acquire() as con:
+            count = await con.fetchval("SELECT COUNT(*) FROM avatars")
+        self.assertEqual(count, 0)
+
+class IdenticonCacheOnlyTest(AsyncHandlerTest):
+
+    def setUp(self):
+        super().setUp(extraconf={'general': {'identicon_cache_only': True}})
+
+    def get_urls(self):
+        return urls
+
+    @gen_test
+    @requires_database
+    async def test_identicon_not_stored(self):
+
+        resp = await self.fetch("/identicon/{}.png".format(TEST_ADDRESS), method="GET")
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertEqual(resp.body, blockies.create(TEST_ADDRESS, size=8, scale=12, format='PNG'))
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        self.assertIn(hashlib.md5(resp.body).hexdigest(), resp.headers['Etag'])
+
+        async with self.pool.acquire() as con:
+            count = await con.fetchval("SELECT COUNT(*) FROM avatars")
+        self.assertEqual(count, 0)
+
+        resp = await self.fetch("/identicon/{}.png".format(TEST_ADDRESS), method="GET", headers={
+            'If-None-Match': resp.headers['Etag']
+        })
+        self.assertResponseCodeEqual(resp, 304)
+
+    @gen_test
+    @requires_database
+    async def test_cleanup_stored_identicons(self):
+
+        async with self.pool.acquire() as con:
+            for i in range(5):
+                await con.execute("INSERT INTO avatars (toshi_id, img, hash, format) VALUES ($1, $2, $3, $4)",
+                                  "0x{:040x}_identicon_PNG".format(i), b'', 'hash', 'PNG')
+            await con.execute("INSERT INTO avatars (toshi_id, img, hash, format) VALUES ($1, $2, $3, $4)",
+                              TEST_ADDRESS, b'', 'hash', 'PNG')
+
+        housekeeping = HousekeepingApplication()
+        self.assertTrue(housekeeping._cleanup_identicons)
+        await housekeeping.cleanup_identicons()
+        # nothing to clean up the second time
+        await housekeeping.cleanup_identicons()
+        self.assertFalse(housekeeping._cleanup_identicons)
+
+        async with self.pool.acquire() as con:
+            rows = await con.fetch("SELECT toshi_id FROM avatars")
+        self.assertEqual([row['toshi_id'] for row in rows], [TEST_ADDRESS])
+
+class IdenticonCacheTest(AsyncHandlerTest):
+
+    def get_urls(self):
+        return urls
+
+    @gen_test
+    async def test_memory_and_disk_tiers(self):
+
+        expected = blockies.create(TEST_ADDRESS, size=8, scale=12, format='PNG')
+
+        with tempfile.TemporaryDirectory() as directory:
+
+            cache = IdenticonCache(len(expected), directory)
+            self.assertIsNone(await cache.lookup(TEST_ADDRESS, 'PNG'))
+
+            identicon = await cache.render(TEST_ADDRESS, 'PNG')
+            self.assertEqual(identicon.data, expected)
+            self.assertEqual(cache.stats()['renders'], 1)
+            self.assertEqual(cache.stats()['misses'], 1)
+            self.assertEqual((await cache.lookup(TEST_ADDRESS, 'PNG')).data, expected)
+            self.assertEqual(cache.stats()['hits'], 1)
+
+            await cache.get(TEST_ADDRESS, 'JPEG')
+            self.assertEqual(cache.stats()['renders'], 2)
+            self.assertEqual(cache.stats()['misses'], 2)
+
+            # a fresh cache sharing the directory doesn't need to render
+            cache = IdenticonCache(0, directory)
+            identicon = await cache.lookup(TEST_ADDRESS, 'PNG')
+            self.assertEqual(identicon.data, expected)
+            self.assertEqual((await cache.get(TEST_ADDRESS, 'JPEG')).data,
+                             blockies.create(TEST_ADDRESS, size=8, scale=12, format='JPEG'))
+            self.assertEqual(cache.stats()['renders'], 0)
+            self.assertEqual(cache.stats()['disk_hits'], 2)
+
+            # already rendered addresses are skipped
+            self.assertEqual(cache.render_many([TEST_ADDRESS, "0x" + "0" * 40], 'PNG'), 1)
+
+class RenderIdenticonsTest(unittest.TestCase):
+
+    def test_matches_blockies(self):
+
+        addresses = [TEST_ADDRESS, TEST_ADDRESS.upper(), "0x" + "0" * 40, "short"] + \
+                    ["0x" + os.urandom(20).hex() for _ in range(100)]
+        for format in ['PNG', 'JPEG']:
+            rendered = render_identicons(addresses, format)
+            for address, data in zip(addresses, rendered):
+                self.assertEqual(data, blockies.create(address, size=8, scale=12, format=format),
+                                 "{} {}".format(address, format))
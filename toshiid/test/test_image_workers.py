@@ -0,0 +1,72 @@
+import asyncio
+import os
+import time
+
+from tornado.testing import gen_test
+
+from toshiid.app import urls
+from toshiid.image_workers import ImageWorkerPool, ImageWorkersBusy, BrokenProcessPool
+from toshi.test.base import AsyncHandlerTest
+
+def exit_worker():
+    os._exit(1)
+
+class ImageWorkerPoolTest(AsyncHandlerTest):
+
+    def get_urls(self):
+        return urls
+
+    @gen_test(timeout=30)
+    async def test_run_in_worker_process(self):
+
+        pool = ImageWorkerPool(1)
+        try:
+            self.assertEqual(await pool.run(pow, 2, 10), 1024)
+            with self.assertRaises(ValueError):
+                await pool.run(int, 'not a number')
+
+            stats = pool.stats()
+            self.assertEqual(stats['completed'], 1)
+            self.assertEqual(stats['failed'], 1)
+            self.assertEqual(stats['queue_depth'], 0)
+        finally:
+            pool.shutdown()
+
+    @gen_test(timeout=30)
+    async def test_rejects_when_queue_is_full(self):
+
+        pool = ImageWorkerPool(1, max_queue_size=1)
+        try:
+            running = asyncio.ensure_future(pool.run(time.sleep, 1))
+            queued = asyncio.ensure_future(pool.run(time.sleep, 0))
+            await asyncio.sleep(0.1)
+            self.assertEqual(pool.queue_depth, 1)
+
+            with self.assertRaises(ImageWorkersBusy):
+                await pool.run(time.sleep, 0)
+
+            await asyncio.wait([running, queued])
+            stats = pool.stats()
+            self.assertEqual(stats['completed'], 2)
+            self.assertEqual(stats['rejected'], 1)
+            # the queued task had to wait for the running one
+            self.assertGreater(stats['max_queue_time'], 0.5)
+            self.assertGreater(stats['max_run_time'], 0.5)
+        finally:
+            pool.shutdown()
+
+    @gen_test(timeout=30)
+    async def test_restarts_after_worker_dies(self):
+
+        pool = ImageWorkerPool(1)
+        try:
+            with self.assertRaises(BrokenProcessPool):
+                await pool.run(exit_worker)
+            self.assertEqual(await pool.run(pow, 2, 10), 1024)
+
+            stats = pool.stats()
+            self.assertEqual(stats['failed'], 1)
+            self.assertEqual(stats['completed'], 1)
+            self.assertEqual(stats['restarts'], 1)
+        finally:
+            pool.shutdown()
@@ -0,0 +1,62 @@
+import asyncio
+
+from tornado.escape import json_decode
+from tornado.testing import gen_test
+
+from toshiid.app import urls
+from toshiid.invalidation import InvalidationListener
+from toshi.test.database import requires_database
+from toshi.test.base import AsyncHandlerTest
+
+TEST_ADDRESS = "0x056db290f8ba3250ca64a45d16284d04bc6f5fbf"
+
+class InvalidationListenerTest(AsyncHandlerTest):
+
+    def setUp(self):
+        super().setUp(extraconf={'general': {'user_cache_size': 100, 'user_cache_ttl': 60}})
+
+    def get_urls(self):
+        return urls
+
+    def get_url(self, path):
+        path = "/v1{}".format(path)
+        return super().get_url(path)
+
+    @gen_test
+    @requires_database
+    async def test_external_changes_evict_cache(self):
+
+        listener = self._app.invalidation_listener = InvalidationListener()
+        listener.start()
+        await listener.wait_until_listening()
+
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO users (username, toshi_id, name, is_bot) VALUES ($1, $2, $3, $4)",
+                              'ToshiBot', TEST_ADDRESS, 'Toshi Bot', True)
+            await con.execute("INSERT INTO categories (category_id, tag) VALUES ($1, $2)", 1, 'cat1')
+            await con.execute("INSERT INTO category_names (category_id, name) VALUES ($1, $2)", 1, 'Category 1')
+
+        resp = await self.fetch("/user/{}".format(TEST_ADDRESS))
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertEqual(json_decode(resp.body)['name'], 'Toshi Bot')
+        self.assertIsNotNone(self._app.user_cache.get_by_toshi_id(TEST_ADDRESS))
+
+        # simulate a change made by a different process
+        async with self.pool.acquire() as con:
+            await con.execute("UPDATE users SET name = $1 WHERE toshi_id = $2", 'Toshi Bot 2', TEST_ADDRESS)
+        await asyncio.sleep(0.1)
+
+        self.assertIsNone(self._app.user_cache.get_by_toshi_id(TEST_ADDRESS))
+        resp = await self.fetch("/user/{}".format(TEST_ADDRESS))
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertEqual(json_decode(resp.body)['name'], 'Toshi Bot 2')
+
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO bot_categories VALUES ($1, $2)", 1, TEST_ADDRESS)
+        await asyncio.sleep(0.1)
+
+        resp = await self.fetch("/user/{}".format(TEST_ADDRESS))
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertEqual(len(json_decode(resp.body)['categories']), 1)
+
+        listener.shutdown()
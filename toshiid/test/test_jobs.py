@@ -0,0 +1,82 @@
+from tornado.escape import json_decode
+from tornado.testing import gen_test
+
+from toshiid.app import urls
+from toshiid.jobs import JobWorker, enqueue_jobs
+from toshi.test.database import requires_database
+from toshi.test.base import AsyncHandlerTest
+
+class JobWorkerTest(AsyncHandlerTest):
+
+    def get_urls(self):
+        return urls
+
+    @gen_test
+    @requires_database
+    async def test_jobs_are_run_and_retried(self):
+
+        ran = []
+
+        async def succeed(value):
+            ran.append(value)
+
+        async def fail(value):
+            raise Exception("failed {}".format(value))
+
+        async with self.pool.acquire() as con:
+            async with con.transaction():
+                await enqueue_jobs(con, [('succeed', {'value': 1}), ('fail', {'value': 2}), ('succeed', {'value': 3})])
+
+        worker = JobWorker({'succeed': succeed, 'fail': fail}, max_attempts=2)
+        self.assertEqual(await worker.run_pending(), 3)
+        self.assertEqual(sorted(ran), [1, 3])
+
+        async with self.pool.acquire() as con:
+            jobs = await con.fetch("SELECT * FROM jobs")
+        self.assertEqual(len(jobs), 1)
+        self.assertEqual(jobs[0]['kind'], 'fail')
+        self.assertEqual(json_decode(jobs[0]['payload']), {'value': 2})
+        self.assertEqual(jobs[0]['attempts'], 1)
+        self.assertFalse(jobs[0]['failed'])
+        self.assertEqual(jobs[0]['last_error'], "failed 2")
+
+        # not due again until the backoff has passed
+        self.assertEqual(await worker.run_pending(), 0)
+
+        async with self.pool.acquire() as con:
+            await con.execute("UPDATE jobs SET run_at = (now() AT TIME ZONE 'utc')")
+        self.assertEqual(await worker.run_pending(), 1)
+
+        async with self.pool.acquire() as con:
+            job = await con.fetchrow("SELECT * FROM jobs")
+        self.assertEqual(job['attempts'], 2)
+        self.assertTrue(job['failed'])
+
+        async with self.pool.acquire() as con:
+            await con.execute("UPDATE jobs SET run_at = (now() AT TIME ZONE 'utc')")
+        self.assertEqual(await worker.run_pending(), 0)
+
+    @gen_test
+    @requires_database
+    async def test_claimed_jobs_are_leased(self):
+
+        async def succeed():
+            pass
+
+        async with self.pool.acquire() as con:
+            await enqueue_jobs(con, [('succeed', {})])
+
+        worker = JobWorker({'succeed': succeed}, lease_time=60)
+        # a worker that died after claiming the job
+        jobs = await worker.claim_jobs()
+        self.assertEqual(len(jobs), 1)
+        self.assertEqual(jobs[0]['attempts'], 1)
+
+        self.assertEqual(await worker.run_pending(), 0)
+
+        async with self.pool.acquire() as con:
+            await con.execute("UPDATE jobs SET locked_until = (now() AT TIME ZONE 'utc')")
+        self.assertEqual(await worker.run_pending(), 1)
+
+        async with self.pool.acquire() as con:
+            self.assertEqual(await con.fetchval("SELECT COUNT(*) FROM jobs"), 0)
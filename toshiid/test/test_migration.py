@@ -0,0 +1,84 @@
+import asyncio
+
+from tornado.escape import json_decode
+from tornado.testing import gen_test
+from tornado.web import RequestHandler
+
+from toshiid.migration import MigrationNotifier
+from toshi.test.base import AsyncHandlerTest
+
+TEST_ADDRESS = "0x056db290f8ba3250ca64a45d16284d04bc6f5fbf"
+TEST_ADDRESS_2 = "0x7f0294b53af29ded2b5fa04b6225a1bc334a41e6"
+
+class WalletStandInHandler(RequestHandler):
+
+    def initialize(self, received, failures):
+        self.received = received
+        self.failures = failures
+
+    def post(self):
+        if self.failures:
+            self.failures.pop()
+            self.set_status(503)
+            return
+        self.received.append((self.request.headers.get('Authorization'), json_decode(self.request.body)))
+
+class MigrationNotifierTest(AsyncHandlerTest):
+
+    def setUp(self):
+        self.received = []
+        self.failures = []
+        super().setUp()
+
+    def get_urls(self):
+        return [(r"^/migrate/?$", WalletStandInHandler, {'received': self.received, 'failures': self.failures})]
+
+    @gen_test
+    async def test_notify_dedupes_and_retries(self):
+
+        now = [0]
+        notifier = MigrationNotifier(self.get_url("/migrate"), username="user", password="pass",
+                                     dedupe_window=60, retry_delay=0.01, timer=lambda: now[0])
+        self.failures.extend([True, True])
+
+        self.assertTrue(notifier.notify(TEST_ADDRESS))
+        self.assertFalse(notifier.notify(TEST_ADDRESS))
+        await notifier.flush()
+
+        self.assertEqual(len(self.received), 1)
+        self.assertEqual(self.received[0][1], {'toshiId': TEST_ADDRESS})
+        self.assertTrue(self.received[0][0].startswith('Basic '))
+        stats = notifier.stats()
+        self.assertEqual(stats['sent'], 1)
+        self.assertEqual(stats['retries'], 2)
+        self.assertEqual(stats['deduped'], 1)
+        self.assertEqual(stats['queue_depth'], 0)
+
+        # allowed again once the window has passed
+        now[0] = 61
+        self.assertTrue(notifier.notify(TEST_ADDRESS))
+        await notifier.flush()
+        self.assertEqual(len(self.received), 2)
+
+        notifier.shutdown()
+
+    @gen_test
+    async def test_queue_limit_and_batching(self):
+
+        notifier = MigrationNotifier(self.get_url("/migrate"), max_queue_size=1, batch_size=10)
+
+        self.assertTrue(notifier.notify(TEST_ADDRESS))
+        self.assertFalse(notifier.notify(TEST_ADDRESS_2))
+        self.assertEqual(notifier.stats()['dropped'], 1)
+        await notifier.flush()
+
+        self.assertEqual(self.received, [(None, {'toshiIds': [TEST_ADDRESS]})])
+        notifier.shutdown()
+
+        notifier = MigrationNotifier(self.get_url("/migrate"), batch_size=10)
+        notifier.notify(TEST_ADDRESS)
+        notifier.notify(TEST_ADDRESS_2)
+        await notifier.flush()
+        self.assertEqual(self.received[1], (None, {'toshiIds': [TEST_ADDRESS, TEST_ADDRESS_2]}))
+
+        notifier.shutdown()
@@ -0,0 +1,91 @@
+import os
+import unittest
+
+from tornado.escape import json_decode, json_encode
+from tornado.testing import gen_test
+
+from toshiid.app import urls
+from toshiid.serialization import JSONFragment, UserJSONCache, encode_json
+from toshi.test.database import requires_database
+from toshi.test.base import AsyncHandlerTest
+from toshi.ethereum.utils import data_encoder
+
+class EncodeJSONTest(unittest.TestCase):
+
+    def test_matches_json_encode(self):
+
+        data = {'a': [1, None, "</script>"], 'b': {'c': True, 'd': 1.5, 'é': "ü"}}
+        self.assertEqual(encode_json(data), json_encode(data).encode('utf-8'))
+
+    def test_fragments_are_spliced(self):
+
+        fragment = JSONFragment(json_encode({'name': 'Bob'}).encode('utf-8'))
+        self.assertEqual(json_decode(encode_json({'results': [fragment, None]})),
+                         {'results': [{'name': 'Bob'}, None]})
+
+    def test_stale_rows_miss(self):
+
+        cache = UserJSONCache(10)
+        row = {'toshi_id': '0x1', 'updated': 1}
+        cache.put(row, (2,), JSONFragment(b'{}'))
+        self.assertEqual(cache.get(row, (2,)), b'{}')
+        self.assertIsNone(cache.get(row, (1,)))
+        self.assertIsNone(cache.get({'toshi_id': '0x1', 'updated': 2}, (2,)))
+
+        cache.evict('0x1')
+        self.assertIsNone(cache.get(row, (2,)))
+
+    def test_variants_are_capped(self):
+
+        cache = UserJSONCache(10, max_variants=2)
+        row = {'toshi_id': '0x1', 'updated': 1}
+        for host in ['a', 'b', 'c']:
+            cache.put(row, (1, 'http', host), JSONFragment(host.encode('utf-8')))
+        self.assertIsNone(cache.get(row, (1, 'http', 'a')))
+        self.assertEqual(cache.get(row, (1, 'http', 'b')), b'b')
+        self.assertEqual(cache.get(row, (1, 'http', 'c')), b'c')
+
+class UserJSONCacheHandlerTest(AsyncHandlerTest):
+
+    def setUp(self):
+        super().setUp(extraconf={'general': {'user_json_cache_size': 100}})
+
+    def get_urls(self):
+        return urls
+
+    @gen_test
+    @requires_database
+    async def test_search_uses_cached_json(self):
+
+        users = [(data_encoder(os.urandom(20)), "user{}".format(i), "User {}".format(i)) for i in range(5)]
+
+        async with self.pool.acquire() as con:
+            await con.executemany("INSERT INTO users (toshi_id, username, name) VALUES ($1, $2, $3)", users)
+
+        query = "&".join("toshi_id={}".format(toshi_id) for toshi_id, _, _ in users)
+
+        resp = await self.fetch("/v2/search?{}".format(query))
+        self.assertResponseCodeEqual(resp, 200)
+        first = json_decode(resp.body)
+        self.assertEqual([user['name'] for user in first['results']], [name for _, _, name in users])
+        self.assertEqual(len(self._app.user_json_cache.users), len(users))
+
+        resp = await self.fetch("/v2/search?{}".format(query))
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertEqual(json_decode(resp.body), first)
+        self.assertEqual(self._app.user_json_cache.stats()['hits'], len(users))
+
+        # v1 json is cached separately
+        resp = await self.fetch("/v1/search/user?{}".format(query))
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertEqual([user['username'] for user in json_decode(resp.body)['results']],
+                         [username for _, username, _ in users])
+        self.assertTrue(json_decode(resp.body)['results'][0]['avatar'].startswith('http'))
+
+        # changes to the row are picked up
+        async with self.pool.acquire() as con:
+            await con.execute("UPDATE users SET name = $1 WHERE toshi_id = $2", "Changed", users[0][0])
+
+        resp = await self.fetch("/v2/search?{}".format(query))
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertEqual(json_decode(resp.body)['results'][0]['name'], "Changed")
@@ -0,0 +1,22 @@
+from tornado.web import Application
+
+from toshiid.cache import UserCache
+from toshiid.stats import StatsLogger, app_stats_source
+from toshi.test.base import AsyncHandlerTest
+
+class StatsLoggerTest(AsyncHandlerTest):
+
+    def get_urls(self):
+        return []
+
+    def test_collect(self):
+
+        app = Application()
+        stats_logger = StatsLogger()
+        stats_logger.add_source('user_cache', app_stats_source(app, 'user_cache'))
+        # left out until the cache is created
+        self.assertEqual(stats_logger.collect(), {})
+
+        app.user_cache = UserCache(10)
+        app.user_cache.get_by_toshi_id("0x0000000000000000000000000000000000000000")
+        self.assertEqual(stats_logger.collect()['user_cache']['rows']['misses'], 1)
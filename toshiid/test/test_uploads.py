@@ -0,0 +1,105 @@
+import time
+import unittest
+from unittest import mock
+
+from tornado.httputil import HTTPHeaders, HTTPServerRequest, parse_multipart_form_data
+from tornado.web import Application, RequestHandler
+
+from toshiid.uploads import (MultipartStreamParser, MultipartError, keccak_256, parse_header,
+                             verify_request_signature)
+from toshi.errors import JSONHTTPError
+from toshi.ethereum.utils import data_decoder
+from toshi.handlers import RequestVerificationMixin
+from toshi.request import sign_request
+
+TEST_PRIVATE_KEY = data_decoder("0xe8f32e723decf4051aefac8e2c93c9c5b214313817cdb01a1494b917c8436b35")
+TEST_ADDRESS = "0x056db290f8ba3250ca64a45d16284d04bc6f5fbf"
+
+BOUNDARY = "1234567890abcdef"
+
+BODY = (b'preamble\r\n'
+        b'--1234567890abcdef\r\n'
+        b'Content-Disposition: form-data; name="avatar"; filename="avatar.png"\r\n'
+        b'Content-Type: image/png\r\n'
+        b'\r\n'
+        b'\x89PNG\r\n--1234567890abcde\r\n\r\n'
+        b'\r\n--1234567890abcdef\r\n'
+        b'Content-Disposition: form-data; name="field"\r\n'
+        b'\r\n'
+        b'value'
+        b'\r\n--1234567890abcdef--\r\n')
+
+class MultipartStreamParserTest(unittest.TestCase):
+
+    def test_parse_in_chunks(self):
+
+        arguments = {}
+        files = {}
+        parse_multipart_form_data(BOUNDARY.encode('latin1'), BODY, arguments, files)
+
+        for chunk_size in [1, 2, 7, 64, len(BODY)]:
+            received = []
+            parser = MultipartStreamParser('"{}"'.format(BOUNDARY),
+                                           on_file_data=lambda file, data, offset: received.append((offset, data)))
+            for i in range(0, len(BODY), chunk_size):
+                parser.feed(BODY[i:i + chunk_size])
+            parser.finish()
+
+            self.assertEqual(parser.arguments, arguments)
+            self.assertEqual(list(parser.files.keys()), ['avatar'])
+            file = parser.files['avatar'][0]
+            self.assertEqual(file.filename, 'avatar.png')
+            self.assertEqual(file.content_type, 'image/png')
+            self.assertEqual(file.body.read(), files['avatar'][0].body)
+            self.assertEqual(b''.join(data for _, data in received), files['avatar'][0].body)
+            self.assertEqual(received[0][0], 0)
+            parser.close()
+
+    def test_incomplete_body(self):
+
+        parser = MultipartStreamParser(BOUNDARY)
+        parser.feed(BODY[:-10])
+        with self.assertRaises(MultipartError):
+            parser.finish()
+
+    def test_parse_header(self):
+
+        self.assertEqual(parse_header('form-data; name="avatar"; filename="a \\"b\\".png"'),
+                         ('form-data', {'name': 'avatar', 'filename': 'a "b".png'}))
+        self.assertEqual(parse_header('multipart/form-data; boundary=----abc'),
+                         ('multipart/form-data', {'boundary': '----abc'}))
+        self.assertEqual(parse_header(''), ('', {}))
+
+class SignedHandler(RequestVerificationMixin, RequestHandler):
+    pass
+
+class VerifyRequestSignatureTest(unittest.TestCase):
+
+    def verify(self, body, signed_body):
+        """Returns the results of verifying the request with the library's
+        verify_request and with verify_request_signature"""
+
+        timestamp = int(time.time())
+        headers = HTTPHeaders({
+            'Content-Type': 'multipart/form-data; boundary={}'.format(BOUNDARY),
+            'Toshi-ID-Address': TEST_ADDRESS,
+            'Toshi-Signature': sign_request(TEST_PRIVATE_KEY, "PUT", "/v1/user", timestamp, signed_body),
+            'Toshi-Timestamp': str(timestamp)
+        })
+        request = HTTPServerRequest("PUT", "/v1/user", headers=headers, body=body, connection=mock.Mock())
+        body_hash = keccak_256()
+        body_hash.update(body)
+
+        results = []
+        for verify in [SignedHandler(Application(), request).verify_request,
+                       lambda: verify_request_signature(request, body_hash.digest() if body else None)]:
+            try:
+                results.append(verify())
+            except JSONHTTPError as e:
+                results.append(e.status_code)
+        return results
+
+    def test_matches_library(self):
+
+        self.assertEqual(self.verify(BODY, BODY), [TEST_ADDRESS, TEST_ADDRESS])
+        self.assertEqual(self.verify(BODY, BODY + b'\r\n'), [400, 400])
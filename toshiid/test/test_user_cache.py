@@ -0,0 +1,169 @@
+import unittest
+
+from tornado.escape import json_decode
+from tornado.testing import gen_test
+
+from toshiid.app import urls
+from toshiid.cache import LRUCache, UserCache
+from toshi.test.database import requires_database
+from toshi.test.base import AsyncHandlerTest
+from toshi.ethereum.utils import data_decoder
+from toshi.config import config
+
+TEST_PRIVATE_KEY = data_decoder("0xe8f32e723decf4051aefac8e2c93c9c5b214313817cdb01a1494b917c8436b35")
+TEST_ADDRESS = "0x056db290f8ba3250ca64a45d16284d04bc6f5fbf"
+
+TEST_ADDRESS_2 = "0x056db290f8ba3250ca64a45d16284d04bc000000"
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_lru_eviction(self):
+
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats()['hits'], 3)
+        self.assertEqual(cache.stats()['misses'], 1)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_ttl_expiry(self):
+
+        now = [0]
+        cache = LRUCache(10, ttl=5, timer=lambda: now[0])
+        cache.set('a', 1)
+        now[0] = 4
+        self.assertEqual(cache.get('a'), 1)
+        now[0] = 5
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_disabled(self):
+
+        cache = LRUCache(0)
+        cache.set('a', 1)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+    def test_username_lookup_follows_renames(self):
+
+        cache = UserCache(10)
+        cache.put({'toshi_id': TEST_ADDRESS, 'username': 'BobSmith'})
+        self.assertIsNotNone(cache.get_by_username('bobsmith'))
+
+        cache.evict(TEST_ADDRESS)
+        self.assertIsNone(cache.get_by_username('bobsmith'))
+
+        cache.put({'toshi_id': TEST_ADDRESS, 'username': 'JamesSmith'})
+        self.assertIsNone(cache.get_by_username('bobsmith'))
+        self.assertIsNotNone(cache.get_by_username('jamessmith'))
+
+    def test_put_after_eviction_is_dropped(self):
+
+        cache = UserCache(1)
+        generation = cache.generation()
+        cache.evict(TEST_ADDRESS)
+        cache.put({'toshi_id': TEST_ADDRESS, 'username': 'BobSmith'}, generation)
+        self.assertIsNone(cache.get_by_toshi_id(TEST_ADDRESS))
+
+        # other users aren't affected
+        cache.put({'toshi_id': TEST_ADDRESS_2, 'username': 'JamesSmith'}, generation)
+        self.assertIsNotNone(cache.get_by_toshi_id(TEST_ADDRESS_2))
+
+        # once the eviction is forgotten, older generations are dropped
+        cache.evict(TEST_ADDRESS_2)
+        cache.put({'toshi_id': TEST_ADDRESS, 'username': 'BobSmith'}, generation)
+        self.assertIsNone(cache.get_by_toshi_id(TEST_ADDRESS))
+
+        generation = cache.generation()
+        cache.clear()
+        cache.put({'toshi_id': TEST_ADDRESS, 'username': 'BobSmith'}, generation)
+        self.assertIsNone(cache.get_by_toshi_id(TEST_ADDRESS))
+
+        generation = cache.generation()
+        cache.put({'toshi_id': TEST_ADDRESS, 'username': 'BobSmith'}, generation)
+        self.assertIsNotNone(cache.get_by_toshi_id(TEST_ADDRESS))
+
+class UserCacheHandlerTest(AsyncHandlerTest):
+
+    def setUp(self):
+        super().setUp(extraconf={'general': {'user_cache_size': 100, 'user_cache_ttl': 60}})
+
+    def get_urls(self):
+        return urls
+
+    def get_url(self, path):
+        path = "/v1{}".format(path)
+        return super().get_url(path)
+
+    @gen_test
+    @requires_database
+    async def test_get_user_is_cached(self):
+
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO users (username, toshi_id, name) VALUES ($1, $2, $3)",
+                              'BobSmith', TEST_ADDRESS, 'Bob')
+
+        resp = await self.fetch("/user/{}".format(TEST_ADDRESS))
+        self.assertResponseCodeEqual(resp, 200)
+
+        resp = await self.fetch("/user/{}".format(TEST_ADDRESS))
+        self.assertResponseCodeEqual(resp, 200)
+        resp = await self.fetch("/user/bobsmith")
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertEqual(json_decode(resp.body)['name'], 'Bob')
+
+        stats = self._app.user_cache.stats()
+        self.assertEqual(stats['rows']['hits'], 2)
+        self.assertEqual(stats['rows']['misses'], 1)
+
+    @gen_test
+    @requires_database
+    async def test_update_user_evicts_cache(self):
+
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO users (username, toshi_id, name) VALUES ($1, $2, $3)",
+                              'BobSmith', TEST_ADDRESS, 'Bob')
+
+        resp = await self.fetch("/user/{}".format(TEST_ADDRESS))
+        self.assertResponseCodeEqual(resp, 200)
+
+        resp = await self.fetch_signed("/user", signing_key=TEST_PRIVATE_KEY, method="PUT",
+                                       body={'username': 'JamesSmith', 'name': 'James'})
+        self.assertResponseCodeEqual(resp, 200)
+
+        resp = await self.fetch("/user/{}".format(TEST_ADDRESS))
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertEqual(json_decode(resp.body)['name'], 'James')
+
+        resp = await self.fetch("/user/bobsmith")
+        self.assertResponseCodeEqual(resp, 404)
+        resp = await self.fetch("/user/jamessmith")
+        self.assertResponseCodeEqual(resp, 200)
+
+    @gen_test
+    @requires_database
+    async def test_reputation_update_evicts_cache(self):
+
+        config['reputation'] = {'id': TEST_ADDRESS}
+
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO users (toshi_id) VALUES ($1)", TEST_ADDRESS_2)
+
+        resp = await self.fetch("/user/{}".format(TEST_ADDRESS_2))
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertEqual(json_decode(resp.body)['review_count'], 0)
+
+        resp = await self.fetch_signed("/reputation", signing_key=TEST_PRIVATE_KEY, method="POST",
+                                       body={'toshi_id': TEST_ADDRESS_2, "reputation_score": 4.4,
+                                             "review_count": 10, "average_rating": 4.9})
+        self.assertResponseCodeEqual(resp, 204)
+
+        resp = await self.fetch("/user/{}".format(TEST_ADDRESS_2))
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertEqual(json_decode(resp.body)['review_count'], 10)
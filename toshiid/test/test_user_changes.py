@@ -0,0 +1,69 @@
+import os
+
+from tornado.escape import json_decode
+from tornado.testing import gen_test
+
+from toshiid.app import urls
+from toshiid.users_v2 import MAX_CHANGES_TOSHI_IDS
+from toshi.test.database import requires_database
+from toshi.test.base import AsyncHandlerTest
+from toshi.ethereum.utils import data_encoder
+
+class UserChangesHandlerTest(AsyncHandlerTest):
+
+    def get_urls(self):
+        return urls
+
+    @gen_test
+    @requires_database
+    async def test_changes_since_cursor(self):
+
+        users = [(data_encoder(os.urandom(20)), "user{}".format(i)) for i in range(5)]
+
+        # created well before the cursor's safety margin
+        async with self.pool.acquire() as con:
+            await con.executemany("INSERT INTO users (toshi_id, username, updated) "
+                                  "VALUES ($1, $2, (now() AT TIME ZONE 'utc') - interval '1 hour')", users)
+
+        query = "&".join("toshi_id={}".format(toshi_id) for toshi_id, _ in users)
+
+        resp = await self.fetch("/v2/users/changes?{}".format(query))
+        self.assertResponseCodeEqual(resp, 200)
+        body = json_decode(resp.body)
+        self.assertEqual(len(body['results']), len(users))
+        cursor = body['cursor']
+
+        resp = await self.fetch("/v2/users/changes?since={}&{}".format(cursor, query))
+        self.assertResponseCodeEqual(resp, 200)
+        body = json_decode(resp.body)
+        self.assertEqual(len(body['results']), 0)
+
+        async with self.pool.acquire() as con:
+            await con.execute("UPDATE users SET name = $1 WHERE toshi_id = $2", "Changed", users[2][0])
+
+        resp = await self.fetch("/v2/users/changes?since={}&{}".format(cursor, query))
+        self.assertResponseCodeEqual(resp, 200)
+        body = json_decode(resp.body)
+        self.assertEqual(len(body['results']), 1)
+        self.assertEqual(body['results'][0]['toshi_id'], users[2][0])
+        self.assertEqual(body['results'][0]['name'], "Changed")
+
+    @gen_test
+    @requires_database
+    async def test_changes_bad_arguments(self):
+
+        resp = await self.fetch("/v2/users/changes")
+        self.assertResponseCodeEqual(resp, 400)
+
+        resp = await self.fetch("/v2/users/changes?toshi_id=0x1234")
+        self.assertResponseCodeEqual(resp, 400)
+
+        resp = await self.fetch("/v2/users/changes?since=abc&toshi_id={}".format(data_encoder(os.urandom(20))))
+        self.assertResponseCodeEqual(resp, 400)
+
+        # one more than the max still fits in the request headers, so it
+        # gets a json error rather than being dropped by the server
+        resp = await self.fetch("/v2/users/changes?{}".format("&".join(
+            "toshi_id={}".format(data_encoder(os.urandom(20))) for _ in range(MAX_CHANGES_TOSHI_IDS + 1))))
+        self.assertResponseCodeEqual(resp, 400)
+        self.assertEqual(json_decode(resp.body)['errors'][0]['id'], 'bad_arguments')
@@ -6,6 +6,8 @@ from tornado.escape import json_decode
 from tornado.testing import gen_test
 
 from toshiid.app import urls
+from toshiid.housekeeping import SignupJobs
+from toshiid.jobs import JobWorker
 from toshiid.handlers_v1 import generate_username
 from toshi.analytics import encode_id
 from toshi.test.moto_server import requires_moto, BotoTestMixin
@@ -68,6 +70,14 @@ class UserHandlerTest(BotoTestMixin, AsyncHandlerTest):
             regex.match("\/[^\/]+\/public\/identicon\/{}\.png".format(TEST_PAYMENT_ADDRESS),
                         urllib.parse.urlparse(row['avatar']).path), row['avatar'])
 
+        # ensure a tracking event was queued
+        async with self.pool.acquire() as con:
+            job = await con.fetchrow("SELECT * FROM jobs WHERE kind = 'analytics'")
+        self.assertEqual(json_decode(job['payload'])['toshi_id'], TEST_ADDRESS)
+
+        # the identicon is uploaded by the job queue
+        await JobWorker(SignupJobs().handlers()).run_pending()
+
         async with self.boto:
             objs = await self.boto.list_objects()
         self.assertIn('Contents', objs)
@@ -76,9 +86,6 @@ class UserHandlerTest(BotoTestMixin, AsyncHandlerTest):
         resp = await self.fetch(row['avatar'], method="GET")
         self.assertEqual(resp.code, 200, "Got unexpected {} for url: {}".format(resp.code, row['avatar']))
 
-        # ensure we got a tracking event
-        self.assertEqual((await self.next_tracking_event())[0], encode_id(TEST_ADDRESS))
-
     @gen_test
     @requires_database
     @requires_moto
@@ -102,8 +109,10 @@ class UserHandlerTest(BotoTestMixin, AsyncHandlerTest):
         self.assertIsNotNone(row)
         self.assertTrue(row['is_bot'])
 
-        # ensure we got a tracking event
-        self.assertEqual((await self.next_tracking_event())[0], encode_id(TEST_ADDRESS))
+        # ensure a tracking event was queued
+        async with self.pool.acquire() as con:
+            job = await con.fetchrow("SELECT * FROM jobs WHERE kind = 'analytics'")
+        self.assertEqual(json_decode(job['payload'])['toshi_id'], TEST_ADDRESS)
 
     @gen_test
     @requires_database
@@ -167,8 +176,10 @@ class UserHandlerTest(BotoTestMixin, AsyncHandlerTest):
 
         self.assertEqual(row['username'], username)
 
-        # ensure we got a tracking event
-        self.assertEqual((await self.next_tracking_event())[0], encode_id(TEST_ADDRESS))
+        # ensure a tracking event was queued
+        async with self.pool.acquire() as con:
+            job = await con.fetchrow("SELECT * FROM jobs WHERE kind = 'analytics'")
+        self.assertEqual(json_decode(job['payload'])['toshi_id'], TEST_ADDRESS)
 
     @gen_test
     @requires_database
@@ -675,8 +686,10 @@ class AppHandlerTestWithForcedPublic(AsyncHandlerTest):
 
         self.assertIsNotNone(row['username'])
 
-        # ensure we got a tracking event
-        self.assertEqual((await self.next_tracking_event())[0], encode_id(TEST_ADDRESS))
+        # ensure a tracking event was queued
+        async with self.pool.acquire() as con:
+            job = await con.fetchrow("SELECT * FROM jobs WHERE kind = 'analytics'")
+        self.assertEqual(json_decode(job['payload'])['toshi_id'], TEST_ADDRESS)
 
         resp = await self.fetch_signed("/user", signing_key=TEST_PRIVATE_KEY, method="PUT",
                                        body={'is_app': False})
@@ -6,7 +6,9 @@ from tornado.escape import json_decode
 from tornado.testing import gen_test
 
 from toshiid.app import urls
-from toshiid.handlers_v1 import generate_username
+from toshiid.housekeeping import SignupJobs
+from toshiid.jobs import JobWorker
+from toshiid.handlers_v1 import generate_username, MIN_AUTOID_LENGTH
 from toshi.analytics import encode_id
 from toshi.test.moto_server import requires_moto, BotoTestMixin
 from toshi.test.database import requires_database
@@ -63,6 +65,14 @@ class UserHandlerV2Test(BotoTestMixin, AsyncHandlerTest):
             regex.match("\/[^\/]+\/public\/identicon\/{}\.png".format(TEST_PAYMENT_ADDRESS),
                         urllib.parse.urlparse(row['avatar']).path), row['avatar'])
 
+        # ensure a tracking event was queued
+        async with self.pool.acquire() as con:
+            job = await con.fetchrow("SELECT * FROM jobs WHERE kind = 'analytics'")
+        self.assertEqual(json_decode(job['payload'])['toshi_id'], TEST_ADDRESS)
+
+        # the identicon is uploaded by the job queue
+        await JobWorker(SignupJobs().handlers()).run_pending()
+
         async with self.boto:
             objs = await self.boto.list_objects()
         self.assertIn('Contents', objs)
@@ -71,8 +81,30 @@ class UserHandlerV2Test(BotoTestMixin, AsyncHandlerTest):
         resp = await self.fetch(row['avatar'], method="GET")
         self.assertEqual(resp.code, 200, "Got unexpected {} for url: {}".format(resp.code, row['avatar']))
 
-        # ensure we got a tracking event
-        self.assertEqual((await self.next_tracking_event())[0], encode_id(TEST_ADDRESS))
+    @gen_test
+    @requires_database
+    @requires_moto
+    async def test_create_user_generated_username_skips_taken(self):
+
+        # take every username of the shortest generated length
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO users (toshi_id, username) "
+                              "SELECT 'taken' || i, 'user' || lpad(i::TEXT, $1, '0') "
+                              "FROM generate_series(0, (10 ^ $1)::INTEGER - 1) AS i",
+                              MIN_AUTOID_LENGTH)
+
+        resp = await self.fetch_signed("/v2/user", signing_key=TEST_PRIVATE_KEY, method="POST",
+                                       body={'payment_address': TEST_PAYMENT_ADDRESS})
+        self.assertResponseCodeEqual(resp, 200)
+
+        username = json_decode(resp.body)['username']
+        self.assertIsNotNone(regex.match('^user[0-9]+$', username), username)
+        self.assertEqual(len(username), len('user') + MIN_AUTOID_LENGTH + 1)
+
+        # ensure a tracking event was queued
+        async with self.pool.acquire() as con:
+            job = await con.fetchrow("SELECT * FROM jobs WHERE kind = 'analytics'")
+        self.assertEqual(json_decode(job['payload'])['toshi_id'], TEST_ADDRESS)
 
     @gen_test
     @requires_database
@@ -97,8 +129,10 @@ class UserHandlerV2Test(BotoTestMixin, AsyncHandlerTest):
         self.assertIsNotNone(row)
         self.assertTrue(row['is_bot'])
 
-        # ensure we got a tracking event
-        self.assertEqual((await self.next_tracking_event())[0], encode_id(TEST_ADDRESS))
+        # ensure a tracking event was queued
+        async with self.pool.acquire() as con:
+            job = await con.fetchrow("SELECT * FROM jobs WHERE kind = 'analytics'")
+        self.assertEqual(json_decode(job['payload'])['toshi_id'], TEST_ADDRESS)
 
     @gen_test
     @requires_database
@@ -163,8 +197,10 @@ class UserHandlerV2Test(BotoTestMixin, AsyncHandlerTest):
 
         self.assertEqual(row['username'], username)
 
-        # ensure we got a tracking event
-        self.assertEqual((await self.next_tracking_event())[0], encode_id(TEST_ADDRESS))
+        # ensure a tracking event was queued
+        async with self.pool.acquire() as con:
+            job = await con.fetchrow("SELECT * FROM jobs WHERE kind = 'analytics'")
+        self.assertEqual(json_decode(job['payload'])['toshi_id'], TEST_ADDRESS)
 
     @gen_test
     @requires_database
@@ -384,6 +420,37 @@ class UserHandlerV2Test(BotoTestMixin, AsyncHandlerTest):
 
         self.assertResponseCodeEqual(resp, 404)
 
+    @gen_test
+    @requires_database
+    async def test_get_user_not_modified(self):
+
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO users (username, toshi_id, name) VALUES ($1, $2, $3)", 'BobSmith', TEST_ADDRESS, 'Bob')
+
+        resp = await self.fetch("/v2/user/{}".format(TEST_ADDRESS), method="GET")
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertIn('Etag', resp.headers)
+        etag = resp.headers['Etag']
+
+        for path in [TEST_ADDRESS, 'bobsmith']:
+            resp = await self.fetch("/v2/user/{}".format(path), method="GET", headers={
+                'If-None-Match': etag
+            })
+            self.assertResponseCodeEqual(resp, 304)
+            self.assertEqual(resp.body, b'')
+
+        # reputation changes should invalidate the etag
+        async with self.pool.acquire() as con:
+            await con.execute("UPDATE users SET reputation_score = $1, review_count = $2 WHERE toshi_id = $3",
+                              4.5, 10, TEST_ADDRESS)
+
+        resp = await self.fetch("/v2/user/{}".format(TEST_ADDRESS), method="GET", headers={
+            'If-None-Match': etag
+        })
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertNotEqual(resp.headers['Etag'], etag)
+        self.assertEqual(json_decode(resp.body)['reputation_score'], 4.5)
+
     @gen_test
     @requires_database
     async def test_update_user(self):
@@ -636,8 +703,10 @@ class AppHandlerTestWithForcedPublicV2(AsyncHandlerTest):
 
         self.assertIsNotNone(row['username'])
 
-        # ensure we got a tracking event
-        self.assertEqual((await self.next_tracking_event())[0], encode_id(TEST_ADDRESS))
+        # ensure a tracking event was queued
+        async with self.pool.acquire() as con:
+            job = await con.fetchrow("SELECT * FROM jobs WHERE kind = 'analytics'")
+        self.assertEqual(json_decode(job['payload'])['toshi_id'], TEST_ADDRESS)
 
         resp = await self.fetch_signed("/v2/user", signing_key=TEST_PRIVATE_KEY, method="PUT",
                                        body={'bot': False})
@@ -0,0 +1,72 @@
+import os
+
+from tornado.escape import json_decode, json_encode
+from tornado.testing import gen_test
+
+from toshiid.app import urls
+from toshiid.users_v2 import MAX_BATCH_SIZE
+from toshi.test.database import requires_database
+from toshi.test.base import AsyncHandlerTest
+from toshi.ethereum.utils import data_encoder
+
+class UserBatchHandlerTest(AsyncHandlerTest):
+
+    def get_urls(self):
+        return urls
+
+    @gen_test
+    @requires_database
+    async def test_batch_lookup(self):
+
+        users = [(data_encoder(os.urandom(20)), "user{}".format(i)) for i in range(20)]
+        missing_toshi_id = "0xaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa"
+
+        async with self.pool.acquire() as con:
+            await con.executemany("INSERT INTO users (toshi_id, username) VALUES ($1, $2)", users)
+
+        toshi_ids = [users[5][0], missing_toshi_id, users[1][0], users[12][0]]
+        usernames = ["USER3", "missinguser", users[7][1]]
+
+        resp = await self.fetch("/v2/users/batch", method="POST", body=json_encode({
+            'toshi_ids': toshi_ids,
+            'usernames': usernames
+        }))
+        self.assertResponseCodeEqual(resp, 200)
+        body = json_decode(resp.body)
+
+        self.assertEqual(len(body['toshi_ids']), len(toshi_ids))
+        self.assertEqual(body['toshi_ids'][0]['toshi_id'], users[5][0])
+        self.assertIsNone(body['toshi_ids'][1])
+        self.assertEqual(body['toshi_ids'][2]['toshi_id'], users[1][0])
+        self.assertEqual(body['toshi_ids'][3]['toshi_id'], users[12][0])
+
+        self.assertEqual(len(body['usernames']), len(usernames))
+        self.assertEqual(body['usernames'][0]['toshi_id'], users[3][0])
+        self.assertIsNone(body['usernames'][1])
+        self.assertEqual(body['usernames'][2]['toshi_id'], users[7][0])
+
+    @gen_test
+    @requires_database
+    async def test_batch_lookup_bad_arguments(self):
+
+        resp = await self.fetch("/v2/users/batch", method="POST", body=json_encode({
+            'toshi_ids': ["0')) AS a (id); DELETE FROM users; --"]
+        }))
+        self.assertResponseCodeEqual(resp, 400)
+
+        resp = await self.fetch("/v2/users/batch", method="POST", body=json_encode({
+            'usernames': ["0bad username"]
+        }))
+        self.assertResponseCodeEqual(resp, 400)
+
+        resp = await self.fetch("/v2/users/batch", method="POST", body=json_encode({}))
+        self.assertResponseCodeEqual(resp, 400)
+
+        for body in [['not', 'a', 'dict'], "string", {'toshi_ids': [1, 2]}, {'usernames': [None]}]:
+            resp = await self.fetch("/v2/users/batch", method="POST", body=json_encode(body))
+            self.assertResponseCodeEqual(resp, 400)
+
+        resp = await self.fetch("/v2/users/batch", method="POST", body=json_encode({
+            'toshi_ids': [data_encoder(os.urandom(20)) for _ in range(MAX_BATCH_SIZE + 1)]
+        }))
+        self.assertResponseCodeEqual(resp, 400)
@@ -0,0 +1,340 @@
+import base64
+import email.message
+import email.utils
+import io
+import tempfile
+import time
+
+from PIL import Image
+from tornado.httputil import HTTPFile, HTTPHeaders
+from tornado.web import Finish
+
+from toshi.config import config
+from toshi.crypto import ecrecover
+from toshi.errors import JSONHTTPError
+from toshi.ethereum.utils import data_decoder
+from toshi.handlers import (TIMESTAMP_EXPIRY, TOSHI_ID_ADDRESS_HEADER, TOSHI_SIGNATURE_HEADER,
+                            TOSHI_TIMESTAMP_HEADER)
+from toshi.utils import parse_int, validate_address, validate_signature
+
+# the same keccak implementations used by ethereum.utils.sha3, which only
+# hashes whole values
+try:
+    from Crypto.Hash import keccak
+
+    def keccak_256():
+        return keccak.new(digest_bits=256)
+except ImportError:
+    from sha3 import keccak_256
+
+# uploads are kept in memory up to this size, and in a temporary file after
+SPOOL_MEMORY_SIZE = 1024 * 1024
+# how much of an uploaded image is kept to read its size from its headers
+PROBE_SIZE = 256 * 1024
+MAX_PART_HEADERS_SIZE = 16 * 1024
+
+DEFAULT_MAX_UPLOAD_SIZE = 10 * 1024 * 1024
+DEFAULT_MAX_IMAGE_PIXELS = 50 * 1000 * 1000
+
+def max_upload_size():
+    if 'general' not in config:
+        return DEFAULT_MAX_UPLOAD_SIZE
+    return config['general'].getint('avatar_max_upload_size', DEFAULT_MAX_UPLOAD_SIZE)
+
+def max_image_pixels():
+    if 'general' not in config:
+        return DEFAULT_MAX_IMAGE_PIXELS
+    return config['general'].getint('avatar_max_pixels', DEFAULT_MAX_IMAGE_PIXELS)
+
+def parse_header(line):
+    """Parses a header like Content-Type or Content-Disposition into its
+    main value and a dict of its parameters"""
+    message = email.message.Message()
+    message['header'] = line
+    params = message.get_params(header='header') or [('', '')]
+    return params[0][0], {key.lower(): email.utils.collapse_rfc2231_value(value) for key, value in params[1:]}
+
+def verify_request_signature(request, body_hash):
+    """Verifies a request signed with the Toshi-* headers against
+    `body_hash`, the keccak-256 digest of its body or None if it's empty,
+    returning the address that signed it.
+
+    This is the check `RequestVerificationMixin.verify_request` makes, for
+    bodies that aren't kept to be hashed all at once, so errors are reported
+    the same way."""
+
+    expected_address = request.headers[TOSHI_ID_ADDRESS_HEADER]
+    signature = request.headers[TOSHI_SIGNATURE_HEADER]
+    timestamp = parse_int(request.headers[TOSHI_TIMESTAMP_HEADER])
+
+    if timestamp is None:
+        raise JSONHTTPError(400, body={'errors': [{'id': 'invalid_timestamp', 'message': 'Given Toshi-Timestamp is invalid'}]})
+    if not validate_address(expected_address):
+        raise JSONHTTPError(400, body={'errors': [{'id': 'invalid_id_address', 'message': 'Invalid Toshi-ID-Address'}]})
+    if not validate_signature(signature):
+        raise JSONHTTPError(400, body={'errors': [{'id': 'invalid_signature', 'message': 'Invalid Toshi-Signature'}]})
+
+    data_hash = base64.b64encode(body_hash).decode('ascii') if body_hash is not None else ""
+    data_string = "{}\n{}\n{}\n{}".format(request.method, request.path, timestamp, data_hash)
+    try:
+        valid = ecrecover(data_string, data_decoder(signature), expected_address)
+    except Exception:
+        valid = False
+    if not valid:
+        raise JSONHTTPError(400, body={'errors': [{'id': 'invalid_signature', 'message': 'Invalid Toshi-Signature'}]})
+
+    if abs(int(time.time()) - timestamp) > TIMESTAMP_EXPIRY:
+        raise JSONHTTPError(400, body={'errors': [{'id': 'invalid_timestamp', 'message': 'The difference between the timestamp and the current time is too large'}]})
+
+    return expected_address
+
+def image_too_large_error(max_pixels):
+    return JSONHTTPError(413, body={'errors': [{'id': 'image_too_large', 'message': 'Image too large, max is {} pixels'.format(max_pixels)}]})
+
+class MultipartError(Exception):
+    pass
+
+_PREAMBLE, _DELIMITER, _HEADERS, _BODY, _END = range(5)
+
+class MultipartStreamParser:
+    """Parses a multipart/form-data body as it's received.
+
+    Files are written to spooled temporary files, which are returned as the
+    `body` of their `HTTPFile`, rather than being held in memory. Other
+    fields are collected into `arguments` like tornado's own parser.
+
+    `on_file_data(file, data, offset)` is called with each piece of a file
+    as it's received, `offset` being the amount of the file before `data`."""
+
+    def __init__(self, boundary, on_file_data=None):
+        # the boundary may be quoted
+        if boundary.startswith('"') and boundary.endswith('"'):
+            boundary = boundary[1:-1]
+        self._delimiter = b'--' + boundary.encode('latin1')
+        self._on_file_data = on_file_data
+        self._buffer = bytearray()
+        self._state = _PREAMBLE
+        self._part = None
+        self._part_name = None
+        self._part_size = 0
+        self.files = {}
+        self.arguments = {}
+
+    def feed(self, data):
+        buffer = self._buffer
+        buffer += data
+        while True:
+            if self._state == _PREAMBLE:
+                index = buffer.find(self._delimiter)
+                if index == -1:
+                    # keep enough to match a delimiter split across chunks
+                    del buffer[:-len(self._delimiter)]
+                    return
+                del buffer[:index + len(self._delimiter)]
+                self._state = _DELIMITER
+            elif self._state == _DELIMITER:
+                if len(buffer) < 2:
+                    return
+                if buffer[:2] == b'--':
+                    self._state = _END
+                elif buffer[:2] == b'\r\n':
+                    self._state = _HEADERS
+                else:
+                    raise MultipartError("Invalid multipart boundary")
+                del buffer[:2]
+            elif self._state == _HEADERS:
+                index = buffer.find(b'\r\n\r\n')
+                if index == -1:
+                    if len(buffer) > MAX_PART_HEADERS_SIZE:
+                        raise MultipartError("Multipart headers too large")
+                    return
+                self._start_part(bytes(buffer[:index]))
+                del buffer[:index + 4]
+                self._state = _BODY
+            elif self._state == _BODY:
+                index = buffer.find(b'\r\n' + self._delimiter)
+                if index == -1:
+                    # everything but what could be the start of the next
+                    # delimiter belongs to the part
+                    keep = len(self._delimiter) + 1
+                    if len(buffer) > keep:
+                        self._part_data(bytes(buffer[:-keep]))
+                        del buffer[:-keep]
+                    return
+                self._part_data(bytes(buffer[:index]))
+                self._end_part()
+                del buffer[:index + 2 + len(self._delimiter)]
+                self._state = _DELIMITER
+            else:
+                # ignore the epilogue
+                buffer.clear()
+                return
+
+    def finish(self):
+        if self._state != _END:
+            raise MultipartError("Incomplete multipart body")
+        for files in self.files.values():
+            for file in files:
+                file.body.seek(0)
+
+    def close(self):
+        for files in self.files.values():
+            for file in files:
+                file.body.close()
+
+    def _start_part(self, headers):
+        try:
+            headers = HTTPHeaders.parse(headers.decode('utf-8'))
+        except UnicodeDecodeError:
+            raise MultipartError("Invalid multipart headers")
+        disposition, params = parse_header(headers.get('Content-Disposition', ''))
+        self._part_name = params.get('name')
+        self._part_size = 0
+        # like tornado, parts that aren't valid form data are skipped
+        if disposition != 'form-data' or not params.get('name'):
+            self._part = None
+        elif params.get('filename'):
+            self._part = HTTPFile(filename=params['filename'],
+                                  body=tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_SIZE),
+                                  content_type=headers.get('Content-Type', 'application/unknown'))
+            self.files.setdefault(self._part_name, []).append(self._part)
+        else:
+            self._part = bytearray()
+            self.arguments.setdefault(self._part_name, []).append(self._part)
+
+    def _part_data(self, data):
+        if self._part is None or not data:
+            return
+        if isinstance(self._part, bytearray):
+            self._part += data
+        else:
+            self._part.body.write(data)
+            if self._on_file_data is not None:
+                self._on_file_data(self._part, data, self._part_size)
+        self._part_size += len(data)
+
+    def _end_part(self):
+        if isinstance(self._part, bytearray):
+            self.arguments[self._part_name][-1] = bytes(self._part)
+        self._part = None
+
+class StreamingUploadMixin:
+    """Receives the request body as it's streamed in, for handlers decorated
+    with `tornado.web.stream_request_body`.
+
+    multipart/form-data bodies are parsed as they arrive, so uploads larger
+    than `avatar_max_upload_size`, or images whose headers say they have
+    more than `avatar_max_pixels` pixels, are rejected without waiting for
+    the rest of the body. Methods must call `finish_request_body` before
+    using the body, after which the uploaded files are in `request.files`,
+    with each file's `body` being a spooled temporary file.
+
+    multipart bodies aren't kept once they're parsed, so `request.body` is
+    left empty for them, and `verify_request` checks the signature against
+    a hash of the body computed as it was received."""
+
+    def prepare(self):
+        super().prepare()
+        self._received = 0
+        self._max_upload_size = max_upload_size()
+        self._max_image_pixels = max_image_pixels()
+        self._body = bytearray()
+        self._body_hash = keccak_256()
+        self._multipart = None
+        self._probe = None
+
+        content_length = parse_int(self.request.headers.get('Content-Length'))
+        if content_length is not None and content_length > self._max_upload_size:
+            raise self.upload_too_large_error()
+
+        content_type = self.request.headers.get('Content-Type', '')
+        if content_type.startswith('multipart/form-data'):
+            _, params = parse_header(content_type)
+            if not params.get('boundary'):
+                raise JSONHTTPError(400, body={'errors': [{'id': 'bad_data', 'message': 'Missing multipart boundary'}]})
+            self._multipart = MultipartStreamParser(params['boundary'], on_file_data=self._probe_image)
+
+    def data_received(self, chunk):
+        # the response has already been sent if the upload was rejected
+        if self._finished:
+            return
+        self._received += len(chunk)
+        try:
+            if self._received > self._max_upload_size:
+                raise self.upload_too_large_error()
+            self._body_hash.update(chunk)
+            if self._multipart is not None:
+                self._multipart.feed(chunk)
+            else:
+                self._body += chunk
+        except MultipartError as e:
+            self.reject_upload(JSONHTTPError(400, body={'errors': [{'id': 'bad_data', 'message': str(e)}]}))
+        except JSONHTTPError as e:
+            self.reject_upload(e)
+
+    def finish_request_body(self):
+        """Sets `request.body` to the received body, or `request.files` and
+        `request.body_arguments` if it's multipart/form-data"""
+
+        if self._finished:
+            # the upload was rejected while it was being received
+            raise Finish()
+
+        self.request.body = bytes(self._body)
+        self._body = None
+
+        if self._multipart is not None:
+            try:
+                self._multipart.finish()
+            except MultipartError as e:
+                raise JSONHTTPError(400, body={'errors': [{'id': 'bad_data', 'message': str(e)}]})
+            self.request.files = self._multipart.files
+            for name, values in self._multipart.arguments.items():
+                self.request.body_arguments.setdefault(name, []).extend(values)
+                self.request.arguments.setdefault(name, []).extend(values)
+
+    def verify_request(self):
+        """Verifies the request's signature like `RequestVerificationMixin`,
+        using the hash of the body computed while it was received for
+        multipart bodies"""
+
+        headers = self.request.headers
+        if self._multipart is None or not all(header in headers for header in [
+                TOSHI_ID_ADDRESS_HEADER, TOSHI_SIGNATURE_HEADER, TOSHI_TIMESTAMP_HEADER]):
+            # the body is available, or the request is rejected before the
+            # body is needed
+            return super().verify_request()
+
+        return verify_request_signature(self.request, self._body_hash.digest() if self._received else None)
+
+    def reject_upload(self, error):
+        self.send_error(error.status_code, exc_info=(type(error), error, error.__traceback__))
+
+    def upload_too_large_error(self):
+        return JSONHTTPError(413, body={'errors': [{'id': 'upload_too_large', 'message': 'Upload too large, max is {} bytes'.format(self._max_upload_size)}]})
+
+    def _probe_image(self, file, data, offset):
+        # opening an image only reads its headers, so its size can be
+        # checked as soon as enough of it has arrived
+        if offset == 0:
+            self._probe = bytearray()
+        if self._probe is None:
+            return
+        self._probe += data
+        try:
+            img = Image.open(io.BytesIO(self._probe))
+        except Exception:
+            # not enough to read the headers yet, or not an image, which
+            # is left for the decoder to report
+            if len(self._probe) >= PROBE_SIZE:
+                self._probe = None
+            return
+        self._probe = None
+        if img.size[0] * img.size[1] > self._max_image_pixels:
+            raise image_too_large_error(self._max_image_pixels)
+
+    def on_finish(self):
+        super().on_finish()
+        # prepare isn't called for unsupported methods
+        if getattr(self, '_multipart', None) is not None:
+            self._multipart.close()
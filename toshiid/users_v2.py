@@ -0,0 +1,117 @@
+import datetime
+
+from toshi.database import DatabaseMixin
+from toshi.handlers import BaseHandler
+from toshi.errors import JSONHTTPError
+from toshi.utils import validate_address, parse_int
+from toshiid.handlers_v1 import validate_username
+from toshiid.serialization import UserJSONMixin
+
+MAX_BATCH_SIZE = 500
+
+# each toshi_id takes ~52 bytes of the query string, which has to fit in
+# tornado's 64KB max_header_size
+MAX_CHANGES_TOSHI_IDS = 1000
+# how far behind the database's clock returned cursors are kept. Changes
+# made by transactions that were still running when the changes were
+# queried will have an `updated` time before they are visible, so this
+# makes sure they are picked up by the next sync
+CHANGES_CURSOR_MARGIN = datetime.timedelta(seconds=30)
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+def encode_cursor(timestamp):
+    return str((timestamp - EPOCH) // datetime.timedelta(microseconds=1))
+
+def decode_cursor(cursor):
+    value = parse_int(cursor)
+    if value is None or value < 0:
+        return None
+    return EPOCH + datetime.timedelta(microseconds=value)
+
+class UserBatchHandler(UserJSONMixin, DatabaseMixin, BaseHandler):
+
+    async def post(self):
+
+        try:
+            payload = self.json
+        except:
+            raise JSONHTTPError(400, body={'errors': [{'id': 'bad_data', 'message': 'Error decoding data. Expected JSON content'}]})
+
+        if not isinstance(payload, dict):
+            raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Bad Arguments'}]})
+
+        toshi_ids = payload.get('toshi_ids', [])
+        usernames = payload.get('usernames', [])
+
+        if not isinstance(toshi_ids, list) or not isinstance(usernames, list) or \
+           not all(isinstance(value, str) for value in toshi_ids + usernames):
+            raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Bad Arguments'}]})
+        if len(toshi_ids) + len(usernames) == 0:
+            raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Bad Arguments'}]})
+        if len(toshi_ids) + len(usernames) > MAX_BATCH_SIZE:
+            raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Too many users requested. Max is {}'.format(MAX_BATCH_SIZE)}]})
+        if not all(validate_address(toshi_id) for toshi_id in toshi_ids):
+            raise JSONHTTPError(400, body={'errors': [{'id': 'invalid_toshi_id', 'message': 'Invalid Toshi ID'}]})
+        if not all(validate_username(username) for username in usernames):
+            raise JSONHTTPError(400, body={'errors': [{'id': 'invalid_username', 'message': 'Invalid Username'}]})
+
+        # each position in the arrays holds either a toshi_id or a username
+        toshi_id_column = [toshi_id.lower() for toshi_id in toshi_ids] + [None] * len(usernames)
+        username_column = [None] * len(toshi_ids) + [username.lower() for username in usernames]
+
+        # the lookups are joined separately, as an OR in the join condition
+        # stops postgres from using the toshi_id and lower(username) indexes
+        async with self.db:
+            rows = await self.db.fetch(
+                "WITH v AS (SELECT * FROM unnest($1::VARCHAR[], $2::VARCHAR[]) WITH ORDINALITY AS v (toshi_id, username, ordering)) "
+                "SELECT v.ordering, u.* FROM v JOIN users u ON u.toshi_id = v.toshi_id "
+                "UNION ALL "
+                "SELECT v.ordering, u.* FROM v JOIN users u ON lower(u.username) = v.username",
+                toshi_id_column, username_column)
+
+        # users that weren't found are returned as null
+        results = [None] * len(toshi_id_column)
+        for row in rows:
+            results[row['ordering'] - 1] = self.user_json_v2(row)
+
+        self.write_json({
+            'toshi_ids': results[:len(toshi_ids)],
+            'usernames': results[len(toshi_ids):]
+        })
+
+class UserChangesHandler(UserJSONMixin, DatabaseMixin, BaseHandler):
+
+    async def get(self):
+
+        toshi_ids = self.get_query_arguments('toshi_id')
+        since = self.get_query_argument('since', None)
+
+        if len(toshi_ids) == 0:
+            raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Bad Arguments'}]})
+        if len(toshi_ids) > MAX_CHANGES_TOSHI_IDS:
+            raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Too many users requested. Max is {}'.format(MAX_CHANGES_TOSHI_IDS)}]})
+        if not all(validate_address(toshi_id) for toshi_id in toshi_ids):
+            raise JSONHTTPError(400, body={'errors': [{'id': 'invalid_toshi_id', 'message': 'Invalid Toshi ID'}]})
+
+        sql = "SELECT * FROM users WHERE toshi_id = ANY($1)"
+        args = [[toshi_id.lower() for toshi_id in toshi_ids]]
+        if since is not None:
+            since = decode_cursor(since)
+            if since is None:
+                raise JSONHTTPError(400, body={'errors': [{'id': 'invalid_cursor', 'message': 'Invalid Cursor'}]})
+            sql += " AND updated > $2"
+            args.append(since)
+
+        async with self.db:
+            now = await self.db.fetchval("SELECT (now() AT TIME ZONE 'utc')")
+            rows = await self.db.fetch(sql, *args)
+
+        cursor = now - CHANGES_CURSOR_MARGIN
+        if since is not None and since > cursor:
+            cursor = since
+
+        self.write_json({
+            'cursor': encode_cursor(cursor),
+            'results': [self.user_json_v2(row) for row in rows]
+        })